@@ -0,0 +1,82 @@
+""" Measure the time the default policy spends serving a cache hit.
+
+Run with the package importable, e.g.::
+
+  $ python benchmarks/bench_hit.py
+"""
+import sys
+import time
+
+from repoze.accelerator.policy import AcceleratorPolicy
+from repoze.accelerator.storage import MemoryStorage
+
+ITERATIONS = 100000
+
+# roughly what a browser sends
+ENVIRON = {
+    'REQUEST_METHOD': 'GET',
+    'SCRIPT_NAME': '',
+    'PATH_INFO': '/index.html',
+    'QUERY_STRING': '',
+    'SERVER_NAME': 'example.com',
+    'SERVER_PORT': '80',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'CONTENT_TYPE': '',
+    'CONTENT_LENGTH': '',
+    'REMOTE_ADDR': '127.0.0.1',
+    'wsgi.url_scheme': 'http',
+    'wsgi.version': (1, 0),
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+    'HTTP_HOST': 'example.com',
+    'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) '
+                       'Gecko/20100101 Firefox/60.0',
+    'HTTP_ACCEPT': 'text/html,application/xhtml+xml,application/xml;'
+                   'q=0.9,*/*;q=0.8',
+    'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.5',
+    'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+    'HTTP_CONNECTION': 'keep-alive',
+    'HTTP_COOKIE': 'session=0123456789abcdef; theme=dark',
+    'HTTP_UPGRADE_INSECURE_REQUESTS': '1',
+    'HTTP_CACHE_CONTROL': 'max-age=0',
+    }
+
+HEADERS = [('Content-Type', 'text/html'),
+           ('Cache-Control', 'max-age=3600'),
+           ('ETag', '"abc"'),
+           ('Vary', 'Accept-Encoding')]
+
+def setup():
+    storage = MemoryStorage(None)
+    policy = AcceleratorPolicy(None, storage,
+                               always_vary_on_headers=('Accept-Language',))
+    handler = policy.store('200 OK', HEADERS, dict(ENVIRON))
+    handler.write('x' * 1000)
+    handler.close()
+    return policy
+
+def bench(policy, environ, iterations=ITERATIONS):
+    fetch = policy.fetch
+    assert fetch(dict(environ)) is not None
+    start = time.time()
+    for i in xrange(iterations):
+        fetch(environ)
+    return (time.time() - start) / iterations
+
+def main(argv=sys.argv):
+    iterations = ITERATIONS
+    if len(argv) > 1:
+        iterations = int(argv[1])
+    policy = setup()
+    cases = [
+        ('hit', ENVIRON),
+        ('304', dict(ENVIRON, HTTP_IF_NONE_MATCH='"abc"')),
+        ('range', dict(ENVIRON, HTTP_RANGE='bytes=0-99')),
+        ]
+    for name, environ in cases:
+        best = min([ bench(policy, environ, iterations) for i in range(3) ])
+        print '%-6s %6.2f usec per fetch' % (name, best * 1e6)
+
+if __name__ == '__main__':
+    main()
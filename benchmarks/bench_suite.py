@@ -0,0 +1,272 @@
+""" Measure the middleware, the default policy and MemoryStorage together.
+
+Each case calls an 'Accelerator' with synthetic environs, reading the
+whole response, and reports operations per second and percentiles of
+the time taken by each call:
+
+o 'hit_small', 'hit_large':  hits on a 1KB and a 1MB body.
+
+o 'miss_store':  misses on URLs never seen before, whose responses are
+  stored (in a storage bounded to 1000 entries, so that it evicts).
+
+o 'vary_1', 'vary_10', 'vary_100':  hits on a URL stored with that
+  many variants (varying on Accept-Language), in turn.
+
+o 'threads_1' ... 'threads_32':  hits on 1000 URLs, one miss in ten,
+  from that many threads at once.
+
+Run with the package importable, e.g.::
+
+  $ python benchmarks/bench_suite.py --json results.json
+  $ python benchmarks/bench_suite.py --baseline results.json
+
+With '--baseline', each case is compared with the results saved
+earlier, and the exit status is 1 if any ran slower by more than the
+'--threshold' percentage.  Each case is run '--rounds' times, and the
+fastest round reported.  Case names given as arguments select the
+cases whose names start with them.
+"""
+import json
+import optparse
+import platform
+import sys
+import threading
+import time
+
+from repoze.accelerator.middleware import Accelerator
+from repoze.accelerator.policy import AcceleratorPolicy
+from repoze.accelerator.storage import MemoryStorage
+
+from bench_hit import ENVIRON
+
+ITERATIONS = 20000
+ROUNDS = 3
+PERCENTILES = (50, 90, 99)
+THRESHOLD = 10.0
+THREADS = (1, 2, 4, 8, 16, 32)
+URLS = 1000
+
+timer = time.time
+if sys.platform == 'win32':
+    timer = time.clock
+
+HEADERS = [('Content-Type', 'text/html'),
+           ('Cache-Control', 'max-age=3600')]
+
+class App:
+    """ A WSGI application returning a body of 'size' bytes for every
+    request, with the response headers 'headers'.
+    """
+    def __init__(self, size=1000, headers=HEADERS):
+        self.body = 'x' * size
+        self.headers = list(headers)
+
+    def __call__(self, environ, start_response):
+        start_response('200 OK', self.headers)
+        return [self.body]
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+def make_accelerator(app, **storage_kw):
+    storage = MemoryStorage(None, **storage_kw)
+    policy = AcceleratorPolicy(None, storage)
+    return Accelerator(app, policy, None)
+
+def call(accelerator, environ):
+    result = accelerator(environ, start_response)
+    for chunk in result:
+        pass
+    if hasattr(result, 'close'):
+        result.close()
+
+def environ_for(path, **headers):
+    environ = dict(ENVIRON)
+    environ['PATH_INFO'] = path
+    environ.update(headers)
+    return environ
+
+def timed(accelerator, environs, iterations, latencies):
+    # Call 'accelerator' 'iterations' times, with each of 'environs' in
+    # turn, appending the time taken by each call to 'latencies'.
+    append = latencies.append
+    count = len(environs)
+    for i in xrange(iterations):
+        environ = environs[i % count]
+        start = timer()
+        call(accelerator, environ)
+        append(timer() - start)
+
+def run(accelerator, environs, iterations):
+    """ Return '(operations, seconds, latencies)' for 'iterations' calls.
+    """
+    latencies = []
+    start = timer()
+    timed(accelerator, environs, iterations, latencies)
+    return iterations, timer() - start, latencies
+
+def run_threads(accelerator, environs, iterations, threads):
+    """ As 'run', with 'iterations' calls split between 'threads'
+    threads, each starting at a different environ.
+    """
+    per_thread = max(iterations // threads, 1)
+    results = []
+    def work(environs):
+        latencies = []
+        timed(accelerator, environs, per_thread, latencies)
+        results.append(latencies)
+    step = len(environs) // threads
+    workers = [ threading.Thread(target=work,
+                                 args=(environs[i * step:] +
+                                       environs[:i * step],))
+                for i in range(threads) ]
+    start = timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = timer() - start
+    latencies = []
+    for result in results:
+        latencies.extend(result)
+    return per_thread * threads, seconds, latencies
+
+def case_hit(size):
+    def case(iterations):
+        accelerator = make_accelerator(App(size))
+        environs = [environ_for('/hit')]
+        call(accelerator, environs[0])
+        return run(accelerator, environs, iterations)
+    return case
+
+def case_miss(iterations):
+    accelerator = make_accelerator(App(), max_entries=URLS)
+    environs = [ environ_for('/miss/%d' % i) for i in range(iterations) ]
+    return run(accelerator, environs, iterations)
+
+def case_vary(variants):
+    def case(iterations):
+        headers = HEADERS + [('Vary', 'Accept-Language')]
+        accelerator = make_accelerator(App(headers=headers))
+        environs = [ environ_for('/vary', HTTP_ACCEPT_LANGUAGE='lang-%d' % i)
+                     for i in range(variants) ]
+        for environ in environs:
+            call(accelerator, environ)
+        return run(accelerator, environs, iterations)
+    return case
+
+def case_threads(threads):
+    def case(iterations):
+        accelerator = make_accelerator(App())
+        environs = [ environ_for('/threads/%d' % i) for i in range(URLS) ]
+        for environ in environs[::10]:
+            # one request in ten asks for a reload, so misses and stores
+            environ['HTTP_PRAGMA'] = 'no-cache'
+        for environ in environs:
+            call(accelerator, environ)
+        return run_threads(accelerator, environs, iterations, threads)
+    return case
+
+CASES = [
+    ('hit_small', case_hit(1000)),
+    ('hit_large', case_hit(1 << 20)),
+    ('miss_store', case_miss),
+    ('vary_1', case_vary(1)),
+    ('vary_10', case_vary(10)),
+    ('vary_100', case_vary(100)),
+    ] + [ ('threads_%d' % threads, case_threads(threads))
+          for threads in THREADS ]
+
+def percentile(ordered, percent):
+    """ Return the value below which 'percent' percent of the sorted
+    values 'ordered' fall.
+    """
+    if not ordered:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+def summarize(operations, seconds, latencies):
+    """ Return a dict of the results of a case.
+    """
+    latencies = sorted(latencies)
+    result = {'operations': operations,
+              'ops_per_sec': operations / seconds,
+              }
+    for percent in PERCENTILES:
+        result['p%d_usec' % percent] = percentile(latencies, percent) * 1e6
+    return result
+
+def change(result, base):
+    """ Return the percentage by which ops/sec changed from 'base' to
+    'result'.
+    """
+    return (result['ops_per_sec'] / base['ops_per_sec'] - 1) * 100
+
+def regressions(results, baseline, threshold=THRESHOLD):
+    """ Return the names of the cases in 'results' slower than in
+    'baseline' by more than 'threshold' percent.
+    """
+    return [ name for name, result in results
+             if name in baseline
+             and change(result, baseline[name]) < -threshold ]
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options] [case ...]')
+    parser.add_option('-n', '--iterations', type='int', default=ITERATIONS,
+                      help='calls per case (default %default)')
+    parser.add_option('-r', '--rounds', type='int', default=ROUNDS,
+                      help='rounds per case, the fastest of which is '
+                           'reported (default %default)')
+    parser.add_option('--json', metavar='PATH',
+                      help='save the results to PATH')
+    parser.add_option('--baseline', metavar='PATH',
+                      help='compare the results with those saved in PATH')
+    parser.add_option('--threshold', type='float', default=THRESHOLD,
+                      help='percentage of ops/sec lost which counts as '
+                           'a regression (default %default)')
+    options, names = parser.parse_args(argv[1:])
+
+    baseline = {}
+    if options.baseline:
+        baseline = json.load(open(options.baseline))['results']
+
+    results = []
+    for name, case in CASES:
+        if names and not [ n for n in names if name.startswith(n) ]:
+            continue
+        result = max([ summarize(*case(options.iterations))
+                       for i in range(options.rounds) ],
+                     key=lambda result: result['ops_per_sec'])
+        results.append((name, result))
+        line = '%-11s %10.0f ops/s  p50 %8.2f  p90 %8.2f  p99 %8.2f usec' % (
+            name, result['ops_per_sec'], result['p50_usec'],
+            result['p90_usec'], result['p99_usec'])
+        base = baseline.get(name)
+        if base is not None:
+            line += '  %+6.1f%%' % change(result, base)
+        print line
+        sys.stdout.flush()
+
+    if options.json:
+        f = open(options.json, 'w')
+        try:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'iterations': options.iterations,
+                       'rounds': options.rounds,
+                       'time': time.time(),
+                       'results': dict(results),
+                       }, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    slower = regressions(results, baseline, options.threshold)
+    if slower:
+        print 'slower than the baseline by more than %s%%: %s' % (
+            options.threshold, ', '.join(slower))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+""" Measure storage throughput as the number of threads grows.
+
+Each thread fetches random URLs, storing one of them every tenth
+operation, against a bounded MemoryStorage (one lock) and a
+ShardedMemoryStorage (one lock per segment).  Run with the package
+importable, e.g.::
+
+  $ python benchmarks/bench_threads.py [operations-per-thread]
+"""
+import random
+import sys
+import threading
+import time
+
+from repoze.accelerator.storage import MemoryStorage
+from repoze.accelerator.storage import ShardedMemoryStorage
+
+OPERATIONS = 20000
+URLS = [ 'http://example.com/%d' % i for i in range(1000) ]
+THREADS = (1, 2, 4, 8, 16)
+
+def store(storage, url):
+    handler = storage.store(url, (), sys.maxint, '200 OK',
+                            [('Content-Type', 'text/html')])
+    handler.write('x' * 100)
+    handler.close()
+
+def work(storage, operations, seed):
+    rnd = random.Random(seed)
+    for i in xrange(operations):
+        url = rnd.choice(URLS)
+        if i % 10 == 0:
+            store(storage, url)
+        else:
+            storage.fetch(url)
+
+def run(storage, threads, operations):
+    workers = [ threading.Thread(target=work, args=(storage, operations, i))
+                for i in range(threads) ]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * operations / (time.time() - start)
+
+def main(argv=sys.argv):
+    operations = OPERATIONS
+    if len(argv) > 1:
+        operations = int(argv[1])
+    factories = [
+        ('MemoryStorage', lambda: MemoryStorage(None, max_entries=800)),
+        ('Sharded(16)', lambda: ShardedMemoryStorage(None, 16,
+                                                     max_entries=800)),
+        ]
+    for name, factory in factories:
+        storage = factory()
+        for url in URLS:
+            store(storage, url)
+        for threads in THREADS:
+            print '%-14s %2d threads %9.0f ops/s' % (
+                name, threads, run(storage, threads, operations))
+
+if __name__ == '__main__':
+    main()
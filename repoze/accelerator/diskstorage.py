@@ -0,0 +1,332 @@
+import errno
+import os
+import tempfile
+import time
+
+try:
+    from hashlib import sha1
+except ImportError: #pragma NO COVER python < 2.5
+    from sha import new as sha1
+
+from zope.interface import implements
+from zope.interface import directlyProvides
+
+from repoze.accelerator.interfaces import IChunkHandler
+from repoze.accelerator.interfaces import IStorageFactory
+from repoze.accelerator.interfaces import IVariantStorage
+from repoze.accelerator.serialize import dumps
+from repoze.accelerator.serialize import dumps_entry
+from repoze.accelerator.serialize import loads
+from repoze.accelerator.serialize import loads_entry
+from repoze.accelerator.storage import deadline
+from repoze.accelerator.storage import split_discriminators
+from repoze.accelerator.storage import with_content_length
+
+BLOCK_SIZE = 1 << 16
+
+# seconds after which 'purge' removes body and temporary files no
+# metadata file refers to, e.g. left behind by a handler never closed
+ORPHAN_GRACE = 3600.0
+
+class DiskStorage:
+    """ Keep cached responses in files under a directory.
+
+    o Each URL gets a directory, named by the hash of the URL, holding
+      a '.meta' file (headers and such) per variant, named by the hash
+      of its discriminators, the body files the metadata files point
+      to, and a '.names' file per set of discriminator names its
+      variants use.
+
+    o Entries survive restarts.  Bodies are fetched as 'FileBody'
+      objects, which the middleware hands to 'wsgi.file_wrapper'.
+      A Content-Length header is added if the application sent none.
+
+    o 'fetch_variant' resolves the request's values for each set of
+      discriminator names, and reads the metadata file they name, so
+      that a hit reads one metadata file and opens one body file however
+      many variants the URL has.
+
+    o The body file of each entry returned is opened before it is
+      returned, so that a body replaced or purged before it has been
+      read is still read whole (an open file survives being unlinked);
+      entries whose body file is already gone are skipped.
+
+    o 'purge' also removes the body, names and temporary files which no
+      metadata file refers to and which were last written more than
+      'orphan_grace' seconds ago.
+    """
+    implements(IVariantStorage)
+
+    def __init__(self, logger, path, orphan_grace=ORPHAN_GRACE):
+        self.logger = logger
+        self.path = path
+        self.orphan_grace = orphan_grace
+        _makedirs(path)
+
+    def store(self, url, discriminators, expires, status, headers, **extras):
+        directory = self._directory(url)
+        _makedirs(directory)
+        variant = _hash(dumps(tuple(discriminators)))
+        names = dumps(split_discriminators(discriminators)[0])
+        fd, body_path = tempfile.mkstemp(suffix='.body', dir=directory)
+        body_file = os.fdopen(fd, 'wb')
+        size = [0]
+
+        class DiskHandler:
+            implements(IChunkHandler)
+            def write(self, chunk):
+                body_file.write(chunk)
+                size[0] += len(chunk)
+
+            def close(self):
+                body_file.close()
+                meta = dumps_entry(
+                    discriminators, expires, status,
+                    with_content_length(headers, size[0]),
+                    dict(extras, body=os.path.basename(body_path),
+                         length=size[0], url=url))
+                names_path = os.path.join(directory, _hash(names) + '.names')
+                if not os.path.exists(names_path):
+                    _write_file(directory, names_path, names)
+                meta_path = os.path.join(directory, variant + '.meta')
+                old_body = _read_body_name(meta_path)
+                # readers see the old metadata and body, or the new ones
+                _write_file(directory, meta_path, meta)
+                if old_body is not None:
+                    _unlink(os.path.join(directory, old_body))
+
+        return DiskHandler()
+
+    def fetch(self, url):
+        directory = self._directory(url)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return None
+        L = []
+        for name in names:
+            if name.endswith('.meta'):
+                entry = self._entry(directory, name, url)
+                if entry is not None:
+                    L.append(entry)
+        return L or None
+
+    def fetch_variant(self, url, resolve):
+        directory = self._directory(url)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return None
+        for name in names:
+            if not name.endswith('.names'):
+                continue
+            discrim_names = _read_names(os.path.join(directory, name))
+            if discrim_names is None:
+                continue
+            discriminators = []
+            for typ, discrim_name in discrim_names:
+                value = resolve(typ, discrim_name)
+                if value is None:
+                    break
+                discriminators.append((typ, (discrim_name, value)))
+            else:
+                variant = _hash(dumps(tuple(discriminators)))
+                entry = self._entry(directory, variant + '.meta', url)
+                if entry is not None:
+                    return entry
+
+    def _entry(self, directory, name, url):
+        # Return the entry in the metadata file 'name', with its body
+        # file open, or None.
+        entry = _read_meta(os.path.join(directory, name))
+        if entry is None:
+            return None
+        discriminators, expires, status, headers, extras = entry
+        if extras.get('url') != url: #pragma NO COVER hash collision
+            return None
+        body_path = os.path.join(directory, extras['body'])
+        try:
+            body_file = open(body_path, 'rb')
+        except IOError:
+            return None # replaced or purged meanwhile
+        body = FileBody(body_path, extras['length'], file=body_file)
+        return discriminators, expires, status, headers, body, extras
+
+    def purge(self, now=None):
+        """ Remove entries which expired before 'now' (by default, the
+        current time), and orphaned files older than 'orphan_grace'.
+
+        o Return a tuple, '(entries, bytes)', reporting what was purged.
+        """
+        if now is None:
+            now = time.time()
+        count = size = orphans = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            referenced = set()
+            for name in filenames:
+                if not name.endswith('.meta'):
+                    continue
+                meta_path = os.path.join(dirpath, name)
+                entry = _read_meta(meta_path)
+                if entry is None:
+                    continue
+                discriminators, expires, status, headers, extras = entry
+                if deadline(expires, extras) > now:
+                    referenced.add(extras['body'])
+                    referenced.add(_hash(dumps(
+                        split_discriminators(discriminators)[0])) + '.names')
+                    continue
+                _unlink(meta_path)
+                _unlink(os.path.join(dirpath, extras['body']))
+                count += 1
+                size += extras['length']
+            for name in filenames:
+                if (name in referenced or
+                    not name.endswith(('.body', '.names', '.tmp'))):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue # removed meanwhile
+                if mtime <= now - self.orphan_grace:
+                    _unlink(path)
+                    orphans += 1
+        logger = self.logger
+        if count:
+            logger and logger.info(
+                'repoze.accelerator: purged %d entries (%d bytes)',
+                count, size)
+        if orphans:
+            logger and logger.info(
+                'repoze.accelerator: removed %d orphaned files', orphans)
+        return count, size
+
+    def _directory(self, url):
+        digest = _hash(url)
+        return os.path.join(self.path, digest[:2], digest)
+
+class FileBody:
+    """ A cached body, read from its file in blocks.
+
+    o Unless an open 'file' is passed, the file is opened on first use,
+      and closed when the body has been read or 'close' is called.
+
+    o A 'file' passed in is kept open until 'close' is called (or the
+      body is garbage collected), so that every range read comes from
+      the same file, even if 'path' is replaced or removed meanwhile.
+
+    o 'read' and 'fileno' allow servers to send the file directly via
+      'wsgi.file_wrapper'.
+    """
+    def __init__(self, path, length, block_size=BLOCK_SIZE, file=None):
+        self.path = path
+        self.length = length
+        self.block_size = block_size
+        self._file = file
+        self._keep_open = file is not None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file
+
+    def read(self, size=-1):
+        return self._open().read(size)
+
+    def fileno(self):
+        return self._open().fileno()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __iter__(self):
+        return self.iter_range(0, self.length)
+
+    def iter_range(self, start, stop):
+        """ Yield the bytes in '[start, stop)' of the body, in blocks.
+        """
+        f = self._open()
+        f.seek(start)
+        remaining = stop - start
+        try:
+            while remaining > 0:
+                block = f.read(min(self.block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+        finally:
+            if not self._keep_open:
+                self.close()
+
+def _hash(data):
+    return sha1(data).hexdigest()
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _read_meta(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None # removed meanwhile
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        return loads_entry(data)
+    except ValueError:
+        return None # written by an incompatible version
+
+def _read_names(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None # removed meanwhile
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        return loads(data)
+    except ValueError: #pragma NO COVER torn or foreign file
+        return None
+
+def _write_file(directory, path, data):
+    # Write 'data' to 'path' atomically, via a temporary file.
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def _read_body_name(meta_path):
+    entry = _read_meta(meta_path)
+    if entry is not None:
+        return entry[4]['body']
+
+def make_disk_storage(logger, config):
+    path = config.get('storage.path')
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), 'repoze.accelerator')
+    orphan_grace = float(config.get('storage.orphan_grace', ORPHAN_GRACE))
+    return DiskStorage(logger, os.path.abspath(os.path.normpath(path)),
+                       orphan_grace)
+directlyProvides(make_disk_storage, IStorageFactory)
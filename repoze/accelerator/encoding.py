@@ -0,0 +1,238 @@
+import zlib
+
+from zope.interface import implements
+
+from repoze.accelerator.interfaces import IChunkHandler
+
+try:
+    import brotli
+except ImportError: #pragma NO COVER optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError: #pragma NO COVER optional
+    zstandard = None
+
+# media types (and structured syntax suffixes) worth compressing
+COMPRESSIBLE_TYPES = ('text/',
+                      'application/json',
+                      'application/javascript',
+                      'application/x-javascript',
+                      'application/xml',
+                      'application/xhtml+xml',
+                      'application/rss+xml',
+                      'application/atom+xml',
+                      'image/svg+xml')
+
+COMPRESSIBLE_SUFFIXES = ('+json', '+xml')
+
+def _gzip_encoder():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+class _BrotliEncoder:
+    def __init__(self):
+        self.compressor = brotli.Compressor()
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+def _zstd_encoder():
+    return zstandard.ZstdCompressor().compressobj()
+
+# content-coding -> factory of objects with 'compress' and 'flush'
+# methods, as returned by 'zlib.compressobj'
+ENCODERS = {'gzip': _gzip_encoder}
+if brotli is not None: #pragma NO COVER optional
+    ENCODERS['br'] = _BrotliEncoder
+if zstandard is not None: #pragma NO COVER optional
+    ENCODERS['zstd'] = _zstd_encoder
+
+def compress(name, data):
+    """ Return 'data' encoded with the content-coding 'name'.
+    """
+    encoder = ENCODERS[name]()
+    return encoder.compress(data) + encoder.flush()
+
+def compressible(headers, min_size=0):
+    """ Return True if the body of a response with 'headers' is worth
+    compressing:  it isn't encoded already, its media type is textual,
+    it doesn't forbid transformation, and its Content-Length (if any)
+    is at least 'min_size'.
+    """
+    content_type = None
+    for name, value in headers:
+        name = name.lower()
+        if name == 'content-encoding':
+            if value.strip().lower() != 'identity':
+                return False
+        elif name == 'cache-control':
+            if 'no-transform' in value.lower():
+                return False
+        elif name == 'content-type':
+            content_type = value.split(';', 1)[0].strip().lower()
+        elif name == 'content-length':
+            try:
+                if int(value) < min_size:
+                    return False
+            except ValueError:
+                return False
+        elif name == 'content-range':
+            return False
+    if content_type is None:
+        return False
+    for prefix in COMPRESSIBLE_TYPES:
+        if content_type.startswith(prefix):
+            return True
+    for suffix in COMPRESSIBLE_SUFFIXES:
+        if content_type.endswith(suffix):
+            return True
+    return False
+
+def parse_accept_encoding(header):
+    """ Return a dict mapping the (lowercased) content-codings named in
+    an Accept-Encoding header value to their quality values.
+    """
+    codings = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+def negotiate(header, available):
+    """ Return the content-coding out of 'available' (in order of our
+    preference) which the Accept-Encoding header value 'header' asks
+    for, or None if the identity coding should be used.
+    """
+    if not header or not available:
+        return None
+    codings = parse_accept_encoding(header)
+    default = codings.get('*', 0.0)
+    best, best_q = None, 0.0
+    for name in available:
+        q = codings.get(name, default)
+        if q > best_q:
+            best, best_q = name, q
+    if best is not None and codings.get('identity', 0.0) > best_q:
+        return None
+    return best
+
+def add_vary(headers, name):
+    """ Return 'headers', with 'name' added to their Vary header unless
+    it names it (or '*') already.
+    """
+    lname = name.lower()
+    L = []
+    found = False
+    for hname, value in headers:
+        if hname.lower() == 'vary':
+            names = [ x.strip().lower() for x in value.split(',') ]
+            if lname not in names and '*' not in names:
+                value = '%s, %s' % (value, name)
+            found = True
+        L.append((hname, value))
+    if not found:
+        L.append(('Vary', name))
+    return L
+
+def encoded_etag(etag, name):
+    """ Return the entity tag of the representation encoded with 'name'
+    of an entry whose tag is 'etag'.
+    """
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], name)
+    return etag
+
+def encode_response(headers, body, encodings, accept_encoding, preferred):
+    """ Return '(headers, body)' for the representation of a cached
+    response best matching the Accept-Encoding value 'accept_encoding'.
+
+    o 'encodings' maps content-codings to the response's body encoded
+      with them;  those also in 'preferred' are chosen from, in that
+      order.
+
+    o The headers always vary on Accept-Encoding.  Those of an encoded
+      representation have its Content-Encoding and Content-Length, and
+      its own entity tag.
+    """
+    headers = add_vary(headers, 'Accept-Encoding')
+    name = negotiate(accept_encoding,
+                     [ x for x in preferred if x in encodings ])
+    if name is None:
+        return headers, body
+    data = encodings[name]
+    L = []
+    for hname, value in headers:
+        lname = hname.lower()
+        if lname == 'content-length':
+            continue
+        if lname == 'etag':
+            value = encoded_etag(value, name)
+        L.append((hname, value))
+    L.append(('Content-Encoding', name))
+    L.append(('Content-Length', str(len(data))))
+    return L, [data]
+
+class EncodingHandler:
+    """ Wrap the IChunkHandler storing a response, compressing its body
+    with each of the content-codings 'names' as it is written.
+
+    o When closed, the encodings of bodies of at least 'min_size' bytes
+      which turned out smaller than the body are put in the dict
+      'encodings' (passed to the storage as an extra), before the
+      wrapped handler is closed.
+
+    o Once the wrapped handler's 'discarding' attribute is true (e.g.
+      because the body is too large to store), nothing more is
+      compressed.  It is also this handler's 'discarding' attribute.
+    """
+    implements(IChunkHandler)
+
+    def __init__(self, handler, encodings, names, min_size=0):
+        self.handler = handler
+        self.encodings = encodings
+        self.min_size = min_size
+        self.length = 0
+        self.encoders = [ (name, ENCODERS[name](), []) for name in names ]
+
+    def write(self, chunk):
+        handler = self.handler
+        handler.write(chunk)
+        if getattr(handler, 'discarding', False):
+            self.encoders = []
+            return
+        self.length += len(chunk)
+        for name, encoder, chunks in self.encoders:
+            data = encoder.compress(chunk)
+            if data:
+                chunks.append(data)
+
+    def close(self):
+        length = self.length
+        if length and length >= self.min_size:
+            for name, encoder, chunks in self.encoders:
+                chunks.append(encoder.flush())
+                data = ''.join(chunks)
+                if len(data) < length:
+                    self.encodings[name] = data
+        self.encoders = []
+        self.handler.close()
+
+    def _discarding(self):
+        return getattr(self.handler, 'discarding', False)
+
+    discarding = property(_discarding)
@@ -44,6 +44,20 @@ class IPolicy(Interface):
           be used to store the response body after writing it.
         """
 
+class ICoalescingPolicy(IPolicy):
+    """ Optional API of policies which allow concurrent misses to be
+    collapsed into a single request to the application.
+    """
+    def coalesce_key(environ):
+        """ Return a hashable key naming the cache entry which would
+        be used to serve the request described by 'environ'.
+
+        o Requests with the same key which miss at the same time wait
+          for the first of them to be rendered and stored.
+
+        o Return None if the request could never be served from cache.
+        """
+
 class IPolicyFactory(Interface):
     """ Required API of the entry point which creates a policy plugin.
     """
@@ -86,10 +100,39 @@ class IStorage(Interface):
         
         o 'status', 'headers', and **extras should be saved as well.
 
+        o If **extras includes 'stale_until', a UNIX timestamp later
+          than 'expires', the policy may still serve the entry until
+          then, and the storage should not discard it as expired.
+
         o Return an object implementing IChunkHandler, which will
           be used to cache the response body chunks.
         """
 
+class IVariantStorage(IStorage):
+    """ Optional API of storages which can pick the variant of a URL
+    matching a request themselves.
+    """
+    def fetch_variant(url, resolve):
+        """ Return the entry for 'url' whose discriminators all match
+        the request, in the form returned by 'fetch', or None.
+
+        o 'resolve' is a callable taking a discriminator's type and name
+          (e.g. 'vary' and 'accept-language', or 'env' and 'REMOTE_USER')
+          and returning the request's value for it, or None.
+        """
+
+class IStatsStorage(IStorage):
+    """ Optional API of storages which report statistics about their
+    contents.
+    """
+    def stats():
+        """ Return a dict mapping names (e.g. 'storage_entries' and
+        'storage_bytes') to the current values of the storage's counters
+        and gauges.
+
+        o It is called when metrics are read, not on each request.
+        """
+
 class IStorageFactory(Interface):
     """ Required API of the entry point which creates a storage plugin.
     """
@@ -102,3 +145,35 @@ class IStorageFactory(Interface):
           used to configure the plugin.  By convention, the keys which
           are relevant to the plugin start with 'storage.'.
         """
+
+class IPhaseHook(Interface):
+    """ Optional API of plugins which receive the timings of the phases
+    of sampled requests.
+    """
+    def begin(environ):
+        """ Called as a sampled request starts.
+        """
+
+    def end(environ, phases):
+        """ Called as a sampled request ends (for a miss, once its body
+        has been sent).
+
+        o 'phases' is a sequence of '(name, start, end)' tuples, in the
+          order the phases ended (e.g. 'construct_url' and
+          'storage.fetch' within 'policy.fetch'), and ending with
+          'request', which spans them all.  Timestamps come from
+          'repoze.accelerator.phases.clock'.
+        """
+
+class IPhaseHookFactory(Interface):
+    """ Required API of the entry point which creates a phase hook.
+    """
+    def __call__(logger, config):
+        """ Return a new phase hook.
+
+        o 'logger' will be a PEP 282 logger instance or None.
+
+        o 'config', if passed, will be a dictionary whose values may be
+          used to configure the hook.  By convention, the keys which
+          are relevant to the hook start with 'phase_hook.'.
+        """
@@ -1,15 +1,71 @@
+import logging
+import Queue
+import threading
+
 from zope.interface import directlyProvides
 from repoze.accelerator.interfaces import ILoggerFactory
 
+class QueueHandler(logging.Handler):
+    """ Pass records to the handler 'target' from a background thread,
+    so that logging never waits for the log to be written.
+
+    o At most 'queue_size' records wait to be written;  further ones
+      are dropped, and counted in 'dropped'.
+
+    o Messages are formatted by the background thread, except for the
+      tracebacks of exceptions being handled, which can't wait.
+    """
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def emit(self, record):
+        # (called with the handler's lock held)
+        if record.exc_info:
+            self.target.format(record) # caches 'exc_text'
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ Write the records waiting, then stop the background thread
+        and close the target.
+        """
+        if self.thread.isAlive():
+            try:
+                self.queue.put(None, timeout=5)
+            except Queue.Full: #pragma NO COVER
+                pass
+            self.thread.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+    def _drain(self):
+        get = self.queue.get
+        while True:
+            record = get()
+            if record is None:
+                break
+            try:
+                self.target.handle(record)
+            except: #pragma NO COVER
+                self.handleError(record)
+
 def make_logger(config):
     import os
     import sys
-    import logging
 
     if os.environ.get('ACCELERATOR_LOG'):
         log_stream = sys.stdout
         log_level = logging.DEBUG
-        
+
     else:
         log_file = config.get('logger.filename', '')
         if not log_file or log_file.lower() == 'none':
@@ -28,6 +84,9 @@ def make_logger(config):
     fmt = '%(asctime)s %(message)s'
     formatter = logging.Formatter(fmt)
     handler.setFormatter(formatter)
+    queue_size = int(config.get('logger.queue_size', 0))
+    if queue_size:
+        handler = QueueHandler(handler, queue_size)
     logger = logging.Logger('repoze.accelerator')
     logger.addHandler(handler)
     logger.setLevel(log_level)
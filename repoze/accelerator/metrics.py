@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+
+# the environment key under which the middleware passes its Metrics to
+# the policy
+METRICS_KEY = 'repoze.accelerator.metrics'
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = 'repoze_accelerator_'
+
+class Metrics(object):
+    """ A registry of counters and fixed-bucket histograms.
+
+    o Names may carry Prometheus-style labels, e.g.
+      'bypasses{reason="method"}'.
+
+    o Each thread updates counters of its own, without locking;  they
+      are summed when read.  The counters of threads which have ended
+      are folded together.
+
+    o 'collectors' is a list of callables returning dicts of further
+      values (e.g. a storage's 'stats'), read along with the rest.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.collectors = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # [(thread, counters, histograms)]
+        self._shards = []
+        self._retired = ({}, {})
+
+    # 'incr' and 'observe' are on the request path:  they look up this
+    # thread's counters inline, and only call out the first time.
+
+    def incr(self, name, value=1):
+        """ Add 'value' to the counter 'name'.
+        """
+        try:
+            counters = self._local.counters
+        except AttributeError:
+            counters = self._register().counters
+        counters[name] += value
+
+    def observe(self, name, value):
+        """ Count 'value' (e.g. a latency in seconds) in the histogram
+        'name'.
+        """
+        try:
+            histogram = self._local.histograms[name]
+        except (AttributeError, KeyError):
+            histogram = self._register().histograms.setdefault(
+                # a count per bucket, one for the values above them all,
+                # and the sum of the values
+                name, [0] * (len(self.buckets) + 1) + [0.0])
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def _register(self):
+        # Return this thread's counters, creating them the first time.
+        local = self._local
+        if not hasattr(local, 'counters'):
+            local.counters = defaultdict(int)
+            local.histograms = {}
+            self._lock.acquire()
+            try:
+                self._retire()
+                self._shards.append((threading.currentThread(),
+                                     local.counters, local.histograms))
+            finally:
+                self._lock.release()
+        return local
+
+    def counters(self):
+        """ Return a dict mapping counter names to their totals.
+        """
+        totals = {}
+        for counters, histograms in self._all():
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def histograms(self):
+        """ Return a dict mapping histogram names to '(counts, sum)',
+        where 'counts' holds the number of values in each bucket, then
+        of those above the last bucket.
+        """
+        totals = {}
+        for counters, histograms in self._all():
+            for name, histogram in histograms.items():
+                histogram = list(histogram)
+                total = totals.get(name)
+                if total is None:
+                    totals[name] = histogram
+                else:
+                    for i in range(len(histogram)):
+                        total[i] += histogram[i]
+        return dict([ (name, (histogram[:-1], histogram[-1]))
+                      for name, histogram in totals.items() ])
+
+    def gauges(self):
+        """ Return the values of the 'collectors', merged.
+        """
+        values = {}
+        for collector in self.collectors:
+            values.update(collector())
+        return values
+
+    def render(self):
+        """ Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+        def declare(kind, name):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+        def add(kind, name, labels, value):
+            declare(kind, name)
+            lines.append('%s%s %s' % (name, labels, _number(value)))
+
+        for key, value in sorted(self.counters().items()):
+            name, labels = _split(key)
+            add('counter', PREFIX + name + '_total', labels, value)
+
+        for key, (counts, total) in sorted(self.histograms().items()):
+            name, labels = _split(key)
+            name = PREFIX + name
+            inner = labels[1:-1]
+            declare('histogram', name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append('%s_bucket{%s} %d' % (
+                    name, ','.join(filter(None, [inner, le])), cumulative))
+            lines.append('%s_sum%s %s' % (name, labels, _number(total)))
+            lines.append('%s_count%s %d' % (name, labels, cumulative))
+
+        for key, value in sorted(self.gauges().items()):
+            name, labels = _split(key)
+            add('gauge', PREFIX + name, labels, value)
+
+        return '\n'.join(lines) + '\n'
+
+    def _all(self):
+        # Return the '(counters, histograms)' of every thread.
+        self._lock.acquire()
+        try:
+            self._retire()
+            return [self._retired] + [ (counters, histograms)
+                                       for thread, counters, histograms
+                                       in self._shards ]
+        finally:
+            self._lock.release()
+
+    def _retire(self):
+        # Called with the lock held:  fold the counters of threads
+        # which have ended into '_retired'.
+        live = []
+        retired_counters, retired_histograms = self._retired
+        for shard in self._shards:
+            thread, counters, histograms = shard
+            if thread.isAlive():
+                live.append(shard)
+                continue
+            for name, value in counters.items():
+                retired_counters[name] = retired_counters.get(name, 0) + value
+            for name, histogram in histograms.items():
+                total = retired_histograms.get(name)
+                if total is None:
+                    retired_histograms[name] = list(histogram)
+                else:
+                    for i in range(len(histogram)):
+                        total[i] += histogram[i]
+        self._shards = live
+
+def incr(environ, name, value=1):
+    """ Add 'value' to the counter 'name' of the Metrics passed in
+    'environ' by the middleware, if any.
+    """
+    metrics = environ.get(METRICS_KEY)
+    if metrics is not None:
+        metrics.incr(name, value)
+
+def _split(key):
+    # 'name{labels}' -> ('name', '{labels}')
+    brace = key.find('{')
+    if brace < 0:
+        return key, ''
+    return key[:brace], key[brace:]
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -1,56 +1,371 @@
 import itertools
+import Queue
+from StringIO import StringIO
+import threading
+import time
+
+from repoze.accelerator.interfaces import ICoalescingPolicy
+from repoze.accelerator.interfaces import IStatsStorage
+from repoze.accelerator.metrics import METRICS_KEY
+from repoze.accelerator.metrics import Metrics
+from repoze.accelerator.phases import PHASES_KEY
+from repoze.accelerator.phases import Phases
+from repoze.accelerator.phases import TimedHandler
+
+# block size passed to 'wsgi.file_wrapper'
+BLOCK_SIZE = 1 << 16
+
+# request headers which must not be replayed when refreshing an entry
+UNREPLAYABLE = ('HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_NONE_MATCH',
+                'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE', 'HTTP_IF_RANGE',
+                'HTTP_RANGE', 'repoze.accelerator.stale')
 
 class Accelerator:
-    def __init__(self, app, policy, logger):
+    def __init__(self, app, policy, logger, coalesce_timeout=None,
+                 refresher=None, metrics=None, stats_path=None,
+                 phase_hook=None, phase_sample=1):
         self.app = app
         self.policy = policy
         self.logger = logger
+        # if set, concurrent misses for the same cache key wait up to
+        # this many seconds for the first of them to be stored
+        self.coalesce_timeout = coalesce_timeout
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        if refresher is None:
+            refresher = Refresher(logger)
+        self.refresher = refresher
+        # counters and latency histograms, also passed to the policy
+        if metrics is None:
+            metrics = Metrics()
+            storage = getattr(policy, 'storage', None)
+            if IStatsStorage.providedBy(storage):
+                metrics.collectors.append(storage.stats)
+        self.metrics = metrics
+        # if set, requests for this path get the metrics as text
+        self.stats_path = stats_path
+        # if set, an IPhaseHook receiving the phase timings of one
+        # request in 'phase_sample'
+        self.phase_hook = phase_hook
+        self.phase_sample = phase_sample
+        self._requests = itertools.count()
 
     def __call__(self, environ, start_response):
-        logger = self.logger
+        started = time.time()
+        if (self.stats_path is not None and
+            environ.get('PATH_INFO') == self.stats_path):
+            return self._stats(environ, start_response)
+
+        metrics = environ[METRICS_KEY] = self.metrics
+        if (self.phase_hook is not None and
+            not self._requests.next() % self.phase_sample):
+            return self._sampled(environ, start_response, started)
 
         result = self.policy.fetch(environ)
 
         if result is not None:
-            logger and logger.info(
-                'repoze.accelerator: HIT %s' % environ['PATH_INFO'])
-            status, headers, content = result
-            headers = list(headers) + [('X-Cached-By', 'repoze.accelerator')]
-            start_response(status, headers)
-            for chunk in content:
+            content = self._hit(environ, start_response, result,
+                                environ.get('wsgi.file_wrapper'))
+            # unlike 'miss_seconds', excludes sending the body, which
+            # the server does once we return
+            metrics.observe('hit_seconds', time.time() - started)
+            return content
+
+        return self._miss(environ, start_response, started)
+
+    def _sampled(self, environ, start_response, started):
+        # As '__call__', recording the phases of the request for the
+        # phase hook.
+        hook = self.phase_hook
+        phases = environ[PHASES_KEY] = Phases()
+        hook.begin(environ)
+        try:
+            result = phases.timing('policy.fetch', self.policy.fetch)(
+                environ)
+            if result is not None:
+                content = phases.timing('hit', self._hit)(
+                    environ, start_response, result,
+                    environ.get('wsgi.file_wrapper'))
+                self.metrics.observe('hit_seconds', time.time() - started)
+                self._end_phases(environ, phases)
+                return content
+        except:
+            self._end_phases(environ, phases)
+            raise
+        return self._phased_body(
+            self._miss(environ, start_response, started, phases),
+            environ, phases)
+
+    def _phased_body(self, body, environ, phases):
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            body.close()
+            self._end_phases(environ, phases)
+
+    def _end_phases(self, environ, phases):
+        phases.add('request', phases.start)
+        self.phase_hook.end(environ, phases)
+
+    def _hit(self, environ, start_response, result, file_wrapper=None):
+        logger = self.logger
+        logger and logger.info('repoze.accelerator: HIT %s',
+                               environ['PATH_INFO'])
+        stale = environ.get('repoze.accelerator.stale')
+        if stale is not None:
+            self.refresher.submit(stale, self._refresh,
+                                  self._refresh_environ(environ))
+        status, headers, content = result
+        metrics = self.metrics
+        metrics.incr('hits')
+        length = getattr(content, 'length', None)
+        if length is None:
+            length = _content_length(content, headers)
+        metrics.incr('hit_bytes', length)
+        headers = list(headers) + [('X-Cached-By', 'repoze.accelerator')]
+        start_response(status, headers)
+        if file_wrapper is not None and hasattr(content, 'fileno'):
+            # let the server send the file itself, e.g. via sendfile
+            return file_wrapper(content, BLOCK_SIZE)
+        return content
+
+    def _miss(self, environ, start_response, started=None, phases=None):
+        logger = self.logger
+        metrics = self.metrics
+        app = self.app
+        store = self.policy.store
+        if phases is not None:
+            app = phases.timing('app', app)
+            store = phases.timing('policy.store', store)
+
+        key = None
+        if self.coalesce_timeout:
+            if ICoalescingPolicy.providedBy(self.policy):
+                key = self.policy.coalesce_key(environ)
+            if key is not None:
+                event = self._join(key)
+                if event is not None:
+                    # someone else is already rendering this entry
+                    key = None
+                    logger and logger.info('repoze.accelerator: WAIT %s',
+                                           environ['PATH_INFO'])
+                    event.wait(self.coalesce_timeout)
+                    if event.isSet():
+                        result = self.policy.fetch(environ)
+                        if result is not None:
+                            content = self._hit(environ, start_response,
+                                                result)
+                            try:
+                                for chunk in content:
+                                    yield chunk
+                            finally:
+                                if hasattr(content, 'close'):
+                                    content.close()
+                            raise StopIteration
+
+        logger and logger.info('repoze.accelerator: MISS %s',
+                               environ['PATH_INFO'])
+        metrics.incr('misses')
+
+        try:
+            catch_response = []
+            written = []
+
+            def replace_start_response(status, headers, exc_info=None):
+                catch_response[:] = [status, headers, exc_info]
+                return written.append
+
+            app_iter = app(environ, replace_start_response)
+
+            if catch_response:
+                start_response(*catch_response)
+                status, headers, exc_info = catch_response
+            else:
+                raise RuntimeError('start_response not called')
+
+            handler = store(status, headers, environ)
+            if handler is not None and phases is not None:
+                handler = TimedHandler(handler, phases)
+
+            if handler is None and key is not None:
+                # nothing will be stored;  don't keep the waiters waiting
+                self._release(key)
+                key = None
+
+            chunks = itertools.chain(written, app_iter)
+
+            for chunk in chunks:
                 yield chunk
-            raise StopIteration
+                if handler is not None:
+                    handler.write(chunk)
 
-        logger and logger.info(
-            'repoze.accelerator: MISS %s' % environ['PATH_INFO'])
+            if handler is not None:
+                handler.close()
+                if not getattr(handler, 'discarding', False):
+                    # (the storage may have dropped the body as too large)
+                    metrics.incr('stores')
+
+            if started is not None:
+                metrics.observe('miss_seconds', time.time() - started)
+
+        finally:
+            if key is not None:
+                self._release(key)
+
+        raise StopIteration
+
+    def _stats(self, environ, start_response):
+        body = self.metrics.render()
+        start_response('200 OK',
+                       [('Content-Type', 'text/plain; version=0.0.4'),
+                        ('Content-Length', str(len(body))),
+                        ('Cache-Control', 'no-cache')])
+        return [body]
+
+    def _refresh_environ(self, environ):
+        environ = environ.copy()
+        for key in UNREPLAYABLE:
+            environ.pop(key, None)
+        environ['wsgi.input'] = StringIO()
+        environ['CONTENT_LENGTH'] = '0'
+        return environ
+
+    def _refresh(self, environ):
+        """ Render the response for 'environ' in the background, and
+        store it if the policy allows.
+        """
+        logger = self.logger
+        logger and logger.info('repoze.accelerator: REFRESH %s',
+                               environ['PATH_INFO'])
+        self.metrics.incr('refreshes')
         catch_response = []
         written = []
 
         def replace_start_response(status, headers, exc_info=None):
-            catch_response[:] = [status, headers, exc_info]
+            catch_response[:] = [status, headers]
             return written.append
 
         app_iter = self.app(environ, replace_start_response)
+        try:
+            chunks = itertools.chain(written, app_iter)
+            chunk = None
+            for chunk in chunks:
+                break
+            if not catch_response:
+                raise RuntimeError('start_response not called')
+            status, headers = catch_response
+            handler = self.policy.store(status, headers, environ)
+            if handler is not None:
+                if chunk is not None:
+                    handler.write(chunk)
+                for chunk in chunks:
+                    handler.write(chunk)
+                handler.close()
+                if not getattr(handler, 'discarding', False):
+                    self.metrics.incr('stores')
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
 
-        if catch_response:
-            start_response(*catch_response)
-            status, headers, exc_info = catch_response
-        else:
-            raise RuntimeError('start_response not called')
+    def _join(self, key):
+        """ Register interest in rendering 'key'.
 
-        handler = self.policy.store(status, headers, environ)
+        o Return None if we are the first, and must render it.
 
-        chunks = itertools.chain(written, app_iter)
+        o Otherwise, return an event which will be set when the current
+          renderer is done.
+        """
+        self.inflight_lock.acquire()
+        try:
+            event = self.inflight.get(key)
+            if event is None:
+                self.inflight[key] = threading.Event()
+            return event
+        finally:
+            self.inflight_lock.release()
 
-        for chunk in chunks:
-            yield chunk
-            if handler is not None:
-                handler.write(chunk)
+    def _release(self, key):
+        self.inflight_lock.acquire()
+        try:
+            event = self.inflight.pop(key, None)
+        finally:
+            self.inflight_lock.release()
+        if event is not None:
+            event.set()
 
-        if handler is not None:
-            handler.close()
+class Refresher:
+    """ A bounded pool of threads which refresh stale entries.
 
-        raise StopIteration
+    o At most 'workers' refreshes run at once, and at most
+      'max_pending' wait to be run;  further ones are dropped.
+
+    o Only one refresh for a given key is pending or running at a time.
+    """
+    def __init__(self, logger, workers=2, max_pending=100):
+        self.logger = logger
+        self.workers = workers
+        self.queue = Queue.Queue(max_pending)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, key, func, *args):
+        """ Arrange for 'func(*args)' to be called in a worker thread.
+
+        o Return False if a refresh for 'key' is already pending, or if
+          the queue is full;  otherwise return True.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+        try:
+            self.queue.put_nowait((key, func, args))
+        except Queue.Full:
+            self._done(key)
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            key, func, args = self.queue.get()
+            try:
+                try:
+                    func(*args)
+                except:
+                    logger = self.logger
+                    logger and logger.exception(
+                        'repoze.accelerator: refresh of %r failed', key)
+            finally:
+                self._done(key)
+
+    def _done(self, key):
+        self.lock.acquire()
+        try:
+            self.pending.discard(key)
+        finally:
+            self.lock.release()
+
+def _content_length(content, headers):
+    # the length of a body which doesn't know it (see 'MemoryBody')
+    if isinstance(content, list):
+        return sum([ len(chunk) for chunk in content ])
+    for name, value in headers:
+        if name.lower() == 'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                break
+    return 0
 
 def _resolveEntryPoint(name):
     from pkg_resources import EntryPoint
@@ -60,6 +375,7 @@ def main(app, global_conf, **local_conf):
     from repoze.accelerator.storage import make_memory_storage
     from repoze.accelerator.policy import make_accelerator_policy
     from repoze.accelerator.logger import make_logger
+    from repoze.accelerator.phases import make_phase_profiler
 
     logger_factory = local_conf.get('logger', make_logger)
     if isinstance(logger_factory, basestring):
@@ -76,5 +392,25 @@ def main(app, global_conf, **local_conf):
         policy_factory = _resolveEntryPoint(policy_factory)
     policy = policy_factory(logger, storage, local_conf)
 
-    return Accelerator(app, policy, logger)
+    coalesce_timeout = float(local_conf.get('coalesce_timeout', 0)) or None
+
+    refresher = Refresher(
+        logger,
+        int(local_conf.get('refresh_workers', 2)),
+        int(local_conf.get('refresh_max_pending', 100)),
+        )
+
+    stats_path = local_conf.get('stats_path') or None
+
+    phase_sample = int(local_conf.get('phase_sample', 0))
+    phase_hook = None
+    if phase_sample:
+        hook_factory = local_conf.get('phase_hook', make_phase_profiler)
+        if isinstance(hook_factory, basestring):
+            hook_factory = _resolveEntryPoint(hook_factory)
+        phase_hook = hook_factory(logger, local_conf)
+
+    return Accelerator(app, policy, logger, coalesce_timeout, refresher,
+                       stats_path=stats_path, phase_hook=phase_hook,
+                       phase_sample=phase_sample or 1)
 
@@ -0,0 +1,176 @@
+import atexit
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+from zope.interface import implements
+from zope.interface import directlyProvides
+
+from repoze.accelerator.interfaces import IPhaseHook
+from repoze.accelerator.interfaces import IPhaseHookFactory
+
+# the environment key under which the middleware passes the 'Phases' of
+# a sampled request to the policy
+PHASES_KEY = 'repoze.accelerator.phases'
+
+# the environment key under which 'PhaseProfiler' keeps a request's
+# profile
+PROFILE_KEY = 'repoze.accelerator.profile'
+
+# Python 2's standard library has no monotonic clock;  use it where
+# there is one
+clock = getattr(time, 'monotonic', time.time)
+
+class Phases(list):
+    """ The '(name, start, end)' timings of the phases of a request, in
+    the order they ended;  'start' is when the request started.
+    """
+    def __init__(self):
+        list.__init__(self)
+        self.start = clock()
+
+    def add(self, name, start):
+        """ Record the phase 'name' as lasting from 'start' until now, and
+        return now.
+        """
+        end = clock()
+        self.append((name, start, end))
+        return end
+
+    def timing(self, name, func):
+        """ Return a callable which calls 'func', recording the time it
+        takes as the phase 'name'.
+        """
+        def timed(*arg, **kw):
+            start = clock()
+            try:
+                return func(*arg, **kw)
+            finally:
+                self.add(name, start)
+        return timed
+
+class TimedHandler(object):
+    """ A chunk handler recording the time spent in the 'write' and
+    'close' methods of 'handler', whose 'discarding' attribute (if any)
+    it shares.
+    """
+    def __init__(self, handler, phases):
+        self.handler = handler
+        self.write = phases.timing('handler.write', handler.write)
+        self.close = phases.timing('handler.close', handler.close)
+
+    def _discarding(self):
+        return getattr(self.handler, 'discarding', False)
+
+    discarding = property(_discarding)
+
+class PhaseProfiler(object):
+    """ Sum the time spent in each phase of sampled requests.
+
+    o 'timings' returns the number, total and longest duration of each
+      phase.
+
+    o If 'profile_path' is set, sampled requests are also run under
+      cProfile, and their combined statistics are written to it (to be
+      read with 'pstats') every 'dump_every' samples.
+    """
+    implements(IPhaseHook)
+
+    def __init__(self, logger=None, profile_path=None, dump_every=100):
+        self.logger = logger
+        self.profile_path = profile_path
+        self.dump_every = dump_every
+        self.samples = 0
+        self._timings = {}
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def begin(self, environ):
+        if self.profile_path is not None:
+            profile = environ[PROFILE_KEY] = cProfile.Profile()
+            profile.enable()
+
+    def end(self, environ, phases):
+        profile = environ.pop(PROFILE_KEY, None)
+        if profile is not None:
+            profile.disable()
+        dump = False
+        self._lock.acquire()
+        try:
+            self.samples += 1
+            timings = self._timings
+            for name, start, end in phases:
+                elapsed = end - start
+                timing = timings.get(name)
+                if timing is None:
+                    timings[name] = [1, elapsed, elapsed]
+                else:
+                    timing[0] += 1
+                    timing[1] += elapsed
+                    if elapsed > timing[2]:
+                        timing[2] = elapsed
+            if profile is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                dump = self.dump_every and not self.samples % self.dump_every
+        finally:
+            self._lock.release()
+        if dump:
+            self.dump()
+
+    def timings(self):
+        """ Return a dict mapping phase names to '(count, seconds,
+        longest)'.
+        """
+        self._lock.acquire()
+        try:
+            return dict([ (name, tuple(timing))
+                          for name, timing in self._timings.items() ])
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """ Return the timings as a table, longest total first.
+        """
+        lines = ['%-16s %8s %12s %12s %12s' % (
+            'phase', 'count', 'total ms', 'mean usec', 'max usec')]
+        timings = self.timings().items()
+        timings.sort(key=lambda item: -item[1][1])
+        for name, (count, seconds, longest) in timings:
+            lines.append('%-16s %8d %12.3f %12.1f %12.1f' % (
+                name, count, seconds * 1e3, seconds / count * 1e6,
+                longest * 1e6))
+        return '\n'.join(lines)
+
+    def dump(self, path=None):
+        """ Write the combined profile of the requests sampled so far to
+        'path' (by default, 'profile_path'), and log the timings.
+        """
+        if path is None:
+            path = self.profile_path
+        self._lock.acquire()
+        try:
+            if self._stats is not None and path is not None:
+                self._stats.dump_stats(path)
+        finally:
+            self._lock.release()
+        logger = self.logger
+        logger and logger.info('repoze.accelerator: phase timings of %d '
+                               'requests\n%s', self.samples, self.report())
+
+def make_phase_profiler(logger, config):
+    profile_path = config.get('phase_hook.profile_path') or None
+    if profile_path is not None:
+        profile_path = os.path.abspath(profile_path)
+    profiler = PhaseProfiler(
+        logger,
+        profile_path,
+        int(config.get('phase_hook.dump_every', 100)),
+        )
+    atexit.register(profiler.dump)
+    return profiler
+directlyProvides(make_phase_profiler, IPhaseHookFactory)
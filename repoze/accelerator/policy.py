@@ -1,16 +1,44 @@
 import calendar
 from email.Utils import parsedate_tz
+import re
 import time
 
 from paste.request import construct_url
-from paste.request import parse_headers
 from paste.response import header_value
 
 from zope.interface import implements
 from zope.interface import directlyProvides
 
+from repoze.accelerator.encoding import ENCODERS
+from repoze.accelerator.encoding import EncodingHandler
+from repoze.accelerator.encoding import compressible
+from repoze.accelerator.encoding import encode_response
+from repoze.accelerator.interfaces import ICoalescingPolicy
 from repoze.accelerator.interfaces import IPolicy
 from repoze.accelerator.interfaces import IPolicyFactory
+from repoze.accelerator.interfaces import IVariantStorage
+from repoze.accelerator.metrics import incr
+from repoze.accelerator.phases import PHASES_KEY
+from repoze.accelerator.phases import clock
+from repoze.accelerator.ranges import body_length
+from repoze.accelerator.ranges import parse_range
+from repoze.accelerator.ranges import range_response
+from repoze.accelerator.storage import CompressedBody
+
+# the environment key marking requests for URLs remembered as
+# uncacheable (see 'AcceleratorPolicy.hit_for_pass_ttl')
+PASS_KEY = 'repoze.accelerator.pass'
+
+# the most URLs remembered as uncacheable at once
+HIT_FOR_PASS_MAX = 10000
+
+# request headers making a request conditional or partial, and the
+# statuses of responses answering such requests, which never earn a
+# hit-for-pass verdict
+CONDITIONAL_HEADERS = ('HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+                       'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE',
+                       'HTTP_IF_RANGE', 'HTTP_RANGE')
+PARTIAL_STATUSES = ('206', '304', '412', '416')
 
 class NullPolicy:
     """ Pass-through, caches nothing.
@@ -30,7 +58,7 @@ def make_null_policy(logger, storage, config):
     return NullPolicy()
 directlyProvides(make_null_policy, IPolicyFactory)
 
-class AcceleratorPolicy:
+class AcceleratorPolicy(object):
     """ Simple accelerating cache policy.
 
     - Allow configuration of "vary" policies for both request headers
@@ -57,12 +85,6 @@ class AcceleratorPolicy:
     - If the request method doesn't match one of our allowed_methods,
       don't try to retrieve it from storage.
 
-    - If the request has a Range, header, don't try to retrieve it
-      from storage.
-
-    - If the request is conditional (e.g. If-Modified-Since,
-      If-None-Match), don't try to retrieve it from storage.
-
     - Otherwise, attempt to retrieve it from storage.
 
     When deciding whether a value returned from storage should be
@@ -78,8 +100,34 @@ class AcceleratorPolicy:
     - If the entry in the cache is stale, don't serve from cache.
       Staleness is defined as having a CC: max-age < (now -
       entitydate) or an expires header whereby (expires - entitydate)
-      < (now - entitydate).  Entities which don't have a Date header
-      are also considered stale.
+      < (now - entitydate).  Entities which don't have a Date header,
+      or have neither a max-age nor an Expires header, are also
+      considered stale.
+
+    - Unless the entry has been stale for less than its CC:
+      stale-while-revalidate value, or than "stale_grace" seconds
+      (whichever is greater).  In that case, serve it from cache and
+      set 'repoze.accelerator.stale' in the environment to a key
+      naming the entry, so that the middleware refreshes it.
+
+    If the request is conditional, evaluate it against the 'ETag' and
+    'Last-Modified' headers of the matching entry:
+
+    - If the request has an If-Match header, and the entry has no ETag
+      or a different one, don't serve from cache.
+
+    - If the request has an If-None-Match header which matches the
+      entry's ETag, or an If-Modified-Since header no earlier than its
+      Last-Modified, serve a '304 Not Modified' response.
+
+    - If the entry has no validator to compare against, don't serve
+      from cache;  otherwise serve the entry.
+
+    If a GET request has a Range header, and the entry is a 200 (OK)
+    response, serve the requested ranges out of it as a '206 Partial
+    Content' response, or '416 Requested Range Not Satisfiable' if none
+    of them is.  If the request's If-Range header doesn't match the
+    entry's strong ETag or Last-Modified date, serve the entry whole.
 
     When deciding whether we can store response data in our storage:
 
@@ -105,8 +153,40 @@ class AcceleratorPolicy:
     - Store the status, the end-to-end headers in the response, and
       information about request header and environment variance.
 
+    Concurrent misses for requests which could be served from cache
+    are keyed on the URL plus the values of the "always vary" request
+    headers and environment variables.
+
+    Request headers are read directly from their 'HTTP_*' environment
+    keys, rather than parsed out of the environment as a whole.
+
+    Requests not looked up and responses not stored are counted as
+    'bypasses', by reason, in the middleware's metrics.
+
+    If "hit_for_pass_ttl" is nonzero, the key (as for concurrent
+    misses) of a plain request (not a conditional, Range or reload
+    one) whose response could not be stored (for its status, scheme,
+    no-cache or max-age, or 'Vary: *') is remembered as uncacheable
+    for that many seconds;  206, 304, 412 and 416 responses never
+    count.  Meanwhile, requests with that key are passed to the
+    application without looking them up, storing their responses or
+    waiting for concurrent misses.  Requests for other variants of the
+    URL (with other "always vary" values) are unaffected.
+
+    If "encodings" names content-codings (e.g. 'gzip'), compressible
+    200 and 203 responses which aren't encoded already are compressed
+    with each of them once, as they are stored.  Such entries don't
+    vary on Accept-Encoding:  the encoding each request accepts (the
+    first named, on ties) is picked when it is served from cache, with
+    its own Content-Encoding, Content-Length and ETag, and a Vary
+    header naming Accept-Encoding.  Bodies smaller than
+    "compress_min_size" bytes are left alone.
+
+    Whatever "encodings" names, a compressible body which the storage
+    keeps gzip-compressed (a 'CompressedBody') is served as it is to
+    requests accepting gzip, in the same way, rather than decompressed.
     """
-    implements(IPolicy)
+    implements(ICoalescingPolicy)
 
     def __init__(self,
                  logger,
@@ -116,6 +196,10 @@ class AcceleratorPolicy:
                  always_vary_on_environ=('REQUEST_METHOD',),
                  honor_shift_reload=True,
                  store_https_responses=False,
+                 stale_grace=0,
+                 encodings=(),
+                 compress_min_size=256,
+                 hit_for_pass_ttl=0,
                  ):
         self.logger = logger
         self.storage = storage
@@ -124,63 +208,114 @@ class AcceleratorPolicy:
         self.always_vary_on_environ = always_vary_on_environ
         self.honor_shift_reload = honor_shift_reload
         self.store_https_responses = store_https_responses
+        self.stale_grace = stale_grace
+        self.encodings = encodings
+        self.compress_min_size = compress_min_size
+        self.hit_for_pass_ttl = hit_for_pass_ttl
+        # url -> time until which it is passed to the application
+        self._passes = {}
+
+    def _get_allowed_methods(self):
+        return self._allowed_methods
+
+    def _set_allowed_methods(self, allowed_methods):
+        self._allowed_methods = allowed_methods
+        self._allowed = frozenset(allowed_methods)
+
+    allowed_methods = property(_get_allowed_methods, _set_allowed_methods)
 
     def fetch(self, environ):
-        if environ.get('REQUEST_METHOD', 'GET') not in self.allowed_methods:
+        if environ.get('REQUEST_METHOD', 'GET') not in self._allowed:
+            incr(environ, 'bypasses{reason="method"}')
             return
 
-        request_headers = list(parse_headers(environ))
-
-        # if a Cache-Control/Pragma: no-cache header is in the request,
-        # and if honor_shift_reload is true, we don't serve it from cache
-        if self.honor_shift_reload:
-            if self._check_no_cache(request_headers, environ):
-                return
-        # we don't try to serve range requests up from the cache
-        if header_value(request_headers, 'Range'):
+        if not self._fetchable(environ):
+            incr(environ, 'bypasses{reason="reload"}')
             return
-        # we don't try to serve conditional requests up from cache
-        for conditional in ('If-Modified-Since', 'If-None-Match',
-                            'If-Match'):  # XXX other conditionals?
-            if header_value(request_headers, conditional):
-                return
 
+        # time the lookup if the middleware samples this request
+        phases = environ.get(PHASES_KEY)
+        if phases is not None:
+            start = clock()
         url = construct_url(environ)
-        entries = self.storage.fetch(url)
+        if phases is not None:
+            start = phases.add('construct_url', start)
+
+        passes = self._passes
+        if passes:
+            key = self._key(environ, url)
+            until = passes.get(key)
+            if until is not None:
+                if until > time.time():
+                    environ[PASS_KEY] = True
+                    incr(environ, 'bypasses{reason="pass"}')
+                    return
+                passes.pop(key, None)
 
-        if entries:
-            matching = self._discriminate(entries, request_headers, environ)
-            if not matching:
-                return
+        storage = self.storage
 
+        if IVariantStorage.providedBy(storage):
+            def resolve(typ, name):
+                if typ == 'env':
+                    return environ.get(name)
+                return request_header(environ, name)
+            matching = storage.fetch_variant(url, resolve)
+        else:
+            entries = storage.fetch(url)
+            matching = entries and self._discriminate(entries, environ)
+        if phases is not None:
+            phases.add('storage.fetch', start)
+
+        if matching:
             now = time.time()
 
             discrims, expires, status, response_headers, body, extras = matching
-            if expires > now:
-                return status, response_headers, body
+            if expires <= now:
+                if now >= expires + self._stale_window(response_headers):
+                    return
+                environ['repoze.accelerator.stale'] = (url, discrims)
+            encodings = extras.get('encodings')
+            if encodings and self.encodings:
+                response_headers, body = encode_response(
+                    response_headers, body, encodings,
+                    environ.get('HTTP_ACCEPT_ENCODING'), self.encodings)
+            if (isinstance(body, CompressedBody) and
+                compressible(response_headers)):
+                response_headers, body = encode_response(
+                    response_headers, body, {'gzip': body.data},
+                    environ.get('HTTP_ACCEPT_ENCODING'), ('gzip',))
+            result = self._conditional(
+                (status, response_headers, body), environ)
+            range_header = environ.get('HTTP_RANGE')
+            if range_header and result is not None:
+                if (environ.get('REQUEST_METHOD', 'GET') == 'GET' and
+                    str(result[0]).startswith('200')):
+                    result = self._range(result, range_header, environ)
+            return result
 
     def store(self, status, response_headers, environ):
-        request_headers = list(parse_headers(environ))
-
         # abort if we shouldn't store this response
+        # (requests counted as bypasses when fetched aren't again)
+        if environ.get(PASS_KEY):
+            return
         request_method = environ.get('REQUEST_METHOD', 'GET')
-        if request_method not in self.allowed_methods:
+        if request_method not in self._allowed:
             return
         if not (status.startswith('200') or status.startswith('203')):
-            return
+            return self._uncacheable(environ, 'status', status)
         if environ['wsgi.url_scheme'] == 'https':
             if not self.store_https_responses:
-                return
-        if self._check_no_cache(response_headers, environ):
-            return
+                return self._uncacheable(environ, 'https')
+        if self._check_no_cache(response_headers):
+            return self._uncacheable(environ, 'no-cache')
         cc_header = header_value(response_headers, 'Cache-Control')
         if cc_header:
             cc_parts = parse_cache_control_header(cc_header)
             try:
                 if int(cc_parts.get('max-age', '0')) == 0:
-                    return
+                    return self._uncacheable(environ, 'max-age')
             except ValueError:
-                return
+                return self._uncacheable(environ, 'max-age')
 
         # if we didn't abort due to any condition above, store the response
         vary_header_names = []
@@ -192,11 +327,19 @@ class AcceleratorPolicy:
             vary_header_names.extend(list(self.always_vary_on_headers))
 
         if '*' in vary_header_names:
-            return
+            return self._uncacheable(environ, 'vary')
+
+        encodings = None
+        if self.encodings and compressible(response_headers,
+                                           self.compress_min_size):
+            # we pick the encoding of each hit ourselves
+            encodings = {}
+            vary_header_names = [ x for x in vary_header_names
+                                  if x.lower() != 'accept-encoding' ]
 
         discriminators = []
         for header_name in vary_header_names:
-            value = header_value(request_headers, header_name)
+            value = request_header(environ, header_name)
             if value is not None:
                 discriminators.append(('vary', (header_name, value)))
         for varname in self.always_vary_on_environ:
@@ -218,19 +361,135 @@ class AcceleratorPolicy:
 
         expires = self._expires(date, response_headers)
 
-        # XXX purge?
+        extras = {}
+        window = self._stale_window(response_headers)
+        if window:
+            # ask the storage to keep the entry while we may serve it
+            extras['stale_until'] = expires + window
+        if encodings is not None:
+            # filled in by the EncodingHandler before the entry is stored
+            extras['encodings'] = encodings
 
-        return self.storage.store(
+        handler = self.storage.store(
             url,
             discriminators,
             expires,
             status,
             headers,
+            **extras
             )
+        if handler is not None and encodings is not None:
+            handler = EncodingHandler(handler, encodings, self.encodings,
+                                      self.compress_min_size)
+        return handler
 
-    def _discriminate(self, entries, request_headers, environ):
+    def coalesce_key(self, environ):
+        if environ.get(PASS_KEY):
+            return
+
+        if environ.get('REQUEST_METHOD', 'GET') not in self._allowed:
+            return
 
-        matching_entries = entries[:]
+        if not self._fetchable(environ):
+            return
+
+        return self._key(environ, construct_url(environ))
+
+    def _key(self, environ, url):
+        # the URL plus the values of the "always vary" request headers
+        # and environment variables
+        key = [url]
+        for header_name in self.always_vary_on_headers:
+            key.append(request_header(environ, header_name))
+        for varname in self.always_vary_on_environ:
+            key.append(environ.get(varname))
+        return tuple(key)
+
+    def _uncacheable(self, environ, reason, status=None):
+        # count a response we won't store, and remember its key (see
+        # '_key') for "hit_for_pass_ttl" seconds
+        incr(environ, 'bypasses{reason="%s"}' % reason)
+        ttl = self.hit_for_pass_ttl
+        if ttl and self._passable(environ, status):
+            passes = self._passes
+            now = time.time()
+            if len(passes) >= HIT_FOR_PASS_MAX:
+                for key, until in passes.items():
+                    if until <= now:
+                        passes.pop(key, None)
+                if len(passes) >= HIT_FOR_PASS_MAX:
+                    passes.clear()
+            passes[self._key(environ, construct_url(environ))] = now + ttl
+
+    def _passable(self, environ, status=None):
+        # only a plain request which could have been served from cache
+        # earns a hit-for-pass verdict:  the responses to conditional and
+        # Range requests say nothing about the URL's cacheability
+        if status is not None and status[:3] in PARTIAL_STATUSES:
+            return False
+        for key in CONDITIONAL_HEADERS:
+            if environ.get(key):
+                return False
+        return self._fetchable(environ)
+
+    def _fetchable(self, environ):
+        # if a Cache-Control/Pragma: no-cache header is in the request,
+        # and if honor_shift_reload is true, we don't serve it from cache
+        if self.honor_shift_reload:
+            for key in ('HTTP_PRAGMA', 'HTTP_CACHE_CONTROL'):
+                value = environ.get(key)
+                if value and 'no-cache' in value.lower():
+                    return False
+        return True
+
+    def _conditional(self, result, environ):
+        # answer conditional requests from the entry's validators, or
+        # return None if they can't be answered from it
+        if_match = environ.get('HTTP_IF_MATCH')
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if not (if_match or if_none_match or if_modified_since):
+            return result
+
+        status, response_headers, body = result
+        etag = header_value(response_headers, 'ETag')
+
+        if if_match:
+            if etag is None or etag.startswith('W/'):
+                return
+            tags = parse_etags(if_match)
+            if '*' not in tags and etag not in tags:
+                return
+
+        not_modified = False
+        if if_none_match:
+            if etag is None:
+                return
+            tags = [ strip_weak(tag) for tag in parse_etags(if_none_match) ]
+            not_modified = '*' in tags or strip_weak(etag) in tags
+        elif if_modified_since:
+            last_modified = header_value(response_headers, 'Last-Modified')
+            if last_modified is None:
+                return
+            last_modified = parsedate_tz(last_modified)
+            if_modified_since = parsedate_tz(if_modified_since)
+            if last_modified is None or if_modified_since is None:
+                return
+            not_modified = (calendar.timegm(last_modified) <=
+                            calendar.timegm(if_modified_since))
+
+        if not_modified:
+            if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+                return
+            headers = [ (name, value) for name, value in response_headers
+                        if name.lower() in NOT_MODIFIED_HEADERS ]
+            return '304 Not Modified', headers, []
+
+        return result
+
+    def _discriminate(self, entries, environ):
+
+        matching_entries = list(entries)
 
         for entry in entries:
             discrims, expires, status, headers, body, extras = entry
@@ -239,7 +498,7 @@ class AcceleratorPolicy:
                 if typ == 'env':
                     strval = environ.get(stored_name)
                 elif typ == 'vary':
-                    strval = header_value(request_headers, stored_name)
+                    strval = request_header(environ, stored_name)
                 else: #pragma NO COVER
                     raise ValueError(discrim)
                 if strval is None or strval != stored_value:
@@ -250,13 +509,40 @@ class AcceleratorPolicy:
             match = matching_entries[0] # this is essentially random
             return match
 
-    def _check_no_cache(self, headers, environ):
+    def _range(self, result, range_header, environ):
+        status, response_headers, body = result
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range:
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                validator = header_value(response_headers, 'ETag')
+                if validator and validator.startswith('W/'):
+                    return result
+            else:
+                validator = header_value(response_headers, 'Last-Modified')
+            if validator != if_range:
+                return result
+        length = body_length(body)
+        ranges = parse_range(range_header, length)
+        if ranges is None:
+            return result
+        return range_response(status, response_headers, body, ranges, length)
+
+    def _check_no_cache(self, headers):
         for nocache in ('Pragma', 'Cache-Control'):
             value = header_value(headers, nocache)
             if value and 'no-cache' in value.lower():
                 return True
         return False
 
+    def _stale_window(self, headers):
+        cc_header = header_value(headers, 'Cache-Control')
+        cc_parts = parse_cache_control_header(cc_header)
+        try:
+            window = int(cc_parts.get('stale-while-revalidate') or 0)
+        except ValueError:
+            window = 0
+        return max(window, self.stale_grace)
+
     def _expires(self, date, headers):
         cc_header = header_value(headers, 'Cache-Control')
         expires_header = header_value(headers, 'Expires')
@@ -278,6 +564,9 @@ class AcceleratorPolicy:
             else:
                 return calendar.timegm(expires)
 
+        # no freshness lifetime:  stale as soon as it is stored
+        return date
+
 
 def make_accelerator_policy(logger, storage, config):
     allowed_methods = config.get('policy.allowed_methods', 'GET')
@@ -292,6 +581,16 @@ def make_accelerator_policy(logger, storage, config):
     always_vary_on_environ = config.get('policy.always_vary_on_environ',
                                         'REQUEST_METHOD')
     always_vary_on_environ = filter(None, always_vary_on_environ.split())
+    stale_grace = int(config.get('policy.stale_grace', 0))
+    encodings = []
+    for name in config.get('policy.encodings', '').lower().split():
+        if name in ENCODERS:
+            encodings.append(name)
+        elif logger is not None:
+            logger.warning('repoze.accelerator: content-coding %r is not '
+                           'available', name)
+    compress_min_size = int(config.get('policy.compress_min_size', 256))
+    hit_for_pass_ttl = float(config.get('policy.hit_for_pass_ttl', 0))
     return AcceleratorPolicy(
         logger,
         storage,
@@ -300,6 +599,10 @@ def make_accelerator_policy(logger, storage, config):
         always_vary_on_environ,
         honor_shift_reload,
         store_https_responses,
+        stale_grace,
+        encodings,
+        compress_min_size,
+        hit_for_pass_ttl,
         )
 directlyProvides(make_accelerator_policy, IPolicyFactory)
 
@@ -312,6 +615,37 @@ HOP_BY_HOP = ['connection',
               'transfer-encoding',
               'upgrade']
 
+# headers which are repeated in a 304 response
+NOT_MODIFIED_HEADERS = ('cache-control',
+                        'content-location',
+                        'date',
+                        'etag',
+                        'expires',
+                        'last-modified',
+                        'vary')
+
+# request headers whose environment keys have no 'HTTP_' prefix
+UNPREFIXED_HEADERS = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+
+_environ_keys = {}
+
+def environ_key(name):
+    """ Return the environment key holding the request header 'name'.
+    """
+    key = _environ_keys.get(name)
+    if key is None:
+        key = name.upper().replace('-', '_')
+        if key not in UNPREFIXED_HEADERS:
+            key = 'HTTP_' + key
+        if len(_environ_keys) < 1000: # header names come from responses
+            _environ_keys[name] = key
+    return key
+
+def request_header(environ, name):
+    """ Return the value of the request header 'name', or None.
+    """
+    return environ.get(environ_key(name))
+
 def endtoend(headers):
     connection_header = header_value(headers, 'Connection') or ''
     hop_by_hop = [x.strip().lower() for x in connection_header.split(',')]
@@ -332,6 +666,19 @@ def parse_cache_control_header(header):
                 cc_parts[part] = None
     return cc_parts
 
+_ETAG = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+def parse_etags(header):
+    """ Return the list of entity tags in an If-Match or If-None-Match
+    header value.
+    """
+    return _ETAG.findall(header)
+
+def strip_weak(etag):
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
 def asbool(val):
     val= str(val)
     if val.lower() in ('y', 'yes', 'true', 't'):
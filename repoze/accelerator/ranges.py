@@ -0,0 +1,151 @@
+import binascii
+import os
+
+# ignore Range headers asking for more pieces than this
+MAX_RANGES = 100
+
+def parse_range(header, length):
+    """ Parse a Range header value against a body of 'length' bytes.
+
+    o Return None if the header is malformed, or isn't a 'bytes' range;
+      such headers are to be ignored.
+
+    o Otherwise, return a sorted list of satisfiable '(start, stop)'
+      pairs (half-open, overlapping ranges coalesced).  The list is
+      empty if no range is satisfiable.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [ spec.strip() for spec in specs.split(',') ]
+    specs = [ spec for spec in specs if spec ]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep:
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if first:
+            start = int(first)
+            if last:
+                stop = int(last) + 1
+                if stop <= start:
+                    return None
+            else:
+                stop = length
+            stop = min(stop, length)
+        elif last:
+            # suffix range:  the final 'last' bytes
+            start, stop = max(length - int(last), 0), length
+        else:
+            return None
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    coalesced = []
+    for start, stop in ranges:
+        if coalesced and start <= coalesced[-1][1]:
+            coalesced[-1] = (coalesced[-1][0], max(stop, coalesced[-1][1]))
+        else:
+            coalesced.append((start, stop))
+    return coalesced
+
+def body_length(body):
+    length = getattr(body, 'length', None)
+    if length is not None:
+        return length
+    length = 0
+    for chunk in body:
+        length += len(chunk)
+    return length
+
+def slice_body(body, start, stop):
+    """ Yield the bytes in '[start, stop)' of the chunked 'body'.
+
+    o Only the chunks overlapping the range are sliced;  the body is
+      never joined.
+
+    o Bodies which know how to read a range themselves (such as file
+      bodies) are asked to.
+    """
+    iter_range = getattr(body, 'iter_range', None)
+    if iter_range is not None:
+        return iter_range(start, stop)
+    return _slice_chunks(body, start, stop)
+
+def _slice_chunks(body, start, stop):
+    offset = 0
+    for chunk in body:
+        end = offset + len(chunk)
+        if end > start:
+            if offset >= start and end <= stop:
+                yield chunk
+            else:
+                yield chunk[max(start - offset, 0):stop - offset]
+        offset = end
+        if offset >= stop:
+            break
+
+def range_response(status, headers, body, ranges, length):
+    """ Return a '(status, headers, body)' tuple answering the
+    satisfiable 'ranges' (as returned from 'parse_range') out of the
+    full 'status', 'headers' and 'body' of 'length' bytes.
+    """
+    if not ranges:
+        headers = [ (name, value) for name, value in headers
+                    if name.lower() not in ('content-length',
+                                            'content-range') ]
+        headers.append(('Content-Range', 'bytes */%d' % length))
+        headers.append(('Content-Length', '0'))
+        return '416 Requested Range Not Satisfiable', headers, []
+
+    content_type = None
+    headers206 = []
+    for name, value in headers:
+        lname = name.lower()
+        if lname == 'content-type':
+            content_type = value
+        elif lname not in ('content-length', 'content-range'):
+            headers206.append((name, value))
+
+    if len(ranges) == 1:
+        (start, stop), = ranges
+        if content_type is not None:
+            headers206.append(('Content-Type', content_type))
+        headers206.append(('Content-Range',
+                           'bytes %d-%d/%d' % (start, stop - 1, length)))
+        headers206.append(('Content-Length', str(stop - start)))
+        return ('206 Partial Content', headers206,
+                slice_body(body, start, stop))
+
+    boundary = binascii.hexlify(os.urandom(12))
+    parts = []
+    size = 0
+    for start, stop in ranges:
+        part = ['--%s' % boundary]
+        if content_type is not None:
+            part.append('Content-Type: %s' % content_type)
+        part.append('Content-Range: bytes %d-%d/%d' % (start, stop - 1,
+                                                        length))
+        part = '\r\n'.join(part) + '\r\n\r\n'
+        parts.append((part, start, stop))
+        size += len(part) + (stop - start) + 2
+    trailer = '--%s--\r\n' % boundary
+    size += len(trailer)
+
+    def multipart():
+        for part, start, stop in parts:
+            yield part
+            for chunk in slice_body(body, start, stop):
+                yield chunk
+            yield '\r\n'
+        yield trailer
+
+    headers206.append(('Content-Type',
+                       'multipart/byteranges; boundary=%s' % boundary))
+    headers206.append(('Content-Length', str(size)))
+    return '206 Partial Content', headers206, multipart()
@@ -0,0 +1,324 @@
+import math
+import socket
+import struct
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError: #pragma NO COVER python < 2.5
+    from sha import new as sha1
+
+from zope.interface import implements
+from zope.interface import directlyProvides
+
+from repoze.accelerator.interfaces import IChunkHandler
+from repoze.accelerator.interfaces import IStorage
+from repoze.accelerator.interfaces import IStorageFactory
+from repoze.accelerator.serialize import dumps
+from repoze.accelerator.serialize import dumps_entry
+from repoze.accelerator.serialize import loads_entry
+from repoze.accelerator.storage import MemoryBody
+from repoze.accelerator.storage import deadline
+from repoze.accelerator.storage import with_content_length
+
+_LEN = struct.Struct('>I')
+
+class RedisError(Exception):
+    """ An error reply from the server, or a failure to talk to it.
+    """
+
+class ProtocolError(RedisError):
+    pass
+
+class PoolExhausted(RedisError):
+    pass
+
+class RedisConnection:
+    """ A connection to a Redis server.
+    """
+    def __init__(self, host, port, timeout=None, db=0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.reader = self.sock.makefile('rb')
+        if db:
+            try:
+                self.execute(('SELECT', db))
+            except:
+                self.close()
+                raise
+
+    def execute(self, *commands):
+        """ Send 'commands' (sequences of arguments) at once, and return
+        the list of their replies.
+
+        o Raise RedisError if any of them failed.
+        """
+        self.sock.sendall(''.join([ encode_command(command)
+                                    for command in commands ]))
+        replies = [ read_reply(self.reader) for command in commands ]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+class ConnectionPool:
+    """ A thread-safe pool of at most 'size' connections.
+
+    o 'acquire' raises PoolExhausted rather than waiting when all of
+      them are in use.
+
+    o After a failure to connect, no connection is attempted for
+      'retry_interval' seconds, so that requests don't pile up behind
+      a server which is down.
+    """
+    def __init__(self, host, port, size=10, timeout=1.0, db=0,
+                 retry_interval=1.0):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.db = db
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = 0
+        self.down_until = 0
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()
+            if self.created >= self.size:
+                raise PoolExhausted('all %d connections in use' % self.size)
+            if time.time() < self.down_until:
+                raise RedisError('server down')
+            self.created += 1
+        finally:
+            self.lock.release()
+        try:
+            return RedisConnection(self.host, self.port, self.timeout,
+                                   self.db)
+        except:
+            self.lock.acquire()
+            try:
+                self.created -= 1
+                self.down_until = time.time() + self.retry_interval
+            finally:
+                self.lock.release()
+            raise
+
+    def release(self, connection, broken=False):
+        """ Return 'connection' to the pool, or close it if 'broken'.
+        """
+        if broken:
+            connection.close()
+        self.lock.acquire()
+        try:
+            if broken:
+                self.created -= 1
+            else:
+                self.idle.append(connection)
+        finally:
+            self.lock.release()
+
+    def execute(self, *commands):
+        """ Run 'commands' on a pooled connection, as
+        'RedisConnection.execute'.
+        """
+        connection = self.acquire()
+        try:
+            replies = connection.execute(*commands)
+        except RedisError, e:
+            # an error reply leaves the connection usable;  a protocol
+            # error doesn't
+            self.release(connection, isinstance(e, ProtocolError))
+            raise
+        except:
+            self.release(connection, True)
+            raise
+        self.release(connection)
+        return replies
+
+class RedisStorage:
+    """ Keep cached responses in a Redis server.
+
+    o Each variant of a URL is kept under its own key, which expires
+      when the entry may no longer be served.  A set per URL names the
+      keys of its variants, which are read with a single MGET.
+
+    o When the server can't be reached, or all 'pool_size' connections
+      are busy, fetches miss and stores are dropped.
+    """
+    implements(IStorage)
+
+    def __init__(self, logger, host='localhost', port=6379, db=0,
+                 prefix='repoze.accelerator:', pool_size=10, timeout=1.0,
+                 retry_interval=1.0):
+        self.logger = logger
+        self.prefix = prefix
+        self.pool = ConnectionPool(host, port, pool_size, timeout, db,
+                                   retry_interval)
+
+    def store(self, url, discriminators, expires, status, headers, **extras):
+        body = []
+        storage = self
+
+        class RedisHandler:
+            implements(IChunkHandler)
+            def write(self, chunk):
+                body.append(chunk)
+
+            def close(self):
+                storage._store(url, discriminators, expires, status, headers,
+                               extras, ''.join(body))
+
+        return RedisHandler()
+
+    def _store(self, url, discriminators, expires, status, headers, extras,
+               body):
+        until = deadline(expires, extras)
+        if not isinstance(until, (int, long, float)):
+            return # it would never be served
+        ttl = int(math.ceil(until - time.time()))
+        if ttl <= 0:
+            return
+        index = self._index_key(url)
+        key = '%s:%s' % (index, _hash(dumps(tuple(discriminators))))
+        value = dumps_value(discriminators, expires, status,
+                            with_content_length(headers, len(body)),
+                            dict(extras, url=url), body)
+        try:
+            replies = self.pool.execute(('SET', key, value, 'EX', ttl),
+                                        ('SADD', index, key),
+                                        ('TTL', index))
+            if replies[2] < ttl:
+                # keep the set as long as its longest-lived variant
+                self.pool.execute(('EXPIRE', index, ttl))
+        except (RedisError, socket.error), e:
+            self._failed('store', url, e)
+
+    def fetch(self, url):
+        index = self._index_key(url)
+        try:
+            keys, = self.pool.execute(('SMEMBERS', index))
+            if not keys:
+                return None
+            values, = self.pool.execute(['MGET'] + keys)
+            expired = [ key for key, value in zip(keys, values)
+                        if value is None ]
+            if expired:
+                self.pool.execute(['SREM', index] + expired)
+        except (RedisError, socket.error), e:
+            self._failed('fetch', url, e)
+            return None
+        L = []
+        for value in values:
+            if value is None:
+                continue
+            try:
+                entry = loads_value(value)
+            except ValueError: #pragma NO COVER written by another version
+                continue
+            discriminators, expires, status, headers, extras, body = entry
+            if extras.get('url') != url: #pragma NO COVER hash collision
+                continue
+            L.append((discriminators, expires, status, headers,
+                      MemoryBody((body,)), extras))
+        return L or None
+
+    def _index_key(self, url):
+        return self.prefix + _hash(url)
+
+    def _failed(self, operation, url, error):
+        logger = self.logger
+        logger and logger.warning('repoze.accelerator: redis %s of %s '
+                                  'failed: %s', operation, url, error)
+
+def dumps_value(discriminators, expires, status, headers, extras, body):
+    """ Return the value under which an entry is kept:  its metadata
+    (see 'serialize.dumps_entry'), prefixed by its length, then its body.
+    """
+    meta = dumps_entry(discriminators, expires, status, headers, extras)
+    return '%s%s%s' % (_LEN.pack(len(meta)), meta, body)
+
+def loads_value(data):
+    """ Return '(discriminators, expires, status, headers, extras, body)'
+    from a value written by 'dumps_value'.
+
+    o Raise ValueError if 'data' wasn't written by a compatible version.
+    """
+    if len(data) < _LEN.size:
+        raise ValueError('truncated value')
+    length, = _LEN.unpack_from(data)
+    start = _LEN.size
+    discriminators, expires, status, headers, extras = loads_entry(
+        data[start:start + length])
+    return (discriminators, expires, status, headers, extras,
+            data[start + length:])
+
+def encode_command(args):
+    """ Encode a command (a sequence of arguments) in the Redis protocol.
+    """
+    out = ['*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        else:
+            arg = str(arg)
+        out.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(out)
+
+def read_reply(reader):
+    """ Read a reply in the Redis protocol from the file-like 'reader'.
+
+    o Error replies are returned as RedisError instances.
+
+    o Raise ProtocolError if the reply is malformed or cut short.
+    """
+    line = reader.readline()
+    if not line.endswith('\r\n'):
+        raise ProtocolError('connection closed')
+    tag, rest = line[0], line[1:-2]
+    if tag == '+':
+        return rest
+    if tag == '-':
+        return RedisError(rest)
+    try:
+        number = int(rest)
+    except ValueError:
+        raise ProtocolError('bad reply %r' % line)
+    if tag == ':':
+        return number
+    if tag == '$':
+        if number < 0:
+            return None
+        data = reader.read(number + 2)
+        if len(data) != number + 2 or not data.endswith('\r\n'):
+            raise ProtocolError('connection closed')
+        return data[:-2]
+    if tag == '*':
+        if number < 0:
+            return None
+        return [ read_reply(reader) for i in xrange(number) ]
+    raise ProtocolError('bad reply %r' % line)
+
+def _hash(data):
+    return sha1(data).hexdigest()
+
+def make_redis_storage(logger, config):
+    return RedisStorage(
+        logger,
+        host=config.get('storage.host', 'localhost'),
+        port=int(config.get('storage.port', 6379)),
+        db=int(config.get('storage.db', 0)),
+        prefix=config.get('storage.prefix', 'repoze.accelerator:'),
+        pool_size=int(config.get('storage.pool_size', 10)),
+        timeout=float(config.get('storage.timeout', 1.0)),
+        retry_interval=float(config.get('storage.retry_interval', 1.0)),
+        )
+directlyProvides(make_redis_storage, IStorageFactory)
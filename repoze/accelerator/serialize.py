@@ -0,0 +1,136 @@
+import struct
+
+# Entries are written as MAGIC, a format version byte, then the tagged
+# encoding of (discriminators, expires, status, headers, extras).  The
+# encoding handles the few types found in cache entries, and (unlike
+# marshal or pickle) is stable across Python versions and safe to load.
+
+MAGIC = 'RAE'
+VERSION = 1
+
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+_LEN = struct.Struct('>I')
+
+def dumps(obj):
+    """ Return the tagged binary encoding of 'obj'.
+    """
+    out = []
+    _dump(obj, out.append)
+    return ''.join(out)
+
+def _dump(obj, write):
+    if obj is None:
+        write('N')
+    elif obj is True:
+        write('T')
+    elif obj is False:
+        write('F')
+    elif isinstance(obj, str):
+        write('s')
+        write(_LEN.pack(len(obj)))
+        write(obj)
+    elif isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+        write('u')
+        write(_LEN.pack(len(obj)))
+        write(obj)
+    elif isinstance(obj, (int, long)):
+        if -2**63 <= obj < 2**63:
+            write('i')
+            write(_INT.pack(obj))
+        else:
+            obj = str(obj)
+            write('I')
+            write(_LEN.pack(len(obj)))
+            write(obj)
+    elif isinstance(obj, float):
+        write('f')
+        write(_FLOAT.pack(obj))
+    elif isinstance(obj, (tuple, list)):
+        write(isinstance(obj, tuple) and 't' or 'l')
+        write(_LEN.pack(len(obj)))
+        for item in obj:
+            _dump(item, write)
+    elif isinstance(obj, dict):
+        write('d')
+        write(_LEN.pack(len(obj)))
+        for key, value in obj.items():
+            _dump(key, write)
+            _dump(value, write)
+    else:
+        raise TypeError('cannot serialize %r' % (obj,))
+
+def loads(data):
+    """ Return the object encoded in 'data' by 'dumps'.
+
+    o Raise ValueError if 'data' is truncated or malformed.
+    """
+    obj, offset = _load(data, 0)
+    if offset != len(data):
+        raise ValueError('trailing data')
+    return obj
+
+def _load(data, offset):
+    try:
+        tag = data[offset]
+        offset += 1
+        if tag == 'N':
+            return None, offset
+        if tag == 'T':
+            return True, offset
+        if tag == 'F':
+            return False, offset
+        if tag == 'i':
+            return _INT.unpack_from(data, offset)[0], offset + _INT.size
+        if tag == 'f':
+            return _FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size
+        length, = _LEN.unpack_from(data, offset)
+        offset += _LEN.size
+        if tag in 'suI':
+            value = data[offset:offset + length]
+            if len(value) != length:
+                raise ValueError('truncated string')
+            offset += length
+            if tag == 'u':
+                value = value.decode('utf-8')
+            elif tag == 'I':
+                value = long(value)
+            return value, offset
+        if tag in 'tl':
+            items = []
+            for i in xrange(length):
+                item, offset = _load(data, offset)
+                items.append(item)
+            if tag == 't':
+                items = tuple(items)
+            return items, offset
+        if tag == 'd':
+            items = {}
+            for i in xrange(length):
+                key, offset = _load(data, offset)
+                items[key], offset = _load(data, offset)
+            return items, offset
+    except (IndexError, struct.error), e:
+        raise ValueError(str(e))
+    raise ValueError('unknown tag %r' % tag)
+
+def dumps_entry(discriminators, expires, status, headers, extras):
+    """ Return the versioned encoding of a cache entry's metadata.
+    """
+    return '%s%s%s' % (MAGIC, chr(VERSION), dumps(
+        (tuple(discriminators), expires, status, list(headers), extras)))
+
+def loads_entry(data):
+    """ Return '(discriminators, expires, status, headers, extras)'
+    from data written by 'dumps_entry'.
+
+    o Raise ValueError if 'data' wasn't written by a compatible version.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a cache entry')
+    if data[len(MAGIC):len(MAGIC) + 1] != chr(VERSION):
+        raise ValueError('unsupported cache entry version')
+    discriminators, expires, status, headers, extras = loads(
+        data[len(MAGIC) + 1:])
+    return discriminators, expires, status, headers, extras
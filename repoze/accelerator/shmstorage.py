@@ -0,0 +1,346 @@
+import binascii
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError: #pragma NO COVER python < 2.5
+    from sha import new as sha1
+
+from zope.interface import implements
+from zope.interface import directlyProvides
+
+from repoze.accelerator.interfaces import IChunkHandler
+from repoze.accelerator.interfaces import IStorage
+from repoze.accelerator.interfaces import IStorageFactory
+from repoze.accelerator.serialize import dumps
+from repoze.accelerator.serialize import dumps_entry
+from repoze.accelerator.serialize import loads_entry
+from repoze.accelerator.storage import MemoryBody
+from repoze.accelerator.storage import deadline
+from repoze.accelerator.storage import with_content_length
+
+# The arena is laid out as:
+#
+#   - a header page:  MAGIC, the layout parameters, and the next slot
+#     to allocate in each slab class;
+#
+#   - the index:  'index_slots' fixed-size records, each naming the
+#     slab slot holding one entry (URL and variant);  an entry's record
+#     is found within PROBE slots of the bucket its URL hashes to;
+#
+#   - the slabs:  for each size in SLAB_SIZES, an equal share of the
+#     remaining space divided into slots of that size, which are reused
+#     in turn (the oldest entries of a size class are overwritten
+#     first).
+#
+# Writers hold a lock on the arena file (which the kernel releases if
+# the process dies).  Readers take no lock:  each slot carries a
+# generation number, bumped before it is overwritten, and a CRC of its
+# contents;  each record carries a CRC of itself.  Anything torn by a
+# concurrent write, or by a writer which crashed, fails these checks
+# and reads as a miss.
+
+MAGIC = 'RACCSHM\0'
+VERSION = 1
+PAGE_SIZE = 4096
+PROBE = 8
+SLAB_SIZES = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20)
+
+# magic, version, arena size, index slots
+HEADER = struct.Struct('>8sIQI')
+# next slot to allocate, per slab class
+NEXT = struct.Struct('>I')
+NEXT_OFFSET = 64
+# url hash, variant hash, slab class, slot, generation, deadline
+RECORD = struct.Struct('>QQIIId')
+RECORD_CRC = struct.Struct('>I')
+RECORD_SIZE = RECORD.size + RECORD_CRC.size
+# generation, metadata length, body length, crc
+SLOT = struct.Struct('>IIII')
+
+class SharedMemoryStorage:
+    """ Keep cached responses in a memory-mapped file shared by all the
+    processes on a host which open it (e.g. prefork server workers).
+
+    o Entries are limited to the largest slab size, less their
+      metadata;  larger responses are not stored.
+
+    o When a slab class is full, its oldest entries are overwritten;
+      when an entry's index bucket is full, the entry which expires
+      soonest is dropped.
+
+    o A process which dies while writing leaves no lock held, and
+      nothing which readers would mistake for an entry.
+    """
+    implements(IStorage)
+
+    def __init__(self, logger, path, arena_size=64 << 20,
+                 index_slots=1 << 16):
+        self.logger = logger
+        self.path = path
+        self.lock = threading.Lock() # fcntl locks are per process
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            self._fd = fd
+            self._lock()
+            try:
+                self._attach(arena_size, index_slots)
+            finally:
+                self._unlock()
+        except:
+            os.close(fd)
+            raise
+
+    def _attach(self, arena_size, index_slots):
+        # Called with the lock held:  map the arena, formatting it if it
+        # is new or was laid out differently.
+        index_size = index_slots * RECORD_SIZE
+        data_offset = _round_up(PAGE_SIZE + index_size, PAGE_SIZE)
+        if arena_size <= data_offset:
+            raise ValueError('arena_size too small for %d index slots'
+                             % index_slots)
+        fresh = os.fstat(self._fd).st_size != arena_size
+        if fresh:
+            os.ftruncate(self._fd, arena_size)
+        self.arena = arena = mmap.mmap(self._fd, arena_size,
+                                       mmap.MAP_SHARED,
+                                       mmap.PROT_READ | mmap.PROT_WRITE)
+        layout = (MAGIC, VERSION, arena_size, index_slots)
+        if fresh or HEADER.unpack_from(arena, 0) != layout:
+            logger = self.logger
+            logger and logger.info(
+                'repoze.accelerator: formatting shared arena %s', self.path)
+            arena[:data_offset] = '\0' * data_offset
+            HEADER.pack_into(arena, 0, *layout)
+        self.arena_size = arena_size
+        self.index_slots = index_slots
+        self.index_offset = PAGE_SIZE
+        share = (arena_size - data_offset) // len(SLAB_SIZES)
+        # (slot size, number of slots, offset of first slot) per class
+        self.slabs = slabs = []
+        offset = data_offset
+        for size in SLAB_SIZES:
+            slabs.append((size, share // size, offset))
+            offset += share
+
+    def close(self):
+        """ Unmap the arena;  the storage may not be used afterwards.
+        """
+        self.arena.close()
+        os.close(self._fd)
+
+    def store(self, url, discriminators, expires, status, headers, **extras):
+        body = []
+        storage = self
+
+        class SharedMemoryHandler:
+            implements(IChunkHandler)
+            def write(self, chunk):
+                body.append(chunk)
+
+            def close(self):
+                storage._store(url, discriminators, expires, status, headers,
+                               extras, ''.join(body))
+
+        return SharedMemoryHandler()
+
+    def _store(self, url, discriminators, expires, status, headers, extras,
+               body):
+        until = deadline(expires, extras)
+        if not isinstance(until, (int, long, float)):
+            return # it would never be served
+        meta = dumps_entry(discriminators, expires, status,
+                           with_content_length(headers, len(body)),
+                           dict(extras, url=url))
+        needed = SLOT.size + len(meta) + len(body)
+        for cls, (size, count, offset) in enumerate(self.slabs):
+            if count and needed <= size:
+                break
+        else:
+            return # too large for any slab
+        url_hash = _hash(url)
+        variant_hash = _hash(dumps(tuple(discriminators)))
+        crc = binascii.crc32(meta + body) & 0xffffffff
+        arena = self.arena
+        self._lock()
+        try:
+            record = self._choose_record(url_hash, variant_hash)
+            next_offset = NEXT_OFFSET + cls * NEXT.size
+            slot, = NEXT.unpack_from(arena, next_offset)
+            if slot >= count: #pragma NO COVER layout changed
+                slot = 0
+            NEXT.pack_into(arena, next_offset, (slot + 1) % count)
+            slot_offset = offset + slot * size
+            generation = SLOT.unpack_from(arena, slot_offset)[0] + 1
+            generation = generation & 0xffffffff or 1
+            # invalidate the slot's old entry before overwriting it
+            SLOT.pack_into(arena, slot_offset, generation, 0, 0, 0)
+            start = slot_offset + SLOT.size
+            arena[start:start + len(meta)] = meta
+            arena[start + len(meta):start + len(meta) + len(body)] = body
+            SLOT.pack_into(arena, slot_offset, generation, len(meta),
+                           len(body), crc)
+            _write_record(arena, record, url_hash, variant_hash, cls, slot,
+                          generation, until)
+        finally:
+            self._unlock()
+
+    def _choose_record(self, url_hash, variant_hash):
+        # Called with the lock held:  return the offset of the record to
+        # (re)use for an entry:  the entry's own record, a free one, or
+        # the one expiring soonest.
+        free = victim = victim_deadline = None
+        for record in self._window(url_hash):
+            fields = self._read_record(record)
+            if fields is not None:
+                if fields[0] == url_hash and fields[1] == variant_hash:
+                    return record
+                if self._read_slot(fields) is None:
+                    fields = None # its slot has been overwritten since
+            if fields is None:
+                if free is None:
+                    free = record
+            elif victim is None or fields[5] < victim_deadline:
+                victim, victim_deadline = record, fields[5]
+        if free is not None:
+            return free
+        return victim
+
+    def fetch(self, url):
+        url_hash = _hash(url)
+        L = []
+        for record in self._window(url_hash):
+            fields = self._read_record(record)
+            if fields is None or fields[0] != url_hash:
+                continue
+            item = self._read_slot(fields)
+            if item is None:
+                continue
+            meta, body = item
+            try:
+                entry = loads_entry(meta)
+            except ValueError: #pragma NO COVER written by another version
+                continue
+            discriminators, expires, status, headers, extras = entry
+            if extras.get('url') != url: #pragma NO COVER hash collision
+                continue
+            L.append((discriminators, expires, status, headers,
+                      MemoryBody((body,)), extras))
+        return L or None
+
+    def purge(self, now=None):
+        """ Remove entries which expired before 'now' (by default, the
+        current time).
+
+        o Return a tuple, '(entries, bytes)', reporting what was purged.
+        """
+        if now is None:
+            now = time.time()
+        count = size = 0
+        arena = self.arena
+        self._lock()
+        try:
+            for i in xrange(self.index_slots):
+                record = self.index_offset + i * RECORD_SIZE
+                fields = self._read_record(record)
+                if fields is None or fields[5] > now:
+                    continue
+                item = self._read_slot(fields)
+                arena[record:record + RECORD_SIZE] = '\0' * RECORD_SIZE
+                if item is not None:
+                    count += 1
+                    size += len(item[0]) + len(item[1])
+        finally:
+            self._unlock()
+        if count:
+            logger = self.logger
+            logger and logger.info(
+                'repoze.accelerator: purged %d entries (%d bytes)',
+                count, size)
+        return count, size
+
+    def _window(self, url_hash):
+        slots = self.index_slots
+        bucket = url_hash % slots
+        offset = self.index_offset
+        for i in range(min(PROBE, slots)):
+            yield offset + ((bucket + i) % slots) * RECORD_SIZE
+
+    def _read_record(self, record):
+        # return the fields of a valid record, or None
+        data = self.arena[record:record + RECORD_SIZE]
+        fields = RECORD.unpack_from(data)
+        if not fields[0]:
+            return None
+        crc, = RECORD_CRC.unpack_from(data, RECORD.size)
+        if binascii.crc32(data[:RECORD.size]) & 0xffffffff != crc:
+            return None # torn
+        if fields[2] >= len(self.slabs) or (
+            fields[3] >= self.slabs[fields[2]][1]):
+            return None
+        return fields
+
+    def _read_slot(self, fields):
+        # return '(meta, body)' from the slot a record names, or None if
+        # it has been overwritten or is being written
+        cls, slot, generation = fields[2:5]
+        size, count, offset = self.slabs[cls]
+        arena = self.arena
+        slot_offset = offset + slot * size
+        current, meta_len, body_len, crc = SLOT.unpack_from(arena,
+                                                            slot_offset)
+        if current != generation or SLOT.size + meta_len + body_len > size:
+            return None
+        start = slot_offset + SLOT.size
+        data = arena[start:start + meta_len + body_len]
+        if SLOT.unpack_from(arena, slot_offset)[0] != generation:
+            return None
+        if binascii.crc32(data) & 0xffffffff != crc:
+            return None
+        return data[:meta_len], data[meta_len:]
+
+    def _lock(self):
+        self.lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        except:
+            self.lock.release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
+
+def _write_record(arena, record, *fields):
+    data = RECORD.pack(*fields)
+    crc = binascii.crc32(data) & 0xffffffff
+    arena[record:record + RECORD_SIZE] = data + RECORD_CRC.pack(crc)
+
+def _hash(data):
+    # a nonzero 64-bit hash (zero marks free index records)
+    return struct.unpack('>Q', sha1(data).digest()[:8])[0] or 1
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+def make_shm_storage(logger, config):
+    path = config.get('storage.path')
+    if not path:
+        directory = '/dev/shm'
+        if not os.path.isdir(directory):
+            directory = tempfile.gettempdir()
+        path = os.path.join(directory, 'repoze.accelerator.arena')
+    arena_size = int(config.get('storage.arena_size', 64 << 20))
+    index_slots = int(config.get('storage.index_slots', 1 << 16))
+    return SharedMemoryStorage(logger,
+                               os.path.abspath(os.path.normpath(path)),
+                               arena_size, index_slots)
+directlyProvides(make_shm_storage, IStorageFactory)
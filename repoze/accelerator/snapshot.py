@@ -0,0 +1,82 @@
+import os
+import struct
+import tempfile
+
+from repoze.accelerator.serialize import dumps_entry
+from repoze.accelerator.serialize import loads_entry
+
+# A snapshot is MAGIC, a format version byte, then one record per
+# entry:  the lengths of its URL, metadata (see 'serialize.dumps_entry')
+# and body, followed by those.
+
+MAGIC = 'RASNAP'
+VERSION = 1
+
+_RECORD = struct.Struct('>III')
+
+def write_snapshot(path, entries):
+    """ Write 'entries', an iterable of '(url, discriminators, expires,
+    status, headers, extras, body)' tuples, to a snapshot at 'path'.
+
+    o The snapshot is written to a temporary file, which replaces
+      'path' once complete.
+
+    o Return a tuple, '(entries, bytes)', reporting the entries and
+      body bytes written.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    f = os.fdopen(fd, 'wb')
+    count = size = 0
+    try:
+        try:
+            f.write(MAGIC + chr(VERSION))
+            for (url, discriminators, expires, status, headers, extras,
+                 body) in entries:
+                meta = dumps_entry(discriminators, expires, status, headers,
+                                   extras)
+                f.write(_RECORD.pack(len(url), len(meta), len(body)))
+                f.write(url)
+                f.write(meta)
+                f.write(body)
+                count += 1
+                size += len(body)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return count, size
+
+def read_snapshot(path, block_size=1 << 16):
+    """ Yield the '(url, discriminators, expires, status, headers,
+    extras, body)' tuples of the entries in the snapshot at 'path', one
+    at a time.
+
+    o Raise ValueError if the file isn't a snapshot this version can
+      read.  A truncated final record is ignored.
+    """
+    f = open(path, 'rb', block_size)
+    try:
+        header = f.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a snapshot')
+        if header[len(MAGIC):] != chr(VERSION):
+            raise ValueError('unsupported snapshot version')
+        while True:
+            lengths = f.read(_RECORD.size)
+            if len(lengths) < _RECORD.size:
+                break
+            url_length, meta_length, body_length = _RECORD.unpack(lengths)
+            url = f.read(url_length)
+            meta = f.read(meta_length)
+            body = f.read(body_length)
+            if len(body) < body_length or len(meta) < meta_length:
+                break
+            discriminators, expires, status, headers, extras = loads_entry(
+                meta)
+            yield (url, discriminators, expires, status, headers, extras,
+                   body)
+    finally:
+        f.close()
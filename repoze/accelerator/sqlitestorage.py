@@ -0,0 +1,296 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from zope.interface import implements
+from zope.interface import directlyProvides
+
+from repoze.accelerator.interfaces import IChunkHandler
+from repoze.accelerator.interfaces import IStorage
+from repoze.accelerator.interfaces import IStorageFactory
+from repoze.accelerator.serialize import dumps
+from repoze.accelerator.serialize import dumps_entry
+from repoze.accelerator.serialize import loads_entry
+from repoze.accelerator.storage import deadline
+from repoze.accelerator.storage import with_content_length
+
+# bodies are stored in rows of this many bytes
+BLOCK_SIZE = 1 << 16
+
+# seconds for which the body of an entry replaced or purged is kept, so
+# that requests which fetched it before can still send it
+BODY_GRACE = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    discriminators BLOB NOT NULL,
+    deadline REAL NOT NULL,
+    meta BLOB NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS entries_key
+    ON entries (url, discriminators);
+CREATE INDEX IF NOT EXISTS entries_deadline ON entries (deadline);
+CREATE TABLE IF NOT EXISTS chunks (
+    entry INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (entry, seq)
+);
+CREATE TABLE IF NOT EXISTS dead (
+    entry INTEGER PRIMARY KEY,
+    since REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dead_since ON dead (since);
+"""
+
+# Statements are kept as constants, so that each connection's
+# statement cache prepares them once.
+
+FETCH = """
+SELECT entries.id, entries.meta, entries.length, chunks.data
+  FROM entries LEFT JOIN chunks
+    ON chunks.entry = entries.id AND chunks.seq = 0
+ WHERE entries.url = ?"""
+
+BURY = """
+INSERT OR REPLACE INTO dead (entry, since)
+SELECT id, ? FROM entries WHERE url = ? AND discriminators = ?"""
+
+DELETE = "DELETE FROM entries WHERE url = ? AND discriminators = ?"
+
+INSERT = """
+INSERT INTO entries (url, discriminators, deadline, meta, length)
+VALUES (?, ?, ?, ?, ?)"""
+
+INSERT_CHUNK = "INSERT INTO chunks (entry, seq, data) VALUES (?, ?, ?)"
+
+CHUNKS = """
+SELECT data FROM chunks WHERE entry = ? AND seq BETWEEN ? AND ?
+ ORDER BY seq"""
+
+EXPIRED = "SELECT count(*), total(length) FROM entries WHERE deadline <= ?"
+
+BURY_EXPIRED = """
+INSERT OR REPLACE INTO dead (entry, since)
+SELECT id, ? FROM entries WHERE deadline <= ?"""
+
+SWEEP = "DELETE FROM entries WHERE deadline <= ?"
+
+REAP = """
+DELETE FROM chunks WHERE entry IN (SELECT entry FROM dead WHERE since <= ?)"""
+
+REAP_DEAD = "DELETE FROM dead WHERE since <= ?"
+
+class SQLiteStorage:
+    """ Keep cached responses in an SQLite database, in WAL mode so
+    that readers don't wait for writers.
+
+    o Each thread uses its own connection.
+
+    o Bodies are stored as BLOBs in rows of BLOCK_SIZE bytes.  The
+      first is read along with the entry;  the others as the body is
+      sent, from a snapshot of the database taken when the second
+      is read.
+
+    o When an entry is replaced or purged, its body is kept for
+      'body_grace' seconds, so that a body fetched before is still
+      whole when it is sent.
+
+    o Storing an entry removes the bodies of entries which have been
+      replaced or purged for longer than 'body_grace'.  Expired entries
+      are removed by calling 'purge', which a background thread does
+      every 'purge_interval' seconds if that is nonzero.
+    """
+    implements(IStorage)
+
+    def __init__(self, logger, path, timeout=5.0, body_grace=BODY_GRACE,
+                 purge_interval=0):
+        self.logger = logger
+        self.path = path
+        self.timeout = timeout
+        self.body_grace = body_grace
+        self.purge_interval = purge_interval
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+        if purge_interval:
+            thread = threading.Thread(target=self._purge_periodically)
+            thread.setDaemon(True)
+            thread.start()
+
+    def connection(self):
+        """ Return this thread's connection to the database.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None,
+                                         cached_statements=20)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def store(self, url, discriminators, expires, status, headers, **extras):
+        body = []
+        storage = self
+
+        class SQLiteHandler:
+            implements(IChunkHandler)
+            def write(self, chunk):
+                body.append(chunk)
+
+            def close(self):
+                storage._store(url, discriminators, expires, status, headers,
+                               extras, ''.join(body))
+
+        return SQLiteHandler()
+
+    def _store(self, url, discriminators, expires, status, headers, extras,
+               body):
+        meta = dumps_entry(discriminators, expires, status,
+                           with_content_length(headers, len(body)), extras)
+        key = buffer(dumps(tuple(discriminators)))
+        until = deadline(expires, extras)
+        now = time.time()
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(REAP, (now - self.body_grace,))
+            connection.execute(REAP_DEAD, (now - self.body_grace,))
+            connection.execute(BURY, (now, url, key))
+            connection.execute(DELETE, (url, key))
+            if until is not None:
+                # (an entry without a deadline would never be served)
+                entry = connection.execute(
+                    INSERT, (url, key, until, buffer(meta),
+                             len(body))).lastrowid
+                connection.executemany(INSERT_CHUNK, [
+                    (entry, seq, buffer(body, offset, BLOCK_SIZE))
+                    for seq, offset in enumerate(
+                        xrange(0, len(body), BLOCK_SIZE)) ])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def fetch(self, url):
+        L = []
+        for entry, meta, length, first in self.connection().execute(FETCH,
+                                                                     (url,)):
+            try:
+                discriminators, expires, status, headers, extras = \
+                                loads_entry(str(meta))
+            except ValueError: #pragma NO COVER written by another version
+                continue
+            body = SQLiteBody(self, entry, length, first)
+            L.append((discriminators, expires, status, headers, body, extras))
+        return L or None
+
+    def purge(self, now=None):
+        """ Remove entries which expired before 'now' (by default, the
+        current time), and the bodies of entries replaced or purged
+        more than 'body_grace' seconds before it.
+
+        o Return a tuple, '(entries, bytes)', reporting the expired
+          entries purged.
+        """
+        if now is None:
+            now = time.time()
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            count, size = connection.execute(EXPIRED, (now,)).fetchone()
+            connection.execute(BURY_EXPIRED, (now, now))
+            connection.execute(SWEEP, (now,))
+            connection.execute(REAP, (now - self.body_grace,))
+            connection.execute(REAP_DEAD, (now - self.body_grace,))
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        size = int(size)
+        if count:
+            logger = self.logger
+            logger and logger.info(
+                'repoze.accelerator: purged %d entries (%d bytes)',
+                count, size)
+        return count, size
+
+    def _purge_periodically(self):
+        sleep = time.sleep # module globals vanish at interpreter exit
+        while True:
+            sleep(self.purge_interval)
+            try:
+                self.purge()
+            except: #pragma NO COVER
+                logger = self.logger
+                logger and logger.exception('repoze.accelerator: purge')
+
+class SQLiteBody:
+    """ A cached body, read from the database in blocks.
+    """
+    def __init__(self, storage, entry, length, first):
+        self.storage = storage
+        self.entry = entry
+        self.length = length
+        self.first = first
+        self._cursor = None
+
+    def __iter__(self):
+        return self.iter_range(0, self.length)
+
+    def iter_range(self, start, stop):
+        """ Yield the bytes in '[start, stop)' of the body, in blocks.
+        """
+        if start >= stop:
+            return
+        first, last = start // BLOCK_SIZE, (stop - 1) // BLOCK_SIZE
+        offset = first * BLOCK_SIZE
+        if first == 0 and self.first is not None:
+            blocks = [self.first]
+            if last > 0:
+                blocks = self._blocks(blocks, 1, last)
+        else:
+            blocks = self._blocks([], first, last)
+        for block in blocks:
+            block = str(block)
+            end = offset + len(block)
+            if offset < start or end > stop:
+                block = block[max(start - offset, 0):stop - offset]
+            offset = end
+            yield block
+
+    def _blocks(self, blocks, first, last):
+        for block in blocks:
+            yield block
+        self._cursor = cursor = self.storage.connection().execute(
+            CHUNKS, (self.entry, first, last))
+        try:
+            for data, in cursor:
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        # finish the statement, so that it no longer holds a snapshot
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+def make_sqlite_storage(logger, config):
+    path = config.get('storage.path')
+    if not path:
+        path = os.path.join(tempfile.gettempdir(),
+                            'repoze.accelerator.sqlite')
+    timeout = float(config.get('storage.timeout', 5.0))
+    body_grace = float(config.get('storage.body_grace', BODY_GRACE))
+    purge_interval = float(config.get('storage.purge_interval', 0))
+    return SQLiteStorage(logger, os.path.abspath(os.path.normpath(path)),
+                         timeout, body_grace, purge_interval)
+directlyProvides(make_sqlite_storage, IStorageFactory)
@@ -1,49 +1,834 @@
+import atexit
+import heapq
+import os
+import signal
 import threading
+import time
+import zlib
 
 from zope.interface import implements
 from zope.interface import directlyProvides
 
+from repoze.accelerator.encoding import compress
 from repoze.accelerator.interfaces import IChunkHandler
-from repoze.accelerator.interfaces import IStorage
+from repoze.accelerator.interfaces import IStatsStorage
 from repoze.accelerator.interfaces import IStorageFactory
+from repoze.accelerator.interfaces import IVariantStorage
+from repoze.accelerator.snapshot import read_snapshot
+from repoze.accelerator.snapshot import write_snapshot
+
+# indexes into an LRU link: [prev, next, key]
+PREV, NEXT, KEY = 0, 1, 2
+
+# compressed bodies are decompressed in blocks of at most this many bytes
+BLOCK_SIZE = 1 << 16
+
+# response headers whose values are commonly shared between entries
+SHARED_VALUE_HEADERS = frozenset(['accept-ranges',
+                                  'cache-control',
+                                  'content-encoding',
+                                  'content-language',
+                                  'content-type',
+                                  'pragma',
+                                  'server',
+                                  'vary'])
+
+def _compression_ratio(storage):
+    if not storage.compressed_out:
+        return 0.0
+    return float(storage.compressed_in) / storage.compressed_out
+
+class CacheEntry(object):
+    """ A response kept by 'MemoryStorage'.
+
+    o Iterating over it yields '(discriminators, expires, status,
+      headers, body, extras)', the form of the entries returned by
+      'IStorage.fetch'.
+    """
+    __slots__ = ('discriminators', 'expires', 'status', 'headers', 'body',
+                 'size', 'extras')
+
+    def __init__(self, discriminators, expires, status, headers, body, size,
+                 extras):
+        self.discriminators = discriminators
+        self.expires = expires
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = size
+        self.extras = extras
+
+    def _astuple(self):
+        return (self.discriminators, self.expires, self.status, self.headers,
+                self.body, self.extras)
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __len__(self):
+        return 6
+
+    def __getitem__(self, index):
+        return self._astuple()[index]
+
+    def __repr__(self):
+        return '<CacheEntry %r>' % (self._astuple(),)
 
 class MemoryStorage:
-    implements(IStorage)
+    """ Keep cached responses in a dictionary in process memory.
+
+    o If 'max_size' is nonzero, the total number of bytes used by body
+      chunks, headers and discriminators is kept below it by evicting
+      the least recently used entries.
 
-    def __init__(self, logger, lock=threading.Lock()):
+    o If 'max_entries' is nonzero, no more than that many entries
+      (one per url / discriminators pair) are kept.
+
+    o Expired entries are purged, in order of expiry:  up to
+      'purge_batch' of them each time an entry is stored, and all of
+      them every 'purge_interval' seconds if that is nonzero.  An
+      entry stored with a 'stale_until' extra is kept until then.
+
+    o The variants of each URL are indexed by the names and values of
+      their discriminators, so that 'fetch_variant' needs only a dict
+      lookup per distinct set of discriminator names.
+
+    o Body chunks are joined into a single 'MemoryBody' chunk when the
+      entry is stored, so that hits are sent in one write;  a
+      Content-Length header is added if the application sent none.
+
+    o Entries are kept as compact 'CacheEntry' objects, with header
+      names and common header values interned.  'fetch' returns a
+      tuple of the URL's entries which is replaced, never changed,
+      when they are.
+
+    o Its entries may be saved to a snapshot file ('snapshot') and
+      loaded back into a new storage ('restore'), e.g. across restarts.
+
+    o If 'compress_min_size' is nonzero, bodies of at least that many
+      bytes which aren't encoded already are kept gzip-compressed (as
+      a 'CompressedBody'), reusing the gzip encoding the policy passed
+      in the 'encodings' extra if any.  The bodies compressed, their
+      bytes before ('compressed_in') and after ('compressed_out'), and
+      the seconds spent compressing ('compress_time') are counted.
+
+    o If 'max_object_size' is nonzero, responses whose body is larger
+      (as declared by their Content-Length, or once that many bytes
+      have been written) aren't stored:  their handler discards the
+      body and sets its 'discarding' attribute.  Nor are entries
+      larger than 'max_size'.  They are counted in 'oversized', and the
+      bytes written to them in 'oversized_bytes'.
+
+    o 'stats' reports the entries and bytes held, and the counters.
+    """
+    implements(IVariantStorage, IStatsStorage)
+
+    def __init__(self, logger, lock=None, max_size=0, max_entries=0,
+                 purge_batch=8, purge_interval=0, compress_min_size=0,
+                 max_object_size=0):
         self.logger = logger
+        if lock is None:
+            lock = threading.Lock()
+        # url -> {discriminators: CacheEntry}
         self.data = {}
+        # url -> tuple of CacheEntry, as returned from 'fetch'
+        self.views = {}
+        # url -> {discriminator names: {discriminator values: discrims}}
+        self.index = {}
         self.lock = lock
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.bounded = bool(max_size or max_entries)
+        self.size = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        # circular doubly linked list of LRU links, oldest first
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+        # heap of (deadline, url, discriminators), soonest first;  may
+        # hold records for entries since replaced or evicted
+        self._expiry = []
+        self.purge_batch = purge_batch
+        self.purge_interval = purge_interval
+        self.purged = 0
+        self.purged_bytes = 0
+        self.restoring = False
+        self.compress_min_size = compress_min_size
+        self.compressed = 0
+        self.compressed_in = 0
+        self.compressed_out = 0
+        self.compress_time = 0.0
+        self.max_object_size = max_object_size
+        self.oversized = 0
+        self.oversized_bytes = 0
+        if purge_interval:
+            thread = threading.Thread(target=self._purge_periodically)
+            thread.setDaemon(True)
+            thread.start()
+
+    compression_ratio = property(_compression_ratio)
 
     def store(self, url, discriminators, expires, status, headers, **extras):
         body = []
         storage = self
+        limit = self.max_object_size
 
         class SimpleHandler:
             implements(IChunkHandler)
+            # true once the body is known to exceed 'max_object_size'
+            discarding = False
+            # bytes written, if there is a limit
+            length = 0
+
             def write(self, chunk):
+                if self.discarding:
+                    self.length += len(chunk)
+                    return
                 body.append(chunk)
+                if limit:
+                    self.length += len(chunk)
+                    if self.length > limit:
+                        del body[:]
+                        self.discarding = True
 
             def close(self):
+                if self.discarding:
+                    return self._discard(self.length)
+                buffered = MemoryBody(body)
+                # (the Content-Length we may add is left out of the size,
+                # like the other per-entry overhead)
+                size = entry_size(discriminators, headers, buffered,
+                                  extras)
+                length = buffered.length
+                data, elapsed = None, 0.0
+                if (storage.compress_min_size and
+                    length >= storage.compress_min_size and
+                    not _encoded(headers)):
+                    # (an encoding from the policy is counted already)
+                    data = (extras.get('encodings') or {}).get('gzip')
+                    added = 0
+                    if data is None:
+                        started = time.time()
+                        data = compress('gzip', buffered[0])
+                        elapsed = time.time() - started
+                        added = len(data)
+                    if len(data) < length:
+                        size += added - length
+                        buffered = CompressedBody(data, length)
+                    else:
+                        data = None
+                if storage.max_size and size > storage.max_size:
+                    # storing it would evict every other entry, then it
+                    self.discarding = True
+                    return self._discard(length)
+                stored_headers = intern_headers(
+                    with_content_length(headers, buffered.length))
+                if type(status) is str:
+                    stored_status = intern(status)
+                else:
+                    stored_status = status
+                entry = CacheEntry(discriminators, expires, stored_status,
+                                   stored_headers, buffered, size, extras)
                 storage.lock.acquire()
                 try:
+                    if storage.purge_batch:
+                        storage._purge(time.time(), storage.purge_batch)
+                    storage._remove(url, discriminators)
                     entries = storage.data.setdefault(url, {})
-                    entries[discriminators] = expires,status,headers,body,extras
+                    entries[discriminators] = entry
+                    storage.views[url] = tuple(entries.values())
+                    names, values = split_discriminators(discriminators)
+                    variants = storage.index.setdefault(url, {})
+                    variants.setdefault(names, {})[values] = discriminators
+                    storage._link((url, discriminators))
+                    storage.size += size
+                    heapq.heappush(storage._expiry,
+                                   (deadline(expires, extras), url,
+                                    discriminators))
+                    storage.compress_time += elapsed
+                    if data is not None:
+                        storage.compressed += 1
+                        storage.compressed_in += length
+                        storage.compressed_out += len(data)
+                    if storage.bounded:
+                        storage._evict()
                 finally:
                     storage.lock.release()
 
-        return SimpleHandler()
-                
+            def _discard(self, length):
+                storage.lock.acquire()
+                try:
+                    storage.oversized += 1
+                    storage.oversized_bytes += length
+                finally:
+                    storage.lock.release()
+
+        handler = SimpleHandler()
+        if limit and _declared_length(headers) > limit:
+            handler.discarding = True
+        return handler
+
     def fetch(self, url):
+        entries = self.views.get(url)
+        if entries is None:
+            return None
+        if self.bounded:
+            self.lock.acquire()
+            try:
+                for entry in entries:
+                    self._touch((url, entry.discriminators))
+            finally:
+                self.lock.release()
+        return entries
+
+    def fetch_variant(self, url, resolve):
+        variants = self.index.get(url)
+        if variants is None:
+            return None
+        entries = self.data.get(url, {})
+        for names, table in variants.items():
+            values = tuple([ resolve(typ, name) for typ, name in names ])
+            discrims = table.get(values)
+            if discrims is not None:
+                entry = entries.get(discrims)
+                if entry is not None:
+                    if self.bounded:
+                        self.lock.acquire()
+                        try:
+                            self._touch((url, discrims))
+                        finally:
+                            self.lock.release()
+                    return entry
+
+    def stats(self):
+        """ Return a dict of the number of entries, the bytes they hold
+        and the counters above, for the middleware's metrics.
+        """
+        return {'storage_entries': len(self._links),
+                'storage_bytes': self.size,
+                'storage_evictions': self.evictions,
+                'storage_evicted_bytes': self.evicted_bytes,
+                'storage_purged': self.purged,
+                'storage_purged_bytes': self.purged_bytes,
+                'storage_compressed': self.compressed,
+                'storage_compressed_in_bytes': self.compressed_in,
+                'storage_compressed_out_bytes': self.compressed_out,
+                'storage_compress_seconds': self.compress_time,
+                'storage_oversized': self.oversized,
+                'storage_oversized_bytes': self.oversized_bytes,
+                }
+
+    def purge(self, now=None, limit=None):
+        """ Remove entries which expired before 'now' (by default, the
+        current time), at most 'limit' of them if that is not None.
+
+        o Return a tuple, '(entries, bytes)', reporting what was purged.
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            count, size = self._purge(now, limit)
+        finally:
+            self.lock.release()
+        if count:
+            logger = self.logger
+            logger and logger.info(
+                'repoze.accelerator: purged %d entries (%d bytes)',
+                count, size)
+        return count, size
+
+    def _purge(self, now, limit):
+        # Called with the lock held.
+        heap = self._expiry
+        count = size = 0
+        while heap and heap[0][0] <= now:
+            if limit is not None and count >= limit:
+                break
+            when, url, discriminators = heapq.heappop(heap)
+            entries = self.data.get(url)
+            if entries is None:
+                continue
+            entry = entries.get(discriminators)
+            if entry is None or deadline(entry.expires, entry.extras) != when:
+                continue # replaced since
+            self._remove(url, discriminators)
+            size += entry.size
+            count += 1
+        if len(heap) > 2 * len(self._links) + 64:
+            # too many records for replaced or evicted entries
+            self._expiry = heap = [
+                (deadline(entry.expires, entry.extras), url, discriminators)
+                for url, entries in self.data.items()
+                for discriminators, entry in entries.items() ]
+            heapq.heapify(heap)
+        self.purged += count
+        self.purged_bytes += size
+        return count, size
+
+    def snapshot(self, path):
+        """ Save the entries which haven't expired to a snapshot file at
+        'path'.
+
+        o Return a tuple, '(entries, bytes)', reporting what was saved.
+        """
+        return _snapshot(self, [self], path)
+
+    def restore(self, path):
+        """ Load the entries saved in the snapshot file at 'path',
+        skipping those which have expired, or have been stored since.
+
+        o Return a tuple, '(entries, bytes)', reporting what was loaded.
+        """
+        return _restore(self, path)
+
+    def _live(self, now):
+        # Return the '(url, entry)' pairs of entries which haven't
+        # expired.  Entries are never changed once stored, so they may
+        # be read without the lock afterwards.
+        self.lock.acquire()
+        try:
+            return [ (url, entry)
+                     for url, entries in self.data.items()
+                     for entry in entries.values()
+                     if deadline(entry.expires, entry.extras) > now ]
+        finally:
+            self.lock.release()
+
+    def _has(self, url, discriminators):
+        return discriminators in self.data.get(url, ())
+
+    def _purge_periodically(self):
+        sleep = time.sleep # module globals vanish at interpreter exit
+        while True:
+            sleep(self.purge_interval)
+            try:
+                # purge in batches, so as not to hold the lock for long
+                while self.purge(limit=100)[0] == 100:
+                    pass
+            except: #pragma NO COVER
+                logger = self.logger
+                logger and logger.exception('repoze.accelerator: purge')
+
+    def _remove(self, url, discriminators):
+        # Called with the lock held:  forget an entry, returning it (or
+        # None if there was none).
         entries = self.data.get(url)
         if entries is None:
             return None
-        L = []
-        for discrims, (expires,status,headers,body,extras) in entries.items():
-            L.append((discrims, expires, status, headers, body, extras))
-        return L
+        entry = entries.pop(discriminators, None)
+        if entry is None:
+            return None
+        if entries:
+            self.views[url] = tuple(entries.values())
+        else:
+            del self.data[url]
+            del self.views[url]
+        self.size -= entry.size
+        variants = self.index.get(url)
+        if variants is not None:
+            names, values = split_discriminators(discriminators)
+            table = variants.get(names)
+            if table is not None:
+                table.pop(values, None)
+                if not table:
+                    del variants[names]
+                    if not variants:
+                        del self.index[url]
+        self._unlink((url, discriminators))
+        return entry
+
+    def _link(self, key):
+        # Called with the lock held:  insert 'key' as the most recently
+        # used entry.
+        root = self._root
+        last = root[PREV]
+        link = [last, root, key]
+        last[NEXT] = root[PREV] = self._links[key] = link
+
+    def _unlink(self, key):
+        link = self._links.pop(key, None)
+        if link is not None:
+            prev, next = link[PREV], link[NEXT]
+            prev[NEXT] = next
+            next[PREV] = prev
+
+    def _touch(self, key):
+        link = self._links.get(key)
+        if link is not None:
+            prev, next = link[PREV], link[NEXT]
+            prev[NEXT] = next
+            next[PREV] = prev
+            root = self._root
+            last = root[PREV]
+            link[PREV], link[NEXT] = last, root
+            last[NEXT] = root[PREV] = link
+
+    def _evict(self):
+        # Called with the lock held:  drop least recently used entries
+        # until we are back within our budget.
+        root = self._root
+        while ((self.max_size and self.size > self.max_size) or
+               (self.max_entries and len(self._links) > self.max_entries)):
+            link = root[NEXT]
+            if link is root:
+                break
+            url, discriminators = link[KEY]
+            entry = self._remove(url, discriminators)
+            self.evictions += 1
+            self.evicted_bytes += entry.size
+
+class MemoryBody(list):
+    """ A cached body:  a list holding its chunks joined into one (or
+    nothing, if the body is empty), which knows its 'length'.
+    """
+    __slots__ = ('length',)
+
+    def __init__(self, chunks=()):
+        body = ''.join(chunks)
+        if body:
+            list.__init__(self, (body,))
+        self.length = len(body)
+
+class CompressedBody(object):
+    """ A cached body kept gzip-compressed, which is decompressed in
+    blocks of at most BLOCK_SIZE bytes as it is iterated over, and
+    knows its uncompressed 'length'.
+    """
+    __slots__ = ('data', 'length')
+
+    def __init__(self, data, length):
+        self.data = data
+        self.length = length
+
+    def __iter__(self):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = self.data
+        while data:
+            block = decompressor.decompress(data, BLOCK_SIZE)
+            data = decompressor.unconsumed_tail
+            if block:
+                yield block
+        block = decompressor.flush()
+        if block:
+            yield block
+
+def with_content_length(headers, length):
+    """ Return 'headers', plus a Content-Length header for a body of
+    'length' bytes if they have none.
+
+    o Empty bodies get none, as they may be responses to HEAD requests.
+    """
+    if length:
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                break
+        else:
+            return list(headers) + [('Content-Length', str(length))]
+    return headers
+
+def _encoded(headers):
+    for name, value in headers:
+        if (name.lower() == 'content-encoding' and
+            value.strip().lower() != 'identity'):
+            return True
+    return False
+
+def _declared_length(headers):
+    # the Content-Length of a response, or 0 if it has none we understand
+    for name, value in headers:
+        if name.lower() == 'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                break
+    return 0
+
+def intern_headers(headers):
+    """ Return a copy of 'headers' sharing the strings of header names,
+    and of values which are commonly the same, with other entries.
+    """
+    L = []
+    for name, value in headers:
+        if type(name) is str:
+            name = intern(name)
+            if type(value) is str and name.lower() in SHARED_VALUE_HEADERS:
+                value = intern(value)
+        L.append((name, value))
+    return L
+
+class ShardedMemoryStorage(object):
+    """ Spread cached responses over 'segments' MemoryStorage segments
+    by the hash of their URL, each with its own lock.
+
+    o Stores (and, for bounded storages, fetches) of URLs in different
+      segments don't wait for each other.  Fetches see an entry either
+      before or after a store is complete, never in between.
+
+    o 'max_size' and 'max_entries' are split evenly between segments.
+      A single thread purges all of them every 'purge_interval'
+      seconds, if that is nonzero.
+    """
+    implements(IVariantStorage, IStatsStorage)
+
+    def __init__(self, logger, segments=16, max_size=0, max_entries=0,
+                 purge_batch=8, purge_interval=0, compress_min_size=0,
+                 max_object_size=0):
+        self.logger = logger
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.max_object_size = max_object_size
+        self.purge_interval = purge_interval
+        self.restoring = False
+        self.segments = [
+            MemoryStorage(logger,
+                          max_size=_share(max_size, segments),
+                          max_entries=_share(max_entries, segments),
+                          purge_batch=purge_batch,
+                          compress_min_size=compress_min_size,
+                          max_object_size=max_object_size)
+            for i in range(segments) ]
+        if purge_interval:
+            thread = threading.Thread(target=self._purge_periodically)
+            thread.setDaemon(True)
+            thread.start()
+
+    def segment(self, url):
+        segments = self.segments
+        return segments[hash(url) % len(segments)]
+
+    def store(self, url, discriminators, expires, status, headers, **extras):
+        return self.segment(url).store(url, discriminators, expires, status,
+                                       headers, **extras)
+
+    def fetch(self, url):
+        return self.segment(url).fetch(url)
+
+    def fetch_variant(self, url, resolve):
+        return self.segment(url).fetch_variant(url, resolve)
+
+    def stats(self):
+        """ As 'MemoryStorage.stats', totalled over the segments.
+        """
+        totals = {}
+        for segment in self.segments:
+            for name, value in segment.stats().items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def purge(self, now=None, limit=None):
+        """ Remove entries which expired before 'now' (by default, the
+        current time), at most 'limit' of them from each segment if that
+        is not None.
+
+        o Return a tuple, '(entries, bytes)', reporting what was purged.
+        """
+        count = size = 0
+        for segment in self.segments:
+            purged = segment.purge(now, limit)
+            count += purged[0]
+            size += purged[1]
+        return count, size
+
+    def snapshot(self, path):
+        """ As 'MemoryStorage.snapshot'.
+        """
+        return _snapshot(self, self.segments, path)
+
+    def restore(self, path):
+        """ As 'MemoryStorage.restore'.
+        """
+        return _restore(self, path)
+
+    def _has(self, url, discriminators):
+        return self.segment(url)._has(url, discriminators)
+
+    def _purge_periodically(self):
+        sleep = time.sleep # module globals vanish at interpreter exit
+        while True:
+            sleep(self.purge_interval)
+            for segment in self.segments:
+                try:
+                    while segment.purge(limit=100)[0] == 100:
+                        pass
+                except: #pragma NO COVER
+                    logger = self.logger
+                    logger and logger.exception('repoze.accelerator: purge')
+
+    def _total(name):
+        def total(self):
+            return sum([ getattr(segment, name) for segment in self.segments ])
+        return property(total)
+
+    size = _total('size')
+    evictions = _total('evictions')
+    evicted_bytes = _total('evicted_bytes')
+    purged = _total('purged')
+    purged_bytes = _total('purged_bytes')
+    compressed = _total('compressed')
+    compressed_in = _total('compressed_in')
+    compressed_out = _total('compressed_out')
+    compress_time = _total('compress_time')
+    oversized = _total('oversized')
+    oversized_bytes = _total('oversized_bytes')
+    del _total
+
+    compression_ratio = property(_compression_ratio)
+
+def _snapshot(storage, segments, path):
+    now = time.time()
+    live = []
+    for segment in segments:
+        live.extend(segment._live(now))
+    records = ( (url, entry.discriminators, entry.expires, entry.status,
+                 entry.headers, entry.extras, ''.join(entry.body))
+                for url, entry in live )
+    count, size = write_snapshot(path, records)
+    logger = storage.logger
+    logger and logger.info(
+        'repoze.accelerator: saved %d entries (%d bytes) to %s',
+        count, size, path)
+    return count, size
+
+def _restore(storage, path):
+    storage.restoring = True
+    try:
+        count = size = 0
+        for (url, discriminators, expires, status, headers, extras,
+             body) in read_snapshot(path):
+            if deadline(expires, extras) <= time.time():
+                continue
+            if storage._has(url, discriminators):
+                continue # a fresher response has been stored meanwhile
+            handler = storage.store(url, discriminators, expires, status,
+                                    headers, **extras)
+            handler.write(body)
+            handler.close()
+            count += 1
+            size += len(body)
+    finally:
+        storage.restoring = False
+    logger = storage.logger
+    logger and logger.info(
+        'repoze.accelerator: loaded %d entries (%d bytes) from %s',
+        count, size, path)
+    return count, size
+
+def enable_snapshots(storage, path, signal_name=None):
+    """ Arrange for 'storage' to be loaded from the snapshot at 'path'
+    in the background, if it exists, and saved to it at exit, and when
+    the process receives the signal named 'signal_name' (e.g. 'SIGUSR2')
+    if that is not None.
+
+    o Signal handlers may only be installed from the main thread;
+      called from another one (e.g. by a server loading applications in
+      a worker thread), no handler is installed, and a warning logged.
+    """
+    logger = storage.logger
+
+    def save():
+        if storage.restoring:
+            # don't replace a complete snapshot with part of it
+            logger and logger.warning(
+                'repoze.accelerator: not saving %s while loading it', path)
+            return
+        try:
+            storage.snapshot(path)
+        except: #pragma NO COVER
+            logger and logger.exception(
+                'repoze.accelerator: saving %s failed', path)
+
+    def load():
+        try:
+            storage.restore(path)
+        except: #pragma NO COVER
+            logger and logger.exception(
+                'repoze.accelerator: loading %s failed', path)
+
+    if os.path.exists(path):
+        storage.restoring = True # until the thread gets going
+        thread = threading.Thread(target=load)
+        thread.setDaemon(True)
+        thread.start()
+
+    atexit.register(save)
+
+    if signal_name:
+        def handler(signum, frame):
+            # the interrupted thread may hold the storage's lock
+            thread = threading.Thread(target=save)
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            signal.signal(getattr(signal, signal_name), handler)
+        except ValueError: # not in the main thread
+            logger and logger.warning(
+                'repoze.accelerator: not saving %s on %s:  signal '
+                'handlers may only be installed from the main thread',
+                path, signal_name)
+
+def _share(total, parts):
+    # each part's share of a nonzero 'total', rounded up
+    if not total:
+        return 0
+    return max(-(-total // parts), 1)
+
+def split_discriminators(discriminators):
+    """ Split discriminators into a tuple of their '(type, name)' pairs
+    and a tuple of their values.
+    """
+    names = tuple([ (typ, name) for typ, (name, value) in discriminators ])
+    values = tuple([ value for typ, (name, value) in discriminators ])
+    return names, values
+
+def deadline(expires, extras):
+    """ Return the time after which an entry may be discarded.
+    """
+    return max(expires, extras.get('stale_until', expires))
+
+def entry_size(discriminators, headers, body, extras=None):
+    """ Approximate the number of bytes a cache entry occupies.
+    """
+    size = 0
+    for chunk in body:
+        size += len(chunk)
+    if extras:
+        # compressed copies of the body (see 'encoding.EncodingHandler')
+        for data in (extras.get('encodings') or {}).values():
+            size += len(data)
+    for name, value in headers:
+        size += len(name) + len(value)
+    for typ, (name, value) in discriminators:
+        size += len(typ) + len(name) + len(str(value))
+    return size
 
 def make_memory_storage(logger, config):
-    return MemoryStorage(logger)
+    max_size = int(config.get('storage.max_size', 0))
+    max_entries = int(config.get('storage.max_entries', 0))
+    purge_batch = int(config.get('storage.purge_batch', 8))
+    purge_interval = float(config.get('storage.purge_interval', 0))
+    segments = int(config.get('storage.segments', 1))
+    compress_min_size = int(config.get('storage.compress_min_size', 0))
+    max_object_size = int(config.get('storage.max_object_size', 0))
+    if segments > 1:
+        storage = ShardedMemoryStorage(logger, segments, max_size=max_size,
+                                       max_entries=max_entries,
+                                       purge_batch=purge_batch,
+                                       purge_interval=purge_interval,
+                                       compress_min_size=compress_min_size,
+                                       max_object_size=max_object_size)
+    else:
+        storage = MemoryStorage(logger, max_size=max_size,
+                                max_entries=max_entries,
+                                purge_batch=purge_batch,
+                                purge_interval=purge_interval,
+                                compress_min_size=compress_min_size,
+                                max_object_size=max_object_size)
+    snapshot_path = config.get('storage.snapshot_path')
+    if snapshot_path:
+        enable_snapshots(storage, os.path.abspath(snapshot_path),
+                         config.get('storage.snapshot_signal') or None)
+    return storage
 directlyProvides(make_memory_storage, IStorageFactory)
-    
+
@@ -0,0 +1,337 @@
+import unittest
+
+class TestDiskStorage(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _getTargetClass(self):
+        from repoze.accelerator.diskstorage import DiskStorage
+        return DiskStorage
+
+    def _makeOne(self):
+        return self._getTargetClass()(None, self.path)
+
+    def _storeOne(self, storage, url, body, discriminators=(), expires=0,
+                  **extras):
+        handler = storage.store(url, discriminators, expires, '200 OK',
+                                [('Content-Type', 'text/plain')], **extras)
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def test_class_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IStorage
+        verifyClass(IStorage, self._getTargetClass())
+
+    def test_class_conforms_to_IVariantStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IVariantStorage
+        verifyClass(IVariantStorage, self._getTargetClass())
+
+    def test_instance_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorage
+        verifyObject(IStorage, self._makeOne())
+
+    def test_factory_provides_IStorageFactory(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorageFactory
+        from repoze.accelerator.diskstorage import make_disk_storage
+        verifyObject(IStorageFactory, make_disk_storage)
+
+    def test_factory(self):
+        import os
+        from repoze.accelerator.diskstorage import make_disk_storage
+        path = os.path.join(self.path, 'cache')
+        storage = make_disk_storage(None, {'storage.path':path,
+                                           'storage.orphan_grace':'60'})
+        self.assertEqual(storage.path, path)
+        self.assertEqual(storage.orphan_grace, 60.0)
+        self.failUnless(os.path.isdir(path))
+
+    def test_factory_default_path(self):
+        import tempfile
+        from repoze.accelerator.diskstorage import make_disk_storage
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = self.path
+        try:
+            storage = make_disk_storage(None, {})
+        finally:
+            tempfile.tempdir = tempdir
+        self.failUnless(storage.path.startswith(self.path))
+
+    def test_fetch_nonexistent(self):
+        storage = self._makeOne()
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_store_and_fetch(self):
+        storage = self._makeOne()
+        discrims = (('env', ('REQUEST_METHOD', 'GET')),)
+        self._storeOne(storage, 'url', ['chunk1', 'chunk2'], discrims, 10,
+                       stale_until=20)
+        entries = storage.fetch('url')
+        self.assertEqual(len(entries), 1)
+        discriminators, expires, status, headers, body, extras = entries[0]
+        self.assertEqual(discriminators, discrims)
+        self.assertEqual(expires, 10)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('Content-Length', '12')])
+        self.assertEqual(extras['stale_until'], 20)
+        self.assertEqual(body.length, 12)
+        self.assertEqual(''.join(body), 'chunk1chunk2')
+
+    def test_entries_survive_restart(self):
+        self._storeOne(self._makeOne(), 'url', ['abc'])
+        entries = self._makeOne().fetch('url')
+        self.assertEqual(''.join(entries[0][4]), 'abc')
+
+    def test_store_variants(self):
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        d2 = (('vary', ('cookie', '2')),)
+        self._storeOne(storage, 'url', ['one'], d1)
+        self._storeOne(storage, 'url', ['two'], d2)
+        entries = storage.fetch('url')
+        bodies = sorted([ (entry[0], ''.join(entry[4]))
+                          for entry in entries ])
+        self.assertEqual(bodies, [(d1, 'one'), (d2, 'two')])
+
+    def test_store_replaces_variant_and_removes_old_body(self):
+        import os
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['old'])
+        self._storeOne(storage, 'url', ['new'])
+        entries = storage.fetch('url')
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(''.join(entries[0][4]), 'new')
+        directory = storage._directory('url')
+        # the metadata, body and names files
+        self.assertEqual(len(os.listdir(directory)), 3)
+
+    def test_fetch_variant(self):
+        storage = self._makeOne()
+        d1 = (('env', ('REQUEST_METHOD', 'GET')),
+              ('vary', ('accept-language', 'en')))
+        d2 = (('env', ('REQUEST_METHOD', 'GET')),
+              ('vary', ('accept-language', 'fr')))
+        d3 = (('env', ('REQUEST_METHOD', 'GET')),)
+        self._storeOne(storage, 'url', ['en'], d1)
+        self._storeOne(storage, 'url', ['fr'], d2)
+        self._storeOne(storage, 'url', ['any'], d3)
+        def resolver(**values):
+            def resolve(typ, name):
+                return values.get(name)
+            return resolve
+        entry = storage.fetch_variant(
+            'url', resolver(REQUEST_METHOD='GET', **{'accept-language':'fr'}))
+        self.assertEqual(entry[0], d2)
+        self.assertEqual(''.join(entry[4]), 'fr')
+        entry = storage.fetch_variant('url', resolver(REQUEST_METHOD='GET'))
+        self.assertEqual(''.join(entry[4]), 'any')
+        self.assertEqual(
+            storage.fetch_variant('url', resolver(REQUEST_METHOD='HEAD')),
+            None)
+        self.assertEqual(storage.fetch_variant('other', resolver()), None)
+
+    def test_fetch_variant_opens_one_body(self):
+        from repoze.accelerator import diskstorage as module
+        storage = self._makeOne()
+        for i in range(10):
+            self._storeOne(storage, 'url', [str(i)],
+                           (('vary', ('cookie', str(i))),))
+        opened = []
+        def dummy_open(path, mode='r'):
+            opened.append(path)
+            return open(path, mode)
+        module.open = dummy_open
+        try:
+            entry = storage.fetch_variant(
+                'url', lambda typ, name: '7')
+        finally:
+            del module.open
+        self.assertEqual(''.join(entry[4]), '7')
+        # the names, metadata and body files
+        self.assertEqual(len(opened), 3)
+
+    def test_fetch_variant_skips_vanished_body(self):
+        import os
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'])
+        directory = storage._directory('url')
+        for name in os.listdir(directory):
+            if name.endswith('.body'):
+                os.unlink(os.path.join(directory, name))
+        self.assertEqual(storage.fetch_variant('url', None), None)
+
+    def test_body_replaced_between_fetch_and_iteration(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['old' * 100000])
+        entries = storage.fetch('url')
+        self._storeOne(storage, 'url', ['new'])
+        self.assertEqual(''.join(entries[0][4]), 'old' * 100000)
+        self.assertEqual(''.join(storage.fetch('url')[0][4]), 'new')
+
+    def test_body_purged_between_fetch_and_iteration(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'], expires=10)
+        entries = storage.fetch('url')
+        self.assertEqual(storage.purge(now=20), (1, 3))
+        self.assertEqual(''.join(entries[0][4]), 'abc')
+
+    def test_fetch_skips_vanished_body(self):
+        import os
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'])
+        directory = storage._directory('url')
+        for name in os.listdir(directory):
+            if name.endswith('.body'):
+                os.unlink(os.path.join(directory, name))
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_unclosed_store_not_visible(self):
+        storage = self._makeOne()
+        handler = storage.store('url', (), 0, '200 OK', [])
+        handler.write('abc')
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_fetch_skips_corrupt_meta(self):
+        import os
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'])
+        directory = storage._directory('url')
+        f = open(os.path.join(directory, 'garbage.meta'), 'wb')
+        f.write('garbage')
+        f.close()
+        self.assertEqual(len(storage.fetch('url')), 1)
+
+    def test_purge(self):
+        import os
+        storage = self._makeOne()
+        storage.logger = DummyLogger()
+        self._storeOne(storage, 'url1', ['abc'], expires=10)
+        self._storeOne(storage, 'url2', ['abcd'], expires=10,
+                       stale_until=30)
+        self._storeOne(storage, 'url3', ['abcde'], expires=40)
+        f = open(os.path.join(self.path, 'garbage.meta'), 'wb')
+        f.write('garbage')
+        f.close()
+        self.assertEqual(storage.purge(now=20), (1, 3))
+        self.assertEqual(storage.fetch('url1'), None)
+        # (the names file is left for 'orphan_grace')
+        self.assertEqual([ name[-6:] for name in
+                           os.listdir(storage._directory('url1')) ],
+                         ['.names'])
+        self.failIf(storage.fetch('url2') is None)
+        self.assertEqual(storage.logger.messages,
+                         ['repoze.accelerator: purged 1 entries (3 bytes)'])
+        self.assertEqual(storage.purge(now=50), (2, 9))
+        self.assertEqual(storage.purge(), (0, 0))
+
+    def test_purge_removes_orphaned_files(self):
+        import os
+        import time
+        storage = self._makeOne()
+        storage.logger = DummyLogger()
+        now = time.time()
+        self._storeOne(storage, 'url', ['abc'], expires=now + 60)
+        self._storeOne(storage, 'url', ['def'], (('env', ('A', '1')),),
+                       expires=10)
+        handler = storage.store('url', (), now + 60, '200 OK', [])
+        handler.write('never closed')
+        directory = storage._directory('url')
+        open(os.path.join(directory, 'tmpabc.tmp'), 'wb').close()
+        self.assertEqual(storage.purge(now), (1, 3))
+        self.assertEqual(len(os.listdir(directory)), 6)
+        old = now - storage.orphan_grace
+        for name in os.listdir(directory):
+            os.utime(os.path.join(directory, name), (old, old))
+        self.assertEqual(storage.purge(now), (0, 0))
+        self.assertEqual(len(os.listdir(directory)), 3)
+        self.assertEqual(''.join(storage.fetch('url')[0][4]), 'abc')
+        self.assertEqual(storage.logger.messages,
+                         ['repoze.accelerator: purged 1 entries (3 bytes)',
+                          'repoze.accelerator: removed 3 orphaned files'])
+
+
+class TestFileBody(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp()
+        import os
+        os.write(fd, '0123456789')
+        os.close(fd)
+
+    def tearDown(self):
+        import os
+        os.unlink(self.path)
+
+    def _makeOne(self, block_size=4):
+        from repoze.accelerator.diskstorage import FileBody
+        return FileBody(self.path, 10, block_size)
+
+    def test_iter_in_blocks_and_closes(self):
+        body = self._makeOne()
+        self.assertEqual(list(body), ['0123', '4567', '89'])
+        self.assertEqual(body._file, None)
+
+    def test_iter_range(self):
+        body = self._makeOne()
+        self.assertEqual(list(body.iter_range(3, 9)), ['3456', '78'])
+
+    def test_iter_range_truncated_file(self):
+        from repoze.accelerator.diskstorage import FileBody
+        body = FileBody(self.path, 20, 4)
+        self.assertEqual(''.join(body), '0123456789')
+
+    def test_read_fileno_close(self):
+        import os
+        body = self._makeOne()
+        fileno = body.fileno()
+        self.assertEqual(os.read(fileno, 2), '01')
+        self.assertEqual(body.read(), '23456789')
+        body.close()
+        self.assertEqual(body._file, None)
+        body.close()
+
+    def test_lazy_open(self):
+        from repoze.accelerator.diskstorage import FileBody
+        FileBody('/nonexistent/path', 10).close()
+
+    def test_open_file_kept_across_ranges(self):
+        import os
+        from repoze.accelerator.diskstorage import FileBody
+        f = open(self.path, 'rb')
+        body = FileBody(self.path, 10, 4, file=f)
+        self.assertEqual(list(body.iter_range(0, 3)), ['012'])
+        os.rename(self.path, self.path + '.old')
+        try:
+            self.assertEqual(list(body.iter_range(7, 10)), ['789'])
+            self.failUnless(body._file is f)
+            body.close()
+            self.failUnless(f.closed)
+        finally:
+            os.rename(self.path + '.old', self.path)
+
+    def test_ranges(self):
+        from repoze.accelerator.ranges import body_length
+        from repoze.accelerator.ranges import slice_body
+        body = self._makeOne()
+        self.assertEqual(body_length(body), 10)
+        self.assertEqual(list(slice_body(body, 2, 5)), ['234'])
+
+
+class DummyLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg, *args):
+        self.messages.append(msg % args)
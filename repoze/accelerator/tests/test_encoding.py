@@ -0,0 +1,236 @@
+import unittest
+
+def gunzip(data):
+    import zlib
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class Test_compress(unittest.TestCase):
+
+    def _callFUT(self, name, data):
+        from repoze.accelerator.encoding import compress
+        return compress(name, data)
+
+    def test_gzip(self):
+        data = 'abc' * 100
+        encoded = self._callFUT('gzip', data)
+        self.assertEqual(encoded[:2], '\x1f\x8b')
+        self.assertEqual(gunzip(encoded), data)
+
+    def test_unknown(self):
+        self.assertRaises(KeyError, self._callFUT, 'compress', 'abc')
+
+class Test_compressible(unittest.TestCase):
+
+    def _callFUT(self, headers, min_size=0):
+        from repoze.accelerator.encoding import compressible
+        return compressible(headers, min_size)
+
+    def test_text(self):
+        self.failUnless(self._callFUT([('Content-Type',
+                                        'text/html; charset=utf-8')]))
+
+    def test_structured_suffix(self):
+        self.failUnless(self._callFUT([('content-type',
+                                        'application/ld+json')]))
+
+    def test_image(self):
+        self.failIf(self._callFUT([('Content-Type', 'image/png')]))
+
+    def test_no_content_type(self):
+        self.failIf(self._callFUT([]))
+
+    def test_encoded_already(self):
+        self.failIf(self._callFUT([('Content-Type', 'text/plain'),
+                                   ('Content-Encoding', 'gzip')]))
+
+    def test_identity_encoding(self):
+        self.failUnless(self._callFUT([('Content-Type', 'text/plain'),
+                                       ('Content-Encoding', 'identity')]))
+
+    def test_no_transform(self):
+        self.failIf(self._callFUT([('Content-Type', 'text/plain'),
+                                   ('Cache-Control',
+                                    'max-age=60, no-transform')]))
+
+    def test_content_length(self):
+        headers = [('Content-Type', 'text/plain'), ('Content-Length', '100')]
+        self.failUnless(self._callFUT(headers, 100))
+        self.failIf(self._callFUT(headers, 101))
+        self.failIf(self._callFUT([('Content-Type', 'text/plain'),
+                                   ('Content-Length', 'junk')]))
+
+    def test_content_range(self):
+        self.failIf(self._callFUT([('Content-Type', 'text/plain'),
+                                   ('Content-Range', 'bytes 0-1/10')]))
+
+class Test_negotiate(unittest.TestCase):
+
+    def _callFUT(self, header, available=('br', 'gzip')):
+        from repoze.accelerator.encoding import negotiate
+        return negotiate(header, list(available))
+
+    def test_no_header(self):
+        self.assertEqual(self._callFUT(None), None)
+        self.assertEqual(self._callFUT(''), None)
+
+    def test_nothing_available(self):
+        self.assertEqual(self._callFUT('gzip', ()), None)
+
+    def test_our_preference_on_ties(self):
+        self.assertEqual(self._callFUT('gzip, deflate, br'), 'br')
+
+    def test_quality(self):
+        self.assertEqual(self._callFUT('br;q=0.5, GZIP'), 'gzip')
+
+    def test_refused(self):
+        self.assertEqual(self._callFUT('gzip;q=0, deflate'), None)
+
+    def test_star(self):
+        self.assertEqual(self._callFUT('*'), 'br')
+        self.assertEqual(self._callFUT('br;q=0, *;q=0.5'), 'gzip')
+
+    def test_identity_preferred(self):
+        self.assertEqual(self._callFUT('identity, gzip;q=0.5'), None)
+        self.assertEqual(self._callFUT('identity;q=0.5, gzip'), 'gzip')
+
+    def test_bad_quality(self):
+        self.assertEqual(self._callFUT('gzip;q=high'), None)
+
+class Test_add_vary(unittest.TestCase):
+
+    def _callFUT(self, headers):
+        from repoze.accelerator.encoding import add_vary
+        return add_vary(headers, 'Accept-Encoding')
+
+    def test_no_vary(self):
+        self.assertEqual(self._callFUT([('Content-Type', 'text/plain')]),
+                         [('Content-Type', 'text/plain'),
+                          ('Vary', 'Accept-Encoding')])
+
+    def test_other_vary(self):
+        self.assertEqual(self._callFUT([('Vary', 'Cookie')]),
+                         [('Vary', 'Cookie, Accept-Encoding')])
+
+    def test_named_already(self):
+        self.assertEqual(self._callFUT([('Vary', 'accept-encoding')]),
+                         [('Vary', 'accept-encoding')])
+        self.assertEqual(self._callFUT([('Vary', '*')]), [('Vary', '*')])
+
+class Test_encode_response(unittest.TestCase):
+
+    def _callFUT(self, accept_encoding, headers=None,
+                 encodings=None, preferred=('br', 'gzip')):
+        from repoze.accelerator.encoding import encode_response
+        if headers is None:
+            headers = [('Content-Type', 'text/plain'),
+                       ('ETag', '"abc"'),
+                       ('Content-Length', '300')]
+        if encodings is None:
+            encodings = {'gzip': 'GZIPPED'}
+        return encode_response(headers, ['x' * 300], encodings,
+                               accept_encoding, list(preferred))
+
+    def test_identity(self):
+        headers, body = self._callFUT(None)
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('ETag', '"abc"'),
+                                   ('Content-Length', '300'),
+                                   ('Vary', 'Accept-Encoding')])
+        self.assertEqual(body, ['x' * 300])
+
+    def test_encoded(self):
+        headers, body = self._callFUT('gzip, br')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('ETag', '"abc-gzip"'),
+                                   ('Vary', 'Accept-Encoding'),
+                                   ('Content-Encoding', 'gzip'),
+                                   ('Content-Length', '7')])
+        self.assertEqual(body, ['GZIPPED'])
+
+    def test_weak_etag(self):
+        headers, body = self._callFUT(
+            'gzip', [('ETag', 'W/"abc"')])
+        self.assertEqual(headers[0], ('ETag', 'W/"abc-gzip"'))
+
+    def test_not_preferred(self):
+        headers, body = self._callFUT('gzip', preferred=('br',))
+        self.assertEqual(body, ['x' * 300])
+
+class TestEncodingHandler(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.accelerator.encoding import EncodingHandler
+        return EncodingHandler
+
+    def _makeOne(self, handler, encodings, min_size=0):
+        return self._getTargetClass()(handler, encodings, ['gzip'], min_size)
+
+    def test_class_conforms_to_IChunkHandler(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IChunkHandler
+        verifyClass(IChunkHandler, self._getTargetClass())
+
+    def test_encodes_before_closing(self):
+        encodings = {}
+        inner = DummyHandler(encodings)
+        handler = self._makeOne(inner, encodings)
+        handler.write('abc' * 50)
+        handler.write('def' * 50)
+        self.assertEqual(inner.chunks, ['abc' * 50, 'def' * 50])
+        self.failIf(inner.closed)
+        handler.close()
+        self.failUnless(inner.closed)
+        self.assertEqual(inner.encodings_at_close.keys(), ['gzip'])
+        self.assertEqual(gunzip(encodings['gzip']), 'abc' * 50 + 'def' * 50)
+
+    def test_too_small(self):
+        encodings = {}
+        inner = DummyHandler(encodings)
+        handler = self._makeOne(inner, encodings, min_size=1000)
+        handler.write('abc' * 50)
+        handler.close()
+        self.failUnless(inner.closed)
+        self.assertEqual(encodings, {})
+
+    def test_incompressible(self):
+        import os
+        encodings = {}
+        handler = self._makeOne(DummyHandler(encodings), encodings)
+        handler.write(os.urandom(500))
+        handler.close()
+        self.assertEqual(encodings, {})
+
+    def test_empty(self):
+        encodings = {}
+        handler = self._makeOne(DummyHandler(encodings), encodings)
+        handler.close()
+        self.assertEqual(encodings, {})
+
+    def test_stops_when_discarding(self):
+        encodings = {}
+        inner = DummyHandler(encodings)
+        handler = self._makeOne(inner, encodings)
+        handler.write('abc' * 50)
+        inner.discarding = True
+        handler.write('def' * 50)
+        self.assertEqual(handler.encoders, [])
+        self.failUnless(handler.discarding)
+        self.assertEqual(inner.chunks, ['abc' * 50, 'def' * 50])
+        handler.close()
+        self.failUnless(inner.closed)
+        self.assertEqual(encodings, {})
+
+class DummyHandler:
+
+    closed = False
+
+    def __init__(self, encodings):
+        self.encodings = encodings
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def close(self):
+        self.closed = True
+        self.encodings_at_close = dict(self.encodings)
@@ -70,3 +70,119 @@ class TestLoggerFactory(unittest.TestCase):
         logger = f(config)
         self.failUnless(isinstance(logger, logging.Logger))
         self.assertEqual(logger.level, logging.DEBUG)
+
+    def test_queue_size(self):
+        import logging
+        import sys
+        from repoze.accelerator.logger import QueueHandler
+        f = self._getFUT()
+        config = {'logger.filename':'stdout',
+                  'logger.queue_size':'100'}
+        logger = f(config)
+        self.failUnless(isinstance(logger, logging.Logger))
+        handler = logger.handlers[0]
+        self.failUnless(isinstance(handler, QueueHandler))
+        self.assertEqual(handler.queue.maxsize, 100)
+        self.assertEqual(handler.target.stream, sys.stdout)
+        handler.close()
+
+class TestQueueHandler(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.accelerator.logger import QueueHandler
+        return QueueHandler
+
+    def _makeOne(self, target, queue_size=10):
+        handler = self._getTargetClass()(target, queue_size)
+        self.handlers.append(handler)
+        return handler
+
+    def setUp(self):
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.target.gate.set()
+            handler.close()
+
+    def _makeLogger(self, handler):
+        import logging
+        logger = logging.Logger('test')
+        logger.addHandler(handler)
+        return logger
+
+    def test_records_written_by_thread(self):
+        import threading
+        target = DummyTarget()
+        handler = self._makeOne(target)
+        logger = self._makeLogger(handler)
+        logger.info('a %s %d', 'b', 1)
+        handler.close()
+        self.failIf(handler.thread.isAlive())
+        self.assertEqual(target.messages, ['a b 1'])
+        self.failIf(target.threads[0] is threading.currentThread())
+        self.failUnless(target.closed)
+
+    def test_not_formatted_below_level(self):
+        import logging
+        target = DummyTarget()
+        logger = self._makeLogger(self._makeOne(target))
+        logger.setLevel(logging.WARNING)
+        class Unformattable:
+            def __str__(self): #pragma NO COVER
+                raise AssertionError('formatted')
+        logger.info('%s', Unformattable())
+        self.assertEqual(logger.handlers[0].queue.qsize(), 0)
+
+    def test_overflow_dropped_and_counted(self):
+        target = DummyTarget()
+        target.gate.clear()
+        handler = self._makeOne(target, queue_size=2)
+        logger = self._makeLogger(handler)
+        logger.info('first') # taken by the thread, which blocks
+        target.started.wait(5)
+        for i in range(5):
+            logger.info('more %d', i)
+        self.assertEqual(handler.dropped, 3)
+        target.gate.set()
+        handler.close()
+        self.assertEqual(target.messages, ['first', 'more 0', 'more 1'])
+
+    def test_exception_formatted_at_once(self):
+        target = DummyTarget()
+        handler = self._makeOne(target)
+        logger = self._makeLogger(handler)
+        try:
+            raise ValueError('oops')
+        except ValueError:
+            logger.exception('failed')
+        handler.close()
+        self.failUnless(target.messages[0].startswith('failed\n'))
+        self.failUnless('ValueError: oops' in target.messages[0])
+
+class DummyTarget(object):
+
+    closed = False
+
+    def __init__(self):
+        import logging
+        import threading
+        self.formatter = logging.Formatter()
+        self.messages = []
+        self.threads = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def format(self, record):
+        return self.formatter.format(record)
+
+    def handle(self, record):
+        import threading
+        self.started.set()
+        self.gate.wait(5)
+        self.threads.append(threading.currentThread())
+        self.messages.append(self.format(record))
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,140 @@
+import unittest
+
+class TestMetrics(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.accelerator.metrics import Metrics
+        return Metrics
+
+    def _makeOne(self, *arg, **kw):
+        klass = self._getTargetClass()
+        return klass(*arg, **kw)
+
+    def test_empty(self):
+        metrics = self._makeOne()
+        self.assertEqual(metrics.counters(), {})
+        self.assertEqual(metrics.histograms(), {})
+        self.assertEqual(metrics.gauges(), {})
+        self.assertEqual(metrics.render(), '\n')
+
+    def test_incr(self):
+        metrics = self._makeOne()
+        metrics.incr('hits')
+        metrics.incr('hits')
+        metrics.incr('hit_bytes', 10)
+        self.assertEqual(metrics.counters(), {'hits': 2, 'hit_bytes': 10})
+
+    def test_observe(self):
+        metrics = self._makeOne(buckets=(0.1, 1.0))
+        metrics.observe('hit_seconds', 0.05)
+        metrics.observe('hit_seconds', 0.1)
+        metrics.observe('hit_seconds', 0.5)
+        metrics.observe('hit_seconds', 2.0)
+        counts, total = metrics.histograms()['hit_seconds']
+        self.assertEqual(counts, [2, 1, 1])
+        self.assertEqual(total, 2.65)
+
+    def test_histograms_copies(self):
+        metrics = self._makeOne(buckets=(1.0,))
+        metrics.observe('hit_seconds', 0.5)
+        counts, total = metrics.histograms()['hit_seconds']
+        counts[0] = 100
+        self.assertEqual(metrics.histograms()['hit_seconds'], ([1, 0], 0.5))
+
+    def test_threads_summed(self):
+        import threading
+        metrics = self._makeOne(buckets=(1.0,))
+        metrics.incr('hits')
+        metrics.observe('hit_seconds', 0.5)
+        done = threading.Event()
+        stop = threading.Event()
+        def run():
+            metrics.incr('hits', 2)
+            metrics.observe('hit_seconds', 2.0)
+            done.set()
+            stop.wait(5)
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            done.wait(5)
+            self.assertEqual(len(metrics._shards), 2)
+            self.assertEqual(metrics.counters(), {'hits': 3})
+            self.assertEqual(metrics.histograms(),
+                             {'hit_seconds': ([1, 1], 2.5)})
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_dead_threads_retired(self):
+        import threading
+        metrics = self._makeOne(buckets=(1.0,))
+        metrics.incr('hits')
+        def run():
+            metrics.incr('hits', 2)
+            metrics.observe('hit_seconds', 2.0)
+        for i in range(3):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        self.assertEqual(metrics.counters(), {'hits': 7})
+        self.assertEqual(len(metrics._shards), 1)
+        self.assertEqual(metrics.histograms(),
+                         {'hit_seconds': ([0, 3], 6.0)})
+
+    def test_gauges(self):
+        metrics = self._makeOne()
+        metrics.collectors.append(lambda: {'storage_entries': 2})
+        metrics.collectors.append(lambda: {'storage_bytes': 10})
+        self.assertEqual(metrics.gauges(),
+                         {'storage_entries': 2, 'storage_bytes': 10})
+
+    def test_render(self):
+        metrics = self._makeOne(buckets=(0.5, 1.0))
+        metrics.incr('hits', 3)
+        metrics.incr('bypasses{reason="method"}')
+        metrics.incr('bypasses{reason="status"}', 2)
+        metrics.observe('hit_seconds', 0.25)
+        metrics.observe('hit_seconds', 2.0)
+        metrics.collectors.append(lambda: {'storage_entries': 4})
+        self.assertEqual(metrics.render().splitlines(), [
+            '# TYPE repoze_accelerator_bypasses_total counter',
+            'repoze_accelerator_bypasses_total{reason="method"} 1',
+            'repoze_accelerator_bypasses_total{reason="status"} 2',
+            '# TYPE repoze_accelerator_hits_total counter',
+            'repoze_accelerator_hits_total 3',
+            '# TYPE repoze_accelerator_hit_seconds histogram',
+            'repoze_accelerator_hit_seconds_bucket{le="0.5"} 1',
+            'repoze_accelerator_hit_seconds_bucket{le="1.0"} 1',
+            'repoze_accelerator_hit_seconds_bucket{le="+Inf"} 2',
+            'repoze_accelerator_hit_seconds_sum 2.25',
+            'repoze_accelerator_hit_seconds_count 2',
+            '# TYPE repoze_accelerator_storage_entries gauge',
+            'repoze_accelerator_storage_entries 4',
+            ])
+
+    def test_render_histogram_labels(self):
+        metrics = self._makeOne(buckets=(1.0,))
+        metrics.observe('seconds{path="hit"}', 0.5)
+        self.assertEqual(metrics.render().splitlines(), [
+            '# TYPE repoze_accelerator_seconds histogram',
+            'repoze_accelerator_seconds_bucket{path="hit",le="1.0"} 1',
+            'repoze_accelerator_seconds_bucket{path="hit",le="+Inf"} 1',
+            'repoze_accelerator_seconds_sum{path="hit"} 0.5',
+            'repoze_accelerator_seconds_count{path="hit"} 1',
+            ])
+
+class Test_incr(unittest.TestCase):
+    def _callFUT(self, environ, name, value=1):
+        from repoze.accelerator.metrics import incr
+        return incr(environ, name, value)
+
+    def test_no_metrics(self):
+        self._callFUT({}, 'hits') # doesn't raise
+
+    def test_metrics(self):
+        from repoze.accelerator.metrics import METRICS_KEY
+        from repoze.accelerator.metrics import Metrics
+        metrics = Metrics()
+        environ = {METRICS_KEY: metrics}
+        self._callFUT(environ, 'hits')
+        self._callFUT(environ, 'hits', 2)
+        self.assertEqual(metrics.counters(), {'hits': 3})
@@ -33,6 +33,40 @@ class TestAcceleratorMiddleware(unittest.TestCase):
                          [('X-Cached-By', 'repoze.accelerator')])
         self.assertEqual(start_response.exc_info, None)
 
+    def test_call_fetch_from_cache_file_wrapper(self):
+        app = DummyApp()
+        body = DummyFileBody()
+        policy = DummyPolicy(result=('200 OK', [], body))
+        environ = self._makeEnviron()
+        environ['wsgi.file_wrapper'] = DummyFileWrapper
+        accelerator = self._makeOne(app, policy)
+        start_response = DummyStartResponse()
+        result = accelerator(environ, start_response)
+        self.failUnless(isinstance(result, DummyFileWrapper))
+        self.failUnless(result.filelike is body)
+        self.assertEqual(result.block_size, 1 << 16)
+        self.assertEqual(start_response.status, '200 OK')
+
+    def test_call_fetch_from_cache_file_wrapper_not_a_file(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['abc']))
+        environ = self._makeEnviron()
+        environ['wsgi.file_wrapper'] = DummyFileWrapper
+        accelerator = self._makeOne(app, policy)
+        start_response = DummyStartResponse()
+        result = accelerator(environ, start_response)
+        self.assertEqual(result, ['abc'])
+
+    def test_call_fetch_from_cache_no_file_wrapper(self):
+        app = DummyApp()
+        body = DummyFileBody()
+        policy = DummyPolicy(result=('200 OK', [], body))
+        environ = self._makeEnviron()
+        accelerator = self._makeOne(app, policy)
+        start_response = DummyStartResponse()
+        result = accelerator(environ, start_response)
+        self.failUnless(result is body)
+
     def test_call_nofetch_start_response_not_called(self):
         app = DummyApp()
         app.call_start_response = False
@@ -71,6 +105,571 @@ class TestAcceleratorMiddleware(unittest.TestCase):
         self.assertEqual(policy.handler.chunks, ['hello', 'world'])
         self.assertEqual(policy.handler.closed, True)
 
+    def test_call_no_coalescing_by_default(self):
+        app = DummyApp()
+        policy = DummyCoalescingPolicy([None], key='key')
+        environ = self._makeEnviron()
+        accelerator = self._makeOne(app, policy)
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['hello', 'world'])
+        self.assertEqual(policy.keyed, 0)
+
+    def test_call_coalescing_noncoalescing_policy(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=None)
+        environ = self._makeEnviron()
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['hello', 'world'])
+        self.assertEqual(accelerator.inflight, {})
+
+    def test_call_coalescing_uncacheable_request(self):
+        app = DummyApp()
+        policy = DummyCoalescingPolicy([None], key=None)
+        environ = self._makeEnviron()
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['hello', 'world'])
+        self.assertEqual(policy.keyed, 1)
+        self.assertEqual(accelerator.inflight, {})
+
+    def test_call_coalescing_leader_releases_after_close(self):
+        app = DummyApp()
+        policy = DummyCoalescingPolicy([None], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        handler = DummyHandler()
+        policy.handler = handler
+        def close():
+            self.failUnless('key' in accelerator.inflight)
+            handler.closed = True
+        handler.close = close
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        generator = accelerator(environ, start_response)
+        self.assertEqual(generator.next(), 'hello')
+        event = accelerator.inflight['key']
+        self.failIf(event.isSet())
+        self.assertEqual(list(generator), ['world'])
+        self.failUnless(handler.closed)
+        self.failUnless(event.isSet())
+        self.assertEqual(accelerator.inflight, {})
+
+    def test_call_coalescing_leader_releases_early_when_not_storing(self):
+        app = DummyApp()
+        policy = DummyCoalescingPolicy([None], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        generator = accelerator(environ, start_response)
+        self.assertEqual(generator.next(), 'hello')
+        self.assertEqual(accelerator.inflight, {})
+
+    def test_call_coalescing_leader_releases_on_app_error(self):
+        def app(environ, start_response):
+            raise ValueError
+        policy = DummyCoalescingPolicy([None], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        self.assertRaises(ValueError, list, accelerator(environ,
+                                                        start_response))
+        self.assertEqual(accelerator.inflight, {})
+
+    def test_call_coalescing_waiter_served_from_cache(self):
+        import threading
+        app = DummyApp()
+        policy = DummyCoalescingPolicy(
+            [None, ('200 OK', [], ['cached'])], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        event = threading.Event()
+        event.set()
+        accelerator.inflight['key'] = event
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['cached'])
+        self.assertEqual(policy.fetched, 2)
+        self.failIf(hasattr(app, 'environ'))
+        self.failUnless(accelerator.inflight['key'] is event)
+
+    def test_call_coalescing_waiter_served_from_cache_closes(self):
+        import threading
+        app = DummyApp()
+        closed = []
+        content = DummyResult(['cached'])
+        content.close = lambda: closed.append(True)
+        policy = DummyCoalescingPolicy(
+            [None, ('200 OK', [], content)], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        event = threading.Event()
+        event.set()
+        accelerator.inflight['key'] = event
+        environ = self._makeEnviron()
+        environ['wsgi.file_wrapper'] = DummyFileWrapper
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['cached'])
+        self.assertEqual(closed, [True])
+
+    def test_call_coalescing_waiter_misses_after_wait(self):
+        import threading
+        app = DummyApp()
+        policy = DummyCoalescingPolicy([None, None], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 1
+        event = threading.Event()
+        event.set()
+        accelerator.inflight['key'] = event
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['hello', 'world'])
+        self.assertEqual(policy.fetched, 2)
+        self.failUnless(accelerator.inflight['key'] is event)
+
+    def test_call_coalescing_waiter_times_out(self):
+        import threading
+        app = DummyApp()
+        policy = DummyCoalescingPolicy([None], key='key')
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 0.01
+        event = threading.Event()
+        accelerator.inflight['key'] = event
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['hello', 'world'])
+        self.assertEqual(policy.fetched, 1)
+
+    def test_call_coalescing_threaded(self):
+        import threading
+        from repoze.accelerator.policy import AcceleratorPolicy
+        from repoze.accelerator.storage import MemoryStorage
+        gate = threading.Event()
+        calls = []
+        def app(environ, start_response):
+            calls.append(environ)
+            gate.wait(5)
+            start_response('200 OK', [('Cache-Control', 'max-age=60')])
+            return ['rendered']
+        policy = AcceleratorPolicy(None, MemoryStorage(None))
+        accelerator = self._makeOne(app, policy)
+        accelerator.coalesce_timeout = 5
+        results = []
+        def request():
+            environ = self._makeEnviron()
+            environ.update({'wsgi.url_scheme':'http',
+                            'SERVER_NAME':'example.com',
+                            'SERVER_PORT':'80',
+                            'REQUEST_METHOD':'GET'})
+            results.append(list(accelerator(environ, DummyStartResponse())))
+        threads = [threading.Thread(target=request) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        import time
+        while not calls:
+            time.sleep(0.001)
+        time.sleep(0.05) # let the others start waiting
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['rendered']] * 5)
+
+    def test_call_stale_hit_submits_refresh(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['stale']))
+        accelerator = self._makeOne(app, policy)
+        refresher = accelerator.refresher = DummyRefresher()
+        environ = self._makeEnviron()
+        environ['repoze.accelerator.stale'] = ('url', ())
+        environ['HTTP_IF_NONE_MATCH'] = 'foo'
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['stale'])
+        self.assertEqual(len(refresher.submitted), 1)
+        key, func, args = refresher.submitted[0]
+        self.assertEqual(key, ('url', ()))
+        self.assertEqual(func, accelerator._refresh)
+        refresh_environ, = args
+        self.failIf(refresh_environ is environ)
+        self.failIf('repoze.accelerator.stale' in refresh_environ)
+        self.failIf('HTTP_IF_NONE_MATCH' in refresh_environ)
+        self.assertEqual(refresh_environ['wsgi.input'].read(), '')
+        self.assertEqual(refresh_environ['PATH_INFO'], '/')
+
+    def test_call_fresh_hit_submits_no_refresh(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['fresh']))
+        accelerator = self._makeOne(app, policy)
+        refresher = accelerator.refresher = DummyRefresher()
+        environ = self._makeEnviron()
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['fresh'])
+        self.assertEqual(refresher.submitted, [])
+
+    def test_refresh_stores(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        policy.handler = DummyHandler()
+        accelerator = self._makeOne(app, policy)
+        accelerator._refresh(self._makeEnviron())
+        self.assertEqual(policy.handler.chunks, ['hello', 'world'])
+        self.failUnless(policy.handler.closed)
+
+    def test_refresh_discarded_not_counted_as_store(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        policy.handler = DummyHandler()
+        policy.handler.discarding = True
+        accelerator = self._makeOne(app, policy)
+        accelerator._refresh(self._makeEnviron())
+        self.failUnless(policy.handler.closed)
+        self.assertEqual(accelerator.metrics.counters(), {'refreshes': 1})
+
+    def test_refresh_cantstore(self):
+        app = DummyApp(headers=[('a', 'b')])
+        closed = []
+        def close():
+            closed.append(True)
+        def _app(environ, start_response):
+            result = DummyResult(app(environ, start_response))
+            result.close = close
+            return result
+        policy = DummyPolicy(result=None)
+        accelerator = self._makeOne(_app, policy)
+        accelerator._refresh(self._makeEnviron())
+        self.assertEqual(closed, [True])
+
+    def test_refresh_start_response_not_called(self):
+        app = DummyApp()
+        app.call_start_response = False
+        policy = DummyPolicy(result=None)
+        accelerator = self._makeOne(app, policy)
+        self.assertRaises(RuntimeError, accelerator._refresh,
+                          self._makeEnviron())
+
+    def test_call_hit_counted(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['abc', 'def']))
+        accelerator = self._makeOne(app, policy)
+        list(accelerator(self._makeEnviron(), DummyStartResponse()))
+        metrics = accelerator.metrics
+        self.assertEqual(metrics.counters(), {'hits': 1, 'hit_bytes': 6})
+        counts, total = metrics.histograms()['hit_seconds']
+        self.assertEqual(sum(counts), 1)
+
+    def test_call_hit_counted_content_length(self):
+        app = DummyApp()
+        body = DummyFileBody()
+        policy = DummyPolicy(result=('200 OK', [('Content-Length', '12')],
+                                     body))
+        accelerator = self._makeOne(app, policy)
+        accelerator(self._makeEnviron(), DummyStartResponse())
+        self.assertEqual(accelerator.metrics.counters()['hit_bytes'], 12)
+
+    def test_call_miss_counted(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        policy.handler = DummyHandler()
+        accelerator = self._makeOne(app, policy)
+        list(accelerator(self._makeEnviron(), DummyStartResponse()))
+        metrics = accelerator.metrics
+        self.assertEqual(metrics.counters(), {'misses': 1, 'stores': 1})
+        counts, total = metrics.histograms()['miss_seconds']
+        self.assertEqual(sum(counts), 1)
+
+    def test_call_miss_discarded_not_counted_as_store(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        policy.handler = DummyHandler()
+        policy.handler.discarding = True
+        accelerator = self._makeOne(app, policy)
+        list(accelerator(self._makeEnviron(), DummyStartResponse()))
+        self.failUnless(policy.handler.closed)
+        self.assertEqual(accelerator.metrics.counters(), {'misses': 1})
+
+    def test_call_miss_oversized_not_counted_as_store(self):
+        from repoze.accelerator.policy import AcceleratorPolicy
+        from repoze.accelerator.storage import MemoryStorage
+        app = DummyApp(headers=[('Cache-Control', 'max-age=60')])
+        storage = MemoryStorage(None, max_object_size=5)
+        accelerator = self._makeOne(app, AcceleratorPolicy(None, storage))
+        environ = self._makeEnviron()
+        environ.update({'wsgi.url_scheme':'http', 'SERVER_NAME':'example.com',
+                        'SERVER_PORT':'80'})
+        list(accelerator(environ, DummyStartResponse()))
+        self.assertEqual(accelerator.metrics.counters(), {'misses': 1})
+        self.assertEqual(storage.oversized, 1)
+        self.assertEqual(storage.data, {})
+
+    def test_call_miss_cantstore_counted(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        accelerator = self._makeOne(app, policy)
+        list(accelerator(self._makeEnviron(), DummyStartResponse()))
+        self.assertEqual(accelerator.metrics.counters(), {'misses': 1})
+
+    def test_call_passes_metrics_to_policy(self):
+        from repoze.accelerator.metrics import METRICS_KEY
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], []))
+        accelerator = self._makeOne(app, policy)
+        environ = self._makeEnviron()
+        accelerator(environ, DummyStartResponse())
+        self.failUnless(environ[METRICS_KEY] is accelerator.metrics)
+
+    def test_call_stats_path(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['abc']))
+        klass = self._getTargetClass()
+        accelerator = klass(app, policy, None, stats_path='/_stats')
+        list(accelerator(self._makeEnviron(), DummyStartResponse()))
+        environ = self._makeEnviron()
+        environ['PATH_INFO'] = '/_stats'
+        start_response = DummyStartResponse()
+        body = ''.join(accelerator(environ, start_response))
+        self.assertEqual(start_response.status, '200 OK')
+        headers = dict(start_response.headers)
+        self.assertEqual(headers['Content-Type'],
+                         'text/plain; version=0.0.4')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.failUnless('repoze_accelerator_hits_total 1\n' in body)
+        self.failIf(hasattr(app, 'environ'))
+        # the stats request isn't counted
+        self.assertEqual(accelerator.metrics.counters()['hits'], 1)
+
+    def test_ctor_collects_storage_stats(self):
+        from repoze.accelerator.storage import MemoryStorage
+        policy = DummyPolicy(result=None)
+        policy.storage = MemoryStorage(None)
+        accelerator = self._makeOne(DummyApp(), policy)
+        gauges = accelerator.metrics.gauges()
+        self.assertEqual(gauges['storage_entries'], 0)
+        self.assertEqual(gauges['storage_bytes'], 0)
+
+    def test_ctor_metrics(self):
+        from repoze.accelerator.metrics import Metrics
+        metrics = Metrics()
+        klass = self._getTargetClass()
+        accelerator = klass(DummyApp(), DummyPolicy(None), None,
+                            metrics=metrics)
+        self.failUnless(accelerator.metrics is metrics)
+
+    def test_refresh_counted(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        policy.handler = DummyHandler()
+        accelerator = self._makeOne(app, policy)
+        accelerator._refresh(self._makeEnviron())
+        self.assertEqual(accelerator.metrics.counters(),
+                         {'refreshes': 1, 'stores': 1})
+
+    def _makeSampled(self, app, policy, phase_sample=1):
+        klass = self._getTargetClass()
+        hook = DummyPhaseHook()
+        accelerator = klass(app, policy, None, phase_hook=hook,
+                            phase_sample=phase_sample)
+        return accelerator, hook
+
+    def test_call_sampled_hit(self):
+        from repoze.accelerator.phases import PHASES_KEY
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['abc']))
+        accelerator, hook = self._makeSampled(app, policy)
+        environ = self._makeEnviron()
+        result = accelerator(environ, DummyStartResponse())
+        self.assertEqual(result, ['abc'])
+        self.failUnless(hook.begun[0] is environ)
+        self.assertEqual(len(hook.ended), 1)
+        ended, phases = hook.ended[0]
+        self.failUnless(ended is environ)
+        self.failUnless(environ[PHASES_KEY] is phases)
+        self.assertEqual([ phase[0] for phase in phases ],
+                         ['policy.fetch', 'hit', 'request'])
+        self.assertEqual(phases[-1][1], phases.start)
+
+    def test_call_sampled_miss(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        policy.handler = DummyHandler()
+        accelerator, hook = self._makeSampled(app, policy)
+        result = accelerator(self._makeEnviron(), DummyStartResponse())
+        self.assertEqual(hook.ended, [])
+        self.assertEqual(list(result), ['hello', 'world'])
+        self.assertEqual(policy.handler.chunks, ['hello', 'world'])
+        self.failUnless(policy.handler.closed)
+        self.assertEqual(len(hook.ended), 1)
+        phases = hook.ended[0][1]
+        self.assertEqual([ phase[0] for phase in phases ],
+                         ['policy.fetch', 'app', 'policy.store',
+                          'handler.write', 'handler.write', 'handler.close',
+                          'request'])
+        self.assertEqual(accelerator.metrics.counters(),
+                         {'misses': 1, 'stores': 1})
+
+    def test_call_sampled_miss_closed_early(self):
+        app = DummyApp(headers=[('a', 'b')])
+        policy = DummyPolicy(result=None)
+        accelerator, hook = self._makeSampled(app, policy)
+        result = accelerator(self._makeEnviron(), DummyStartResponse())
+        result.next()
+        result.close()
+        self.assertEqual(len(hook.ended), 1)
+        self.assertEqual(hook.ended[0][1][-1][0], 'request')
+
+    def test_call_sampled_fetch_raises(self):
+        app = DummyApp()
+        policy = DummyPolicy(result=None)
+        def fetch(environ):
+            raise ValueError
+        policy.fetch = fetch
+        accelerator, hook = self._makeSampled(app, policy)
+        self.assertRaises(ValueError, accelerator, self._makeEnviron(),
+                          DummyStartResponse())
+        self.assertEqual(len(hook.ended), 1)
+        self.assertEqual([ phase[0] for phase in hook.ended[0][1] ],
+                         ['policy.fetch', 'request'])
+
+    def test_call_sampled_one_in_n(self):
+        from repoze.accelerator.phases import PHASES_KEY
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['abc']))
+        accelerator, hook = self._makeSampled(app, policy, 3)
+        environs = [ self._makeEnviron() for i in range(7) ]
+        for environ in environs:
+            accelerator(environ, DummyStartResponse())
+        self.assertEqual(len(hook.ended), 3)
+        self.assertEqual([ PHASES_KEY in environ for environ in environs ],
+                         [True, False, False, True, False, False, True])
+
+    def test_call_not_sampled_without_hook(self):
+        from repoze.accelerator.phases import PHASES_KEY
+        app = DummyApp()
+        policy = DummyPolicy(result=('200 OK', [], ['abc']))
+        accelerator = self._makeOne(app, policy)
+        environ = self._makeEnviron()
+        accelerator(environ, DummyStartResponse())
+        self.failIf(PHASES_KEY in environ)
+
+    def test_refresh_stale_entry_threaded(self):
+        import sys
+        import time
+        from repoze.accelerator.policy import AcceleratorPolicy
+        from repoze.accelerator.storage import MemoryStorage
+        calls = []
+        def app(environ, start_response):
+            calls.append(environ)
+            start_response('200 OK', [('Cache-Control', 'max-age=60')])
+            return ['fresh']
+        storage = MemoryStorage(None)
+        url = 'http://example.com/'
+        discrims = (('env', ('REQUEST_METHOD', 'GET')),)
+        handler = storage.store(url, discrims, time.time() - 1, '200 OK',
+                                [('Cache-Control',
+                                  'max-age=1, stale-while-revalidate=60')])
+        handler.write('stale')
+        handler.close()
+        policy = AcceleratorPolicy(None, storage)
+        accelerator = self._makeOne(app, policy)
+        environ = self._makeEnviron()
+        environ.update({'wsgi.url_scheme':'http',
+                        'SERVER_NAME':'example.com',
+                        'SERVER_PORT':'80',
+                        'REQUEST_METHOD':'GET'})
+        start_response = DummyStartResponse()
+        result = list(accelerator(environ, start_response))
+        self.assertEqual(result, ['stale'])
+        for i in range(500):
+            entries = storage.fetch(url)
+            if entries and entries[0][4] == ['fresh']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(storage.fetch(url)[0][4], ['fresh'])
+        self.assertEqual(len(calls), 1)
+
+
+class TestRefresher(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.accelerator.middleware import Refresher
+        return Refresher
+
+    def _makeOne(self, workers=1, max_pending=10):
+        return self._getTargetClass()(None, workers, max_pending)
+
+    def test_submit_runs_in_worker(self):
+        import threading
+        refresher = self._makeOne()
+        done = threading.Event()
+        ran = []
+        def func(arg):
+            ran.append((arg, threading.currentThread()))
+            done.set()
+        self.assertEqual(refresher.submit('key', func, 'arg'), True)
+        done.wait(5)
+        self.assertEqual(ran[0][0], 'arg')
+        self.failIf(ran[0][1] is threading.currentThread())
+        self.assertEqual(len(refresher.threads), 1)
+
+    def test_submit_same_key_once(self):
+        import threading
+        refresher = self._makeOne()
+        gate = threading.Event()
+        ran = []
+        def func():
+            gate.wait(5)
+            ran.append(True)
+        self.assertEqual(refresher.submit('key', func), True)
+        self.assertEqual(refresher.submit('key', func), False)
+        gate.set()
+        while 'key' in refresher.pending:
+            gate.wait(0.001)
+        self.assertEqual(ran, [True])
+        self.assertEqual(refresher.submit('key', func), True)
+
+    def test_submit_queue_full(self):
+        import threading
+        refresher = self._makeOne(max_pending=1)
+        gate = threading.Event()
+        started = threading.Event()
+        def func():
+            started.set()
+            gate.wait(5)
+        self.assertEqual(refresher.submit('key1', func), True)
+        started.wait(5)
+        self.assertEqual(refresher.submit('key2', func), True)
+        self.assertEqual(refresher.submit('key3', func), False)
+        self.failIf('key3' in refresher.pending)
+        gate.set()
+
+    def test_failing_refresh_is_logged(self):
+        import threading
+        refresher = self._makeOne()
+        logger = refresher.logger = DummyLogger()
+        logger.exceptions = []
+        done = threading.Event()
+        def exception(msg, *args):
+            logger.exceptions.append(msg % args)
+            done.set()
+        logger.exception = exception
+        def func():
+            raise ValueError
+        refresher.submit('key', func)
+        done.wait(5)
+        self.assertEqual(len(logger.exceptions), 1)
+
 
 class Test_main(unittest.TestCase):
 
@@ -92,6 +691,55 @@ class Test_main(unittest.TestCase):
         self.failUnless(isinstance(accel.policy, AcceleratorPolicy))
         self.failUnless(isinstance(accel.policy.storage, MemoryStorage))
         self.assertEqual(accel.logger, None)
+        self.assertEqual(accel.coalesce_timeout, None)
+        self.assertEqual(accel.refresher.workers, 2)
+        self.assertEqual(accel.refresher.queue.maxsize, 100)
+        self.assertEqual(accel.stats_path, None)
+        self.assertEqual(accel.phase_hook, None)
+
+    def test_main_refresher(self):
+        app = self._makeApp()
+
+        accel = self._callFUT(app, {}, refresh_workers='4',
+                              refresh_max_pending='20')
+
+        self.assertEqual(accel.refresher.workers, 4)
+        self.assertEqual(accel.refresher.queue.maxsize, 20)
+
+    def test_main_coalesce_timeout(self):
+        app = self._makeApp()
+
+        accel = self._callFUT(app, {}, coalesce_timeout='2.5')
+
+        self.assertEqual(accel.coalesce_timeout, 2.5)
+
+    def test_main_stats_path(self):
+        app = self._makeApp()
+
+        accel = self._callFUT(app, {}, stats_path='/_accelerator/stats')
+
+        self.assertEqual(accel.stats_path, '/_accelerator/stats')
+        self.failUnless('storage_entries' in accel.metrics.gauges())
+
+    def test_main_phase_sample(self):
+        from repoze.accelerator.phases import PhaseProfiler
+        app = self._makeApp()
+
+        accel = self._callFUT(app, {}, phase_sample='10')
+
+        self.failUnless(isinstance(accel.phase_hook, PhaseProfiler))
+        self.assertEqual(accel.phase_sample, 10)
+
+    def test_main_phase_hook_entry_point(self):
+        app = self._makeApp()
+
+        accel = self._callFUT(
+            app, {}, phase_sample='1',
+            phase_hook='repoze.accelerator.tests.test_middleware:'
+                       '_makePhaseHook')
+
+        self.failUnless(isinstance(accel.phase_hook, DummyPhaseHook))
+        self.assertEqual(accel.phase_sample, 1)
 
     def test_main_factories(self):
 
@@ -164,6 +812,42 @@ class DummyHandler:
     def close(self):
         self.closed = True
 
+class DummyPhaseHook:
+    def __init__(self):
+        self.begun = []
+        self.ended = []
+    def begin(self, environ):
+        self.begun.append(environ)
+    def end(self, environ, phases):
+        self.ended.append((environ, phases))
+
+def _makePhaseHook(logger, config):
+    return DummyPhaseHook()
+
+class DummyRefresher:
+    def __init__(self):
+        self.submitted = []
+    def submit(self, key, func, *args):
+        self.submitted.append((key, func, args))
+        return True
+
+class DummyResult:
+    def __init__(self, chunks):
+        self.chunks = chunks
+    def __iter__(self):
+        return iter(self.chunks)
+
+class DummyFileBody:
+    def read(self, size=-1): #pragma NO COVER
+        return ''
+    def fileno(self): #pragma NO COVER
+        return -1
+
+class DummyFileWrapper:
+    def __init__(self, filelike, block_size):
+        self.filelike = filelike
+        self.block_size = block_size
+
 class DummyStartResponse:
     def __call__(self, status, headers, exc_info=None):
         self.status = status
@@ -193,3 +877,22 @@ class DummyPolicy:
     def store(self, status, headers, environ):
         return self.handler
 
+class DummyCoalescingPolicy(DummyPolicy):
+    def __init__(self, results, key):
+        from zope.interface import directlyProvides
+        from repoze.accelerator.interfaces import ICoalescingPolicy
+        DummyPolicy.__init__(self, None)
+        directlyProvides(self, ICoalescingPolicy)
+        self.results = results
+        self.key = key
+        self.fetched = 0
+        self.keyed = 0
+
+    def fetch(self, environ):
+        result = self.results[self.fetched]
+        self.fetched += 1
+        return result
+
+    def coalesce_key(self, environ):
+        self.keyed += 1
+        return self.key
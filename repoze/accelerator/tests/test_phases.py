@@ -0,0 +1,193 @@
+import unittest
+
+class TestPhases(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.accelerator.phases import Phases
+        return Phases
+
+    def _makeOne(self):
+        klass = self._getTargetClass()
+        return klass()
+
+    def test_ctor(self):
+        from repoze.accelerator.phases import clock
+        before = clock()
+        phases = self._makeOne()
+        self.assertEqual(list(phases), [])
+        self.failUnless(before <= phases.start <= clock())
+
+    def test_add(self):
+        phases = self._makeOne()
+        end = phases.add('construct_url', phases.start)
+        self.assertEqual(list(phases), [('construct_url', phases.start, end)])
+        self.failUnless(end >= phases.start)
+
+    def test_timing(self):
+        phases = self._makeOne()
+        def func(a, b=None):
+            return a, b
+        timed = phases.timing('app', func)
+        self.assertEqual(timed(1, b=2), (1, 2))
+        self.assertEqual(len(phases), 1)
+        name, start, end = phases[0]
+        self.assertEqual(name, 'app')
+        self.failUnless(start <= end)
+
+    def test_timing_raises(self):
+        phases = self._makeOne()
+        def func():
+            raise ValueError
+        self.assertRaises(ValueError, phases.timing('app', func))
+        self.assertEqual(len(phases), 1)
+
+class TestTimedHandler(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.accelerator.phases import TimedHandler
+        return TimedHandler
+
+    def _makeOne(self, handler, phases):
+        klass = self._getTargetClass()
+        return klass(handler, phases)
+
+    def test_write_and_close(self):
+        from repoze.accelerator.phases import Phases
+        handler = DummyHandler()
+        phases = Phases()
+        timed = self._makeOne(handler, phases)
+        timed.write('abc')
+        timed.write('def')
+        timed.close()
+        self.assertEqual(handler.chunks, ['abc', 'def'])
+        self.failUnless(handler.closed)
+        self.assertEqual([ phase[0] for phase in phases ],
+                         ['handler.write', 'handler.write', 'handler.close'])
+
+    def test_discarding(self):
+        from repoze.accelerator.phases import Phases
+        handler = DummyHandler()
+        timed = self._makeOne(handler, Phases())
+        self.failIf(timed.discarding)
+        handler.discarding = True
+        self.failUnless(timed.discarding)
+
+class TestPhaseProfiler(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.accelerator.phases import PhaseProfiler
+        return PhaseProfiler
+
+    def _makeOne(self, *arg, **kw):
+        klass = self._getTargetClass()
+        return klass(*arg, **kw)
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def test_class_conforms_to_IPhaseHook(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IPhaseHook
+        verifyClass(IPhaseHook, self._getTargetClass())
+
+    def test_instance_conforms_to_IPhaseHook(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IPhaseHook
+        verifyObject(IPhaseHook, self._makeOne())
+
+    def test_timings(self):
+        profiler = self._makeOne()
+        environ = {}
+        profiler.begin(environ)
+        self.assertEqual(environ, {})
+        profiler.end(environ, [('app', 1.0, 1.5), ('request', 0.0, 2.0)])
+        profiler.end(environ, [('app', 1.0, 2.0), ('request', 0.0, 1.0)])
+        self.assertEqual(profiler.samples, 2)
+        self.assertEqual(profiler.timings(), {'app': (2, 1.5, 1.0),
+                                              'request': (2, 3.0, 2.0)})
+
+    def test_report(self):
+        profiler = self._makeOne()
+        profiler.end({}, [('app', 1.0, 1.5), ('request', 0.0, 2.0)])
+        lines = profiler.report().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.failUnless(lines[0].startswith('phase'))
+        self.assertEqual(lines[1].split(),
+                         ['request', '1', '2000.000', '2000000.0',
+                          '2000000.0'])
+        self.assertEqual(lines[2].split()[0], 'app')
+
+    def test_profile(self):
+        import os
+        import pstats
+        from repoze.accelerator.phases import PROFILE_KEY
+        path = os.path.join(self.tempdir, 'profile')
+        profiler = self._makeOne(profile_path=path, dump_every=2)
+        def profiled():
+            pass
+        for i in range(2):
+            environ = {}
+            profiler.begin(environ)
+            self.failUnless(PROFILE_KEY in environ)
+            profiled()
+            profiler.end(environ, [('request', 0.0, 1.0)])
+            self.assertEqual(environ, {})
+            self.assertEqual(os.path.exists(path), i == 1)
+        stats = pstats.Stats(path)
+        calls = [ value[0] for key, value in stats.stats.items()
+                  if key[2] == 'profiled' ]
+        self.assertEqual(calls, [2])
+
+    def test_dump_logs(self):
+        logger = DummyLogger()
+        profiler = self._makeOne(logger)
+        profiler.end({}, [('request', 0.0, 1.0)])
+        profiler.dump()
+        self.assertEqual(len(logger.messages), 1)
+        self.failUnless(logger.messages[0].startswith(
+            'repoze.accelerator: phase timings of 1 requests\n'))
+
+    def test_dump_nothing_profiled(self):
+        import os
+        path = os.path.join(self.tempdir, 'profile')
+        profiler = self._makeOne(profile_path=path)
+        profiler.dump()
+        self.failIf(os.path.exists(path))
+
+class Test_make_phase_profiler(unittest.TestCase):
+    def _callFUT(self, logger, config):
+        from repoze.accelerator.phases import make_phase_profiler
+        return make_phase_profiler(logger, config)
+
+    def test_defaults(self):
+        profiler = self._callFUT(None, {})
+        self.assertEqual(profiler.logger, None)
+        self.assertEqual(profiler.profile_path, None)
+        self.assertEqual(profiler.dump_every, 100)
+
+    def test_config(self):
+        import os
+        logger = DummyLogger()
+        profiler = self._callFUT(logger,
+                                 {'phase_hook.profile_path': 'profile.out',
+                                  'phase_hook.dump_every': '10'})
+        self.failUnless(profiler.logger is logger)
+        self.assertEqual(profiler.profile_path, os.path.abspath('profile.out'))
+        self.assertEqual(profiler.dump_every, 10)
+
+class DummyHandler:
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+    def write(self, chunk):
+        self.chunks.append(chunk)
+    def close(self):
+        self.closed = True
+
+class DummyLogger:
+    def __init__(self):
+        self.messages = []
+    def info(self, msg, *args):
+        self.messages.append(msg % args)
@@ -211,6 +211,18 @@ class TestAcceleratorPolicy(unittest.TestCase, _PolicyBase):
         self.assertEqual(storage.headers, headers)
         self.assertEqual(storage.expires, 0)
 
+    def test_store_no_cc_no_expires_header_stale_at_once(self):
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        policy.stale_grace = 30
+        environ = self._makeEnviron()
+        from email.Utils import formatdate
+        headers = [('Date', formatdate(0))]
+        result = policy.store('200 OK', headers, environ)
+        self.assertEqual(result, True)
+        self.assertEqual(storage.expires, 0)
+        self.assertEqual(storage.extras, {'stale_until':30})
+
     def test_store_allowed_request_method_cacheable(self):
         storage = DummyStorage(store_result=True)
         policy = self._makeOne(storage)
@@ -247,6 +259,25 @@ class TestAcceleratorPolicy(unittest.TestCase, _PolicyBase):
         self.assertEqual(storage.status, '200 OK')
         self.assertEqual(storage.headers, headers)
 
+    def test_store_no_stale_window_no_stale_until(self):
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        headers = [('Cache-Control', 'max-age=400')]
+        policy.store('200 OK', headers, environ)
+        self.assertEqual(storage.extras, {})
+
+    def test_store_stale_while_revalidate_stale_until(self):
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        policy.stale_grace = 30
+        environ = self._makeEnviron()
+        from email.Utils import formatdate
+        headers = [('Cache-Control', 'max-age=400, stale-while-revalidate=60'),
+                   ('Date', formatdate(0))]
+        policy.store('200 OK', headers, environ)
+        self.assertEqual(storage.extras, {'stale_until':460})
+
     def test_store_with_request_vary(self):
         storage = DummyStorage(store_result=True)
         policy = self._makeOne(storage)
@@ -264,6 +295,31 @@ class TestAcceleratorPolicy(unittest.TestCase, _PolicyBase):
         self.assertEqual(discrims[0], ('env', ('REQUEST_METHOD', 'GET')))
         self.assertEqual(discrims[1], ('vary', ('cookie', '12345')))
 
+    def test_store_with_request_vary_content_type(self):
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        headers = self._makeHeaders()
+        headers.append(('Vary', 'Content-Type'))
+        environ['CONTENT_TYPE'] = 'text/plain'
+        result = policy.store('200 OK', headers, environ)
+        self.assertEqual(result, True)
+        discrims = storage.discrims
+        self.assertEqual(len(discrims), 2)
+        self.assertEqual(discrims[1], ('vary', ('content-type', 'text/plain')))
+
+    def test_allowed_methods_assignable(self):
+        import sys
+        storage = DummyStorage([([], sys.maxint, '200 OK', [], ['abc'], {})])
+        policy = self._makeOne(storage)
+        policy.allowed_methods = ['GET', 'HEAD']
+        self.assertEqual(policy.allowed_methods, ['GET', 'HEAD'])
+        environ = self._makeEnviron()
+        environ['REQUEST_METHOD'] = 'POST'
+        self.assertEqual(policy.fetch(environ), None)
+        environ['REQUEST_METHOD'] = 'HEAD'
+        self.assertEqual(policy.fetch(environ), ('200 OK', [], ['abc']))
+
     def test_store_with_always_request_vary(self):
         storage = DummyStorage(store_result=True)
         policy = self._makeOne(storage)
@@ -345,6 +401,242 @@ class TestAcceleratorPolicy(unittest.TestCase, _PolicyBase):
         self.assertEqual(discrims[0], ('env', ('REMOTE_USER', '12345')))
         self.assertEqual(discrims[1], ('vary', ('cookie', '12345')))
 
+    def _bypasses(self, fetch=None, status='200 OK', headers=(), **environ):
+        from repoze.accelerator.metrics import METRICS_KEY
+        from repoze.accelerator.metrics import Metrics
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        policy.store_https_responses = False
+        metrics = Metrics()
+        env = self._makeEnviron()
+        env.update(environ)
+        env[METRICS_KEY] = metrics
+        if fetch:
+            policy.fetch(env)
+        else:
+            policy.store(status, self._makeHeaders() + list(headers), env)
+        return metrics.counters()
+
+    def test_bypasses_fetch_method(self):
+        self.assertEqual(self._bypasses(True, REQUEST_METHOD='POST'),
+                         {'bypasses{reason="method"}': 1})
+
+    def test_bypasses_fetch_reload(self):
+        self.assertEqual(self._bypasses(True, HTTP_PRAGMA='no-cache'),
+                         {'bypasses{reason="reload"}': 1})
+
+    def test_bypasses_store_method_not_counted_again(self):
+        self.assertEqual(self._bypasses(REQUEST_METHOD='POST'), {})
+
+    def test_bypasses_store_status(self):
+        self.assertEqual(self._bypasses(status='500 Error'),
+                         {'bypasses{reason="status"}': 1})
+
+    def test_bypasses_store_https(self):
+        self.assertEqual(self._bypasses(**{'wsgi.url_scheme': 'https'}),
+                         {'bypasses{reason="https"}': 1})
+
+    def test_bypasses_store_no_cache(self):
+        self.assertEqual(self._bypasses(headers=[('Pragma', 'no-cache')]),
+                         {'bypasses{reason="no-cache"}': 1})
+
+    def test_bypasses_store_max_age(self):
+        self.assertEqual(
+            self._bypasses(headers=[('Cache-Control', 'max-age=0')]),
+            {'bypasses{reason="max-age"}': 1})
+        self.assertEqual(
+            self._bypasses(headers=[('Cache-Control', 'max-age=bad')]),
+            {'bypasses{reason="max-age"}': 1})
+
+    def test_bypasses_store_vary(self):
+        self.assertEqual(self._bypasses(headers=[('Vary', '*')]),
+                         {'bypasses{reason="vary"}': 1})
+
+    def test_bypasses_store_stored(self):
+        self.assertEqual(
+            self._bypasses(headers=[('Cache-Control', 'max-age=60')]), {})
+
+    def test_fetch_records_phases(self):
+        from repoze.accelerator.phases import PHASES_KEY
+        from repoze.accelerator.phases import Phases
+        storage = DummyStorage(fetch_result=None)
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        phases = environ[PHASES_KEY] = Phases()
+        policy.fetch(environ)
+        self.assertEqual([ phase[0] for phase in phases ],
+                         ['construct_url', 'storage.fetch'])
+        self.assertEqual(phases[0][2], phases[1][1])
+
+    def _makePassing(self, ttl=60):
+        storage = DummyStorage(store_result=True)
+        fetched = storage.fetched = []
+        def fetch(url):
+            fetched.append(url)
+        storage.fetch = fetch
+        policy = self._makeOne(storage)
+        policy.hit_for_pass_ttl = ttl
+        return policy, storage
+
+    def test_hit_for_pass_off_by_default(self):
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        self.assertEqual(policy.hit_for_pass_ttl, 0)
+        environ = self._makeEnviron()
+        policy.store('500 Error', self._makeHeaders(), environ)
+        self.assertEqual(policy._passes, {})
+
+    def test_hit_for_pass_remembers_uncacheable(self):
+        from repoze.accelerator.metrics import METRICS_KEY
+        from repoze.accelerator.metrics import Metrics
+        from repoze.accelerator.policy import PASS_KEY
+        policy, storage = self._makePassing()
+        environ = self._makeEnviron()
+        self.assertEqual(policy.fetch(environ), None)
+        self.assertEqual(storage.fetched, ['http://example.com'])
+        headers = self._makeHeaders() + [('Cache-Control', 'no-cache')]
+        self.assertEqual(policy.store('200 OK', headers, environ), None)
+        self.assertEqual(policy._passes.keys(), [('http://example.com', 'GET')])
+
+        environ = self._makeEnviron()
+        metrics = environ[METRICS_KEY] = Metrics()
+        self.assertEqual(policy.fetch(environ), None)
+        self.assertEqual(storage.fetched, ['http://example.com'])
+        self.assertEqual(environ[PASS_KEY], True)
+        self.assertEqual(policy.coalesce_key(environ), None)
+        # not stored, even if it could be now
+        headers = self._makeHeaders() + [('Cache-Control', 'max-age=60')]
+        self.assertEqual(policy.store('200 OK', headers, environ), None)
+        self.assertEqual(metrics.counters(), {'bypasses{reason="pass"}': 1})
+
+    def test_hit_for_pass_reasons(self):
+        for status, headers in [('500 Error', []),
+                                ('200 OK', [('Pragma', 'no-cache')]),
+                                ('200 OK', [('Cache-Control', 'max-age=0')]),
+                                ('200 OK', [('Cache-Control', 'max-age=x')]),
+                                ('200 OK', [('Cache-Control', 'max-age=60'),
+                                            ('Vary', '*')]),
+                                ]:
+            policy, storage = self._makePassing()
+            policy.store(status, self._makeHeaders() + headers,
+                         self._makeEnviron())
+            self.assertEqual(policy._passes.keys(), [('http://example.com', 'GET')])
+
+    def test_hit_for_pass_not_for_conditional_or_range(self):
+        for key, value in [('HTTP_IF_NONE_MATCH', '"abc"'),
+                           ('HTTP_IF_MODIFIED_SINCE',
+                            'Sat, 29 Oct 1994 19:43:31 GMT'),
+                           ('HTTP_IF_MATCH', '"abc"'),
+                           ('HTTP_IF_UNMODIFIED_SINCE',
+                            'Sat, 29 Oct 1994 19:43:31 GMT'),
+                           ('HTTP_RANGE', 'bytes=0-1'),
+                           ('HTTP_PRAGMA', 'no-cache')]:
+            policy, storage = self._makePassing()
+            policy.honor_shift_reload = True
+            environ = self._makeEnviron()
+            environ[key] = value
+            policy.store('500 Error', self._makeHeaders(), environ)
+            self.assertEqual(policy._passes, {}, key)
+
+    def test_hit_for_pass_not_for_partial_statuses(self):
+        for status in ('304 Not Modified', '206 Partial Content',
+                       '412 Precondition Failed',
+                       '416 Requested Range Not Satisfiable'):
+            policy, storage = self._makePassing()
+            policy.store(status, self._makeHeaders(), self._makeEnviron())
+            self.assertEqual(policy._passes, {}, status)
+
+    def test_hit_for_pass_revalidation_doesnt_disable_caching(self):
+        policy, storage = self._makePassing()
+        environ = self._makeEnviron()
+        environ['HTTP_IF_NONE_MATCH'] = '"abc"'
+        policy.fetch(environ)
+        policy.store('304 Not Modified', self._makeHeaders(), environ)
+        environ = self._makeEnviron()
+        policy.fetch(environ)
+        headers = self._makeHeaders() + [('Cache-Control', 'max-age=60')]
+        self.assertEqual(policy.store('200 OK', headers, environ), True)
+
+    def test_hit_for_pass_https(self):
+        policy, storage = self._makePassing()
+        environ = self._makeEnviron()
+        environ['wsgi.url_scheme'] = 'https'
+        environ['SERVER_PORT'] = '443'
+        policy.store('200 OK', self._makeHeaders(), environ)
+        self.assertEqual(policy._passes.keys(), [('https://example.com', 'GET')])
+
+    def test_hit_for_pass_not_for_cacheable_or_method(self):
+        policy, storage = self._makePassing()
+        headers = self._makeHeaders() + [('Cache-Control', 'max-age=60')]
+        policy.store('200 OK', headers, self._makeEnviron())
+        environ = self._makeEnviron()
+        environ['REQUEST_METHOD'] = 'POST'
+        policy.store('500 Error', headers, environ)
+        self.assertEqual(policy._passes, {})
+
+    def test_hit_for_pass_per_variant(self):
+        from repoze.accelerator.policy import PASS_KEY
+        policy, storage = self._makePassing()
+        policy.always_vary_on_environ = ('REMOTE_USER',)
+        environ = self._makeEnviron()
+        environ['REMOTE_USER'] = 'fred'
+        headers = self._makeHeaders() + [('Cache-Control', 'no-cache')]
+        policy.store('200 OK', headers, environ)
+        self.assertEqual(policy._passes.keys(),
+                         [('http://example.com', 'fred')])
+        environ = self._makeEnviron()
+        environ['REMOTE_USER'] = 'fred'
+        policy.fetch(environ)
+        self.assertEqual(environ[PASS_KEY], True)
+        self.assertEqual(storage.fetched, [])
+        anonymous = self._makeEnviron()
+        policy.fetch(anonymous)
+        self.failIf(PASS_KEY in anonymous)
+        self.assertEqual(storage.fetched, ['http://example.com'])
+        self.assertEqual(policy.coalesce_key(anonymous),
+                         ('http://example.com', None))
+
+    def test_hit_for_pass_other_url_looked_up(self):
+        policy, storage = self._makePassing()
+        policy.store('500 Error', self._makeHeaders(), self._makeEnviron())
+        environ = self._makeEnviron()
+        environ['PATH_INFO'] = '/other'
+        policy.fetch(environ)
+        self.assertEqual(storage.fetched, ['http://example.com/other'])
+
+    def test_hit_for_pass_expires(self):
+        import time
+        from repoze.accelerator.policy import PASS_KEY
+        policy, storage = self._makePassing()
+        policy._passes[('http://example.com', 'GET')] = time.time() - 1
+        environ = self._makeEnviron()
+        policy.fetch(environ)
+        self.assertEqual(storage.fetched, ['http://example.com'])
+        self.failIf(PASS_KEY in environ)
+        self.assertEqual(policy._passes, {})
+
+    def test_hit_for_pass_bounded(self):
+        import time
+        from repoze.accelerator import policy as module
+        policy, storage = self._makePassing()
+        old_max = module.HIT_FOR_PASS_MAX
+        module.HIT_FOR_PASS_MAX = 3
+        try:
+            policy._passes[('expired',)] = time.time() - 1
+            policy._passes[('a',)] = time.time() + 60
+            policy._passes[('b',)] = time.time() + 60
+            policy.store('500 Error', self._makeHeaders(),
+                         self._makeEnviron())
+            self.assertEqual(sorted(policy._passes.keys()),
+                             [('a',), ('b',), ('http://example.com', 'GET')])
+            environ = self._makeEnviron()
+            environ['PATH_INFO'] = '/other'
+            policy.store('500 Error', self._makeHeaders(), environ)
+            self.assertEqual(policy._passes.keys(),
+                             [('http://example.com/other', 'GET')])
+        finally:
+            module.HIT_FOR_PASS_MAX = old_max
+
     def test_fetch_fails_post_request_method(self):
         storage = DummyStorage(fetch_result=False)
         policy = self._makeOne(storage)
@@ -492,6 +784,28 @@ class TestAcceleratorPolicy(unittest.TestCase, _PolicyBase):
         result = policy.fetch(environ)
         self.assertEqual(result, None)
 
+    def test_fetch_via_variant_storage(self):
+        import sys
+        headers = self._makeHeaders()
+        discrims = (('env', ('REMOTE_USER', 'fred')),
+                    ('vary', ('Cookie', '12345')))
+        stored = (discrims, sys.maxint, 200, headers, [], {})
+        storage = DummyVariantStorage(stored)
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        environ['HTTP_COOKIE'] = '12345'
+        environ['REMOTE_USER'] = 'fred'
+        result = policy.fetch(environ)
+        self.assertEqual(result, (200, headers, []))
+        self.assertEqual(storage.url, 'http://example.com')
+        self.assertEqual(storage.resolved, ['fred', '12345'])
+
+    def test_fetch_via_variant_storage_no_match(self):
+        storage = DummyVariantStorage(None)
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        self.assertEqual(policy.fetch(environ), None)
+
     def test_fetch_fails_no_response_from_storage(self):
         headers = self._makeHeaders()
         cc = 'max-age=4000'
@@ -553,6 +867,529 @@ class TestAcceleratorPolicy(unittest.TestCase, _PolicyBase):
         result = policy.fetch(environ)
         self.assertEqual(result, None)
 
+    def test_class_conforms_to_ICoalescingPolicy(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import ICoalescingPolicy
+        verifyClass(ICoalescingPolicy, self._getTargetClass())
+
+    def test_coalesce_key_post_request_method(self):
+        policy = self._makeOne(DummyStorage())
+        environ = self._makeEnviron()
+        environ['REQUEST_METHOD'] = 'POST'
+        self.assertEqual(policy.coalesce_key(environ), None)
+
+    def test_coalesce_key_range_request(self):
+        policy = self._makeOne(DummyStorage())
+        environ = self._makeEnviron()
+        environ['HTTP_RANGE'] = 'bytes=200-300'
+        self.assertEqual(policy.coalesce_key(environ),
+                         ('http://example.com', 'GET'))
+
+    def test_coalesce_key_shift_reload(self):
+        policy = self._makeOne(DummyStorage())
+        environ = self._makeEnviron()
+        environ['HTTP_PRAGMA'] = 'no-cache'
+        self.assertEqual(policy.coalesce_key(environ), None)
+
+    def test_coalesce_key(self):
+        policy = self._makeOne(DummyStorage())
+        environ = self._makeEnviron()
+        self.assertEqual(policy.coalesce_key(environ),
+                         ('http://example.com', 'GET'))
+
+    def test_coalesce_key_always_vary(self):
+        policy = self._makeOne(DummyStorage())
+        policy.always_vary_on_headers = ('Cookie',)
+        policy.always_vary_on_environ = ('REMOTE_USER',)
+        environ = self._makeEnviron()
+        environ['HTTP_COOKIE'] = '12345'
+        self.assertEqual(policy.coalesce_key(environ),
+                         ('http://example.com', '12345', None))
+
+    def test_fetch_stale_within_stale_while_revalidate(self):
+        import time
+        headers = self._makeHeaders()
+        headers.append(('Cache-Control',
+                        'max-age=10, stale-while-revalidate=60'))
+        expected = ([], time.time() - 30, 200, headers, [], {})
+        storage = DummyStorage(fetch_result=[expected])
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        result = policy.fetch(environ)
+        self.assertEqual(result, (200, headers, []))
+        self.assertEqual(environ['repoze.accelerator.stale'],
+                         ('http://example.com', []))
+
+    def test_fetch_stale_beyond_stale_while_revalidate(self):
+        import time
+        headers = self._makeHeaders()
+        headers.append(('Cache-Control',
+                        'max-age=10, stale-while-revalidate=60'))
+        expected = ([], time.time() - 90, 200, headers, [], {})
+        storage = DummyStorage(fetch_result=[expected])
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        self.assertEqual(policy.fetch(environ), None)
+        self.failIf('repoze.accelerator.stale' in environ)
+
+    def test_fetch_stale_bad_stale_while_revalidate(self):
+        import time
+        headers = self._makeHeaders()
+        headers.append(('Cache-Control',
+                        'max-age=10, stale-while-revalidate=bad'))
+        expected = ([], time.time() - 30, 200, headers, [], {})
+        storage = DummyStorage(fetch_result=[expected])
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        self.assertEqual(policy.fetch(environ), None)
+
+    def test_fetch_stale_within_stale_grace(self):
+        import time
+        headers = self._makeHeaders()
+        headers.append(('Cache-Control', 'max-age=10'))
+        expected = ([], time.time() - 30, 200, headers, [], {})
+        storage = DummyStorage(fetch_result=[expected])
+        policy = self._makeOne(storage)
+        policy.stale_grace = 60
+        environ = self._makeEnviron()
+        result = policy.fetch(environ)
+        self.assertEqual(result, (200, headers, []))
+        self.failUnless('repoze.accelerator.stale' in environ)
+
+    def _storeAndFetchHeaderless(self, stale_grace=0):
+        from repoze.accelerator.storage import MemoryStorage
+        policy = self._makeOne(MemoryStorage(None))
+        policy.stale_grace = stale_grace
+        handler = policy.store('200 OK', [], self._makeEnviron())
+        handler.write('abc')
+        handler.close()
+        environ = self._makeEnviron()
+        return environ, policy.fetch(environ)
+
+    def test_fetch_no_cc_no_expires_header_stale(self):
+        environ, result = self._storeAndFetchHeaderless()
+        self.assertEqual(result, None)
+        self.failIf('repoze.accelerator.stale' in environ)
+
+    def test_fetch_no_cc_no_expires_header_within_stale_grace(self):
+        environ, result = self._storeAndFetchHeaderless(stale_grace=60)
+        self.assertEqual(result[0], '200 OK')
+        self.assertEqual(''.join(result[2]), 'abc')
+        self.failUnless('repoze.accelerator.stale' in environ)
+
+    def test_fetch_fresh_not_marked_stale(self):
+        import sys
+        headers = self._makeHeaders()
+        expected = ([], sys.maxint, 200, headers, [], {})
+        storage = DummyStorage(fetch_result=[expected])
+        policy = self._makeOne(storage)
+        policy.stale_grace = 60
+        environ = self._makeEnviron()
+        policy.fetch(environ)
+        self.failIf('repoze.accelerator.stale' in environ)
+
+    def _fetchConditional(self, stored_headers, method='GET', **request):
+        import sys
+        headers = self._makeHeaders()
+        headers.extend(stored_headers)
+        headers.append(('Content-Type', 'text/plain'))
+        stored = ([], sys.maxint, '200 OK', headers, ['body'], {})
+        storage = DummyStorage(fetch_result=[stored])
+        policy = self._makeOne(storage)
+        policy.allowed_methods = ('GET', 'POST')
+        environ = self._makeEnviron()
+        environ['REQUEST_METHOD'] = method
+        environ.update(request)
+        return headers, policy.fetch(environ)
+
+    def test_fetch_if_none_match_matches(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"'), ('Cache-Control', 'max-age=60')],
+            HTTP_IF_NONE_MATCH='"xyz", "abc"')
+        self.assertEqual(result,
+                         ('304 Not Modified',
+                          [headers[0], ('ETag', '"abc"'),
+                           ('Cache-Control', 'max-age=60')],
+                          []))
+
+    def test_fetch_if_none_match_weak_comparison(self):
+        headers, result = self._fetchConditional(
+            [('ETag', 'W/"abc"')], HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(result[0], '304 Not Modified')
+
+    def test_fetch_if_none_match_star(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(result[0], '304 Not Modified')
+
+    def test_fetch_if_none_match_differs_serves_entry(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], HTTP_IF_NONE_MATCH='"xyz"')
+        self.assertEqual(result, ('200 OK', headers, ['body']))
+
+    def test_fetch_if_none_match_no_etag(self):
+        headers, result = self._fetchConditional(
+            [], HTTP_IF_NONE_MATCH='"xyz"')
+        self.assertEqual(result, None)
+
+    def test_fetch_if_none_match_matches_unsafe_method(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], method='POST', HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(result, None)
+
+    def test_fetch_if_none_match_takes_precedence(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"'), ('Last-Modified', formatdate(0))],
+            HTTP_IF_NONE_MATCH='"xyz"',
+            HTTP_IF_MODIFIED_SINCE=formatdate(100))
+        self.assertEqual(result, ('200 OK', headers, ['body']))
+
+    def test_fetch_if_modified_since_not_modified(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchConditional(
+            [('Last-Modified', formatdate(100))],
+            HTTP_IF_MODIFIED_SINCE=formatdate(100))
+        self.assertEqual(result,
+                         ('304 Not Modified',
+                          [headers[0], ('Last-Modified', formatdate(100))],
+                          []))
+
+    def test_fetch_if_modified_since_modified(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchConditional(
+            [('Last-Modified', formatdate(100))],
+            HTTP_IF_MODIFIED_SINCE=formatdate(50))
+        self.assertEqual(result, ('200 OK', headers, ['body']))
+
+    def test_fetch_if_modified_since_no_last_modified(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchConditional(
+            [], HTTP_IF_MODIFIED_SINCE=formatdate(50))
+        self.assertEqual(result, None)
+
+    def test_fetch_if_modified_since_unparseable(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchConditional(
+            [('Last-Modified', formatdate(100))],
+            HTTP_IF_MODIFIED_SINCE='whenever')
+        self.assertEqual(result, None)
+
+    def test_fetch_if_match_matches(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], HTTP_IF_MATCH='"abc"')
+        self.assertEqual(result, ('200 OK', headers, ['body']))
+
+    def test_fetch_if_match_star(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], HTTP_IF_MATCH='*')
+        self.assertEqual(result, ('200 OK', headers, ['body']))
+
+    def test_fetch_if_match_differs(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], HTTP_IF_MATCH='"xyz"')
+        self.assertEqual(result, None)
+
+    def test_fetch_if_match_weak_etag(self):
+        headers, result = self._fetchConditional(
+            [('ETag', 'W/"abc"')], HTTP_IF_MATCH='W/"abc"')
+        self.assertEqual(result, None)
+
+    def test_fetch_if_match_no_etag(self):
+        headers, result = self._fetchConditional(
+            [], HTTP_IF_MATCH='"abc"')
+        self.assertEqual(result, None)
+
+    def test_fetch_if_match_and_if_none_match(self):
+        headers, result = self._fetchConditional(
+            [('ETag', '"abc"')], HTTP_IF_MATCH='"abc"',
+            HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(result[0], '304 Not Modified')
+
+    def _fetchRange(self, range, stored_headers=(), status='200 OK',
+                    method='GET', **request):
+        import sys
+        headers = self._makeHeaders()
+        headers.extend(stored_headers)
+        headers.append(('Content-Type', 'text/plain'))
+        headers.append(('Content-Length', '10'))
+        stored = ([], sys.maxint, status, headers, ['01234', '56789'], {})
+        storage = DummyStorage(fetch_result=[stored])
+        policy = self._makeOne(storage)
+        policy.allowed_methods = ('GET', 'HEAD')
+        environ = self._makeEnviron()
+        environ['REQUEST_METHOD'] = method
+        environ['HTTP_RANGE'] = range
+        environ.update(request)
+        return headers, policy.fetch(environ)
+
+    def test_fetch_range_single(self):
+        headers, result = self._fetchRange('bytes=3-6')
+        status, headers, body = result
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(headers[1:], [('Content-Type', 'text/plain'),
+                                       ('Content-Range', 'bytes 3-6/10'),
+                                       ('Content-Length', '4')])
+        self.assertEqual(list(body), ['34', '56'])
+
+    def test_fetch_range_multiple(self):
+        headers, result = self._fetchRange('bytes=0-1, 8-')
+        status, headers, body = result
+        self.assertEqual(status, '206 Partial Content')
+        body = ''.join(body)
+        content_type = dict(headers)['Content-Type']
+        self.failUnless(content_type.startswith(
+            'multipart/byteranges; boundary='))
+        boundary = content_type.split('=')[1]
+        self.assertEqual(int(dict(headers)['Content-Length']), len(body))
+        self.assertEqual(body,
+                         '--%(b)s\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Range: bytes 0-1/10\r\n\r\n'
+                         '01\r\n'
+                         '--%(b)s\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Range: bytes 8-9/10\r\n\r\n'
+                         '89\r\n'
+                         '--%(b)s--\r\n' % {'b':boundary})
+
+    def test_fetch_range_unsatisfiable(self):
+        headers, result = self._fetchRange('bytes=20-30')
+        status, headers, body = result
+        self.assertEqual(status, '416 Requested Range Not Satisfiable')
+        self.assertEqual(headers[1:], [('Content-Type', 'text/plain'),
+                                       ('Content-Range', 'bytes */10'),
+                                       ('Content-Length', '0')])
+        self.assertEqual(body, [])
+
+    def test_fetch_range_malformed_serves_whole(self):
+        headers, result = self._fetchRange('bytes=6-3')
+        self.assertEqual(result, ('200 OK', headers, ['01234', '56789']))
+
+    def test_fetch_range_non_200_serves_whole(self):
+        headers, result = self._fetchRange('bytes=3-6', status='203 Foo')
+        self.assertEqual(result, ('203 Foo', headers, ['01234', '56789']))
+
+    def test_fetch_range_head_serves_whole(self):
+        headers, result = self._fetchRange('bytes=3-6', method='HEAD')
+        self.assertEqual(result[0], '200 OK')
+
+    def test_fetch_range_if_range_etag_matches(self):
+        headers, result = self._fetchRange(
+            'bytes=3-6', [('ETag', '"abc"')], HTTP_IF_RANGE='"abc"')
+        self.assertEqual(result[0], '206 Partial Content')
+
+    def test_fetch_range_if_range_etag_differs(self):
+        headers, result = self._fetchRange(
+            'bytes=3-6', [('ETag', '"abc"')], HTTP_IF_RANGE='"xyz"')
+        self.assertEqual(result[0], '200 OK')
+
+    def test_fetch_range_if_range_weak_etag(self):
+        headers, result = self._fetchRange(
+            'bytes=3-6', [('ETag', 'W/"abc"')], HTTP_IF_RANGE='W/"abc"')
+        self.assertEqual(result[0], '200 OK')
+
+    def test_fetch_range_if_range_date_matches(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchRange(
+            'bytes=3-6', [('Last-Modified', formatdate(100))],
+            HTTP_IF_RANGE=formatdate(100))
+        self.assertEqual(result[0], '206 Partial Content')
+
+    def test_fetch_range_if_range_date_differs(self):
+        from email.Utils import formatdate
+        headers, result = self._fetchRange(
+            'bytes=3-6', [('Last-Modified', formatdate(100))],
+            HTTP_IF_RANGE=formatdate(50))
+        self.assertEqual(result[0], '200 OK')
+
+    def test_fetch_range_conditional_not_modified(self):
+        headers, result = self._fetchRange(
+            'bytes=3-6', [('ETag', '"abc"')], HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(result[0], '304 Not Modified')
+
+    def test_fetch_conditional_stale_entry(self):
+        import time
+        headers = self._makeHeaders()
+        headers.append(('ETag', '"abc"'))
+        expected = ([], time.time() - 30, 200, headers, [], {})
+        storage = DummyStorage(fetch_result=[expected])
+        policy = self._makeOne(storage)
+        environ = self._makeEnviron()
+        environ['HTTP_IF_NONE_MATCH'] = '"abc"'
+        self.assertEqual(policy.fetch(environ), None)
+
+    def _storeEncoded(self, headers, body='abc' * 200, **request):
+        storage = DummyStorage(store_result=DummyHandler())
+        policy = self._makeOne(storage)
+        policy.encodings = ['gzip']
+        environ = self._makeEnviron()
+        environ.update(request)
+        handler = policy.store('200 OK', headers, environ)
+        if handler is not None:
+            handler.write(body)
+            handler.close()
+        return storage, handler
+
+    def test_store_encodings_compressed_once(self):
+        import zlib
+        from repoze.accelerator.encoding import EncodingHandler
+        headers = [('Content-Type', 'text/html'),
+                   ('Cache-Control', 'max-age=400'),
+                   ('Vary', 'Accept-Encoding, Cookie')]
+        storage, handler = self._storeEncoded(headers,
+                                              HTTP_ACCEPT_ENCODING='gzip',
+                                              HTTP_COOKIE='1')
+        self.failUnless(isinstance(handler, EncodingHandler))
+        self.failUnless(storage.store_result.closed)
+        # the identity body is stored for all Accept-Encoding values
+        self.assertEqual(storage.discrims,
+                         (('env', ('REQUEST_METHOD', 'GET')),
+                          ('vary', ('cookie', '1'))))
+        self.assertEqual(storage.store_result.chunks, ['abc' * 200])
+        encoded = storage.extras['encodings']['gzip']
+        self.assertEqual(zlib.decompress(encoded, 16 + zlib.MAX_WBITS),
+                         'abc' * 200)
+
+    def test_store_encodings_not_compressible(self):
+        headers = [('Content-Type', 'image/png'),
+                   ('Cache-Control', 'max-age=400')]
+        storage, handler = self._storeEncoded(headers)
+        self.failUnless(handler is storage.store_result)
+        self.failIf('encodings' in storage.extras)
+
+    def test_store_encodings_disabled(self):
+        storage = DummyStorage(store_result=True)
+        policy = self._makeOne(storage)
+        headers = [('Content-Type', 'text/html'),
+                   ('Cache-Control', 'max-age=400')]
+        self.assertEqual(policy.store('200 OK', headers,
+                                      self._makeEnviron()), True)
+        self.assertEqual(storage.extras, {})
+
+    def _fetchEncoded(self, accept_encoding=None, encodings=None,
+                      **request):
+        import sys
+        headers = self._makeHeaders()
+        headers.extend([('Content-Type', 'text/plain'),
+                        ('ETag', '"abc"'),
+                        ('Content-Length', '10')])
+        if encodings is None:
+            encodings = {'gzip': 'GZIPPED'}
+        stored = ([], sys.maxint, '200 OK', headers, ['0123456789'],
+                  {'encodings': encodings})
+        storage = DummyStorage(fetch_result=[stored])
+        policy = self._makeOne(storage)
+        policy.encodings = ['gzip']
+        environ = self._makeEnviron()
+        if accept_encoding is not None:
+            environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        environ.update(request)
+        return headers, policy.fetch(environ)
+
+    def test_fetch_encoded(self):
+        headers, result = self._fetchEncoded('gzip, deflate')
+        status, headers, body = result
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers[1:], [('Content-Type', 'text/plain'),
+                                       ('ETag', '"abc-gzip"'),
+                                       ('Vary', 'Accept-Encoding'),
+                                       ('Content-Encoding', 'gzip'),
+                                       ('Content-Length', '7')])
+        self.assertEqual(body, ['GZIPPED'])
+
+    def test_fetch_encoded_identity(self):
+        stored_headers, result = self._fetchEncoded('deflate')
+        status, headers, body = result
+        self.assertEqual(headers, stored_headers +
+                         [('Vary', 'Accept-Encoding')])
+        self.assertEqual(body, ['0123456789'])
+
+    def test_fetch_not_encoded_when_disabled(self):
+        import sys
+        headers = self._makeHeaders()
+        stored = ([], sys.maxint, '200 OK', headers, ['0123456789'],
+                  {'encodings': {'gzip': 'GZIPPED'}})
+        policy = self._makeOne(DummyStorage(fetch_result=[stored]))
+        environ = self._makeEnviron()
+        environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        self.assertEqual(policy.fetch(environ),
+                         ('200 OK', headers, ['0123456789']))
+
+    def test_fetch_encoded_conditional(self):
+        headers, result = self._fetchEncoded(
+            'gzip', HTTP_IF_NONE_MATCH='"abc-gzip"')
+        self.assertEqual(result[0], '304 Not Modified')
+        self.assertEqual(dict(result[1])['ETag'], '"abc-gzip"')
+        headers, result = self._fetchEncoded(
+            'gzip', HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(result[0], '200 OK')
+
+    def test_fetch_encoded_range(self):
+        headers, result = self._fetchEncoded('gzip', HTTP_RANGE='bytes=0-3')
+        status, headers, body = result
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(dict(headers)['Content-Range'], 'bytes 0-3/7')
+        self.assertEqual(''.join(body), 'GZIP')
+
+    def _fetchCompressed(self, accept_encoding=None, encodings=(),
+                         headers=None, **request):
+        import sys
+        from repoze.accelerator.encoding import compress
+        from repoze.accelerator.storage import CompressedBody
+        if headers is None:
+            headers = [('Content-Type', 'text/plain'),
+                       ('ETag', '"abc"'),
+                       ('Content-Length', '100')]
+        body = CompressedBody(compress('gzip', 'x' * 100), 100)
+        stored = ([], sys.maxint, '200 OK', headers, body, {})
+        policy = self._makeOne(DummyStorage(fetch_result=[stored]))
+        policy.encodings = list(encodings)
+        environ = self._makeEnviron()
+        if accept_encoding is not None:
+            environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        environ.update(request)
+        return body, policy.fetch(environ)
+
+    def test_fetch_compressed_body_sent_as_gzip(self):
+        stored, (status, headers, body) = self._fetchCompressed('gzip')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('ETag', '"abc-gzip"'),
+                                   ('Vary', 'Accept-Encoding'),
+                                   ('Content-Encoding', 'gzip'),
+                                   ('Content-Length',
+                                    str(len(stored.data)))])
+        self.assertEqual(body, [stored.data])
+
+    def test_fetch_compressed_body_other_encodings(self):
+        stored, (status, headers, body) = self._fetchCompressed(
+            'gzip', encodings=['br'])
+        self.assertEqual(dict(headers)['Content-Encoding'], 'gzip')
+        self.assertEqual(body, [stored.data])
+
+    def test_fetch_compressed_body_identity(self):
+        stored, (status, headers, body) = self._fetchCompressed('deflate')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('ETag', '"abc"'),
+                                   ('Content-Length', '100'),
+                                   ('Vary', 'Accept-Encoding')])
+        self.failUnless(body is stored)
+        self.assertEqual(''.join(body), 'x' * 100)
+
+    def test_fetch_compressed_body_no_transform(self):
+        stored_headers = [('Content-Type', 'text/plain'),
+                          ('Cache-Control', 'no-transform')]
+        stored, (status, headers, body) = self._fetchCompressed(
+            'gzip', headers=stored_headers)
+        self.failUnless(body is stored)
+        self.assertEqual(headers, stored_headers)
+
+    def test_fetch_compressed_body_conditional(self):
+        stored, result = self._fetchCompressed(
+            'gzip', HTTP_IF_NONE_MATCH='"abc-gzip"')
+        self.assertEqual(result[0], '304 Not Modified')
+
 
 class Test_make_accelerator_policy(unittest.TestCase):
 
@@ -572,6 +1409,10 @@ class Test_make_accelerator_policy(unittest.TestCase):
         self.assertEqual(policy.store_https_responses, False)
         self.assertEqual(policy.always_vary_on_headers, [])
         self.assertEqual(policy.always_vary_on_environ, ['REQUEST_METHOD'])
+        self.assertEqual(policy.stale_grace, 0)
+        self.assertEqual(policy.encodings, [])
+        self.assertEqual(policy.compress_min_size, 256)
+        self.assertEqual(policy.hit_for_pass_ttl, 0)
         self.assertEqual(policy.logger, None)
 
     def test_make_accelerator_policy_factory_overrides(self):
@@ -579,15 +1420,30 @@ class Test_make_accelerator_policy(unittest.TestCase):
                   'policy.honor_shift_reload':'true',
                   'policy.store_https_responses':'true',
                   'policy.always_vary_on_headers':'Cookie X-Foo',
-                  'policy.always_vary_on_environ':'REMOTE_USER'}
+                  'policy.always_vary_on_environ':'REMOTE_USER',
+                  'policy.stale_grace':'30',
+                  'policy.encodings':'GZIP',
+                  'policy.compress_min_size':'1024',
+                  'policy.hit_for_pass_ttl':'2.5'}
         policy = self._getFUT()(None, DummyStorage(), config)
         self.assertEqual(policy.allowed_methods, ['POST', 'GET'])
         self.assertEqual(policy.honor_shift_reload, True)
         self.assertEqual(policy.store_https_responses, True)
         self.assertEqual(policy.always_vary_on_headers, ['Cookie', 'X-Foo'])
         self.assertEqual(policy.always_vary_on_environ, ['REMOTE_USER'])
+        self.assertEqual(policy.stale_grace, 30)
+        self.assertEqual(policy.encodings, ['gzip'])
+        self.assertEqual(policy.compress_min_size, 1024)
+        self.assertEqual(policy.hit_for_pass_ttl, 2.5)
         self.assertEqual(policy.logger, None)
 
+    def test_make_accelerator_policy_factory_unavailable_encoding(self):
+        logger = DummyLogger()
+        config = {'policy.encodings':'nonesuch gzip'}
+        policy = self._getFUT()(logger, DummyStorage(), config)
+        self.assertEqual(policy.encodings, ['gzip'])
+        self.assertEqual(len(logger.warnings), 1)
+
 
 class DummyStorage:
 
@@ -606,3 +1462,81 @@ class DummyStorage:
 
     def fetch(self, url):
         return self.fetch_result
+
+
+class DummyHandler:
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def close(self):
+        self.closed = True
+
+
+class DummyLogger:
+
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg, *args):
+        self.warnings.append(msg % args)
+
+
+class Test_parse_etags(unittest.TestCase):
+
+    def _callFUT(self, header):
+        from repoze.accelerator.policy import parse_etags
+        return parse_etags(header)
+
+    def test_star(self):
+        self.assertEqual(self._callFUT('*'), ['*'])
+
+    def test_list(self):
+        self.assertEqual(self._callFUT('"a", W/"b,c" ,"d"'),
+                         ['"a"', 'W/"b,c"', '"d"'])
+
+    def test_garbage(self):
+        self.assertEqual(self._callFUT('abc'), [])
+
+
+class Test_request_header(unittest.TestCase):
+
+    def _callFUT(self, environ, name):
+        from repoze.accelerator.policy import request_header
+        return request_header(environ, name)
+
+    def test_http_prefixed(self):
+        environ = {'HTTP_IF_NONE_MATCH': '"a"'}
+        self.assertEqual(self._callFUT(environ, 'If-None-Match'), '"a"')
+        self.assertEqual(self._callFUT(environ, 'if-none-match'), '"a"')
+
+    def test_unprefixed(self):
+        environ = {'CONTENT_TYPE': 'text/plain', 'CONTENT_LENGTH': '3',
+                   'HTTP_CONTENT_TYPE': 'wrong'}
+        self.assertEqual(self._callFUT(environ, 'Content-Type'), 'text/plain')
+        self.assertEqual(self._callFUT(environ, 'content-length'), '3')
+
+    def test_missing(self):
+        self.assertEqual(self._callFUT({}, 'Cookie'), None)
+
+
+class DummyVariantStorage(DummyStorage):
+
+    def __init__(self, variant):
+        from zope.interface import directlyProvides
+        from repoze.accelerator.interfaces import IVariantStorage
+        DummyStorage.__init__(self)
+        directlyProvides(self, IVariantStorage)
+        self.variant = variant
+
+    def fetch_variant(self, url, resolve):
+        self.url = url
+        if self.variant is not None:
+            self.resolved = [ resolve(typ, name) for typ, (name, value)
+                              in self.variant[0] ]
+        return self.variant
@@ -0,0 +1,87 @@
+import unittest
+
+class Test_parse_range(unittest.TestCase):
+
+    def _callFUT(self, header, length=10):
+        from repoze.accelerator.ranges import parse_range
+        return parse_range(header, length)
+
+    def test_not_bytes(self):
+        self.assertEqual(self._callFUT('items=0-1'), None)
+
+    def test_no_specs(self):
+        self.assertEqual(self._callFUT('bytes='), None)
+
+    def test_too_many_specs(self):
+        from repoze.accelerator.ranges import MAX_RANGES
+        header = 'bytes=' + ','.join(['0-0'] * (MAX_RANGES + 1))
+        self.assertEqual(self._callFUT(header), None)
+
+    def test_no_dash(self):
+        self.assertEqual(self._callFUT('bytes=5'), None)
+
+    def test_not_numeric(self):
+        self.assertEqual(self._callFUT('bytes=a-5'), None)
+        self.assertEqual(self._callFUT('bytes=1-b'), None)
+
+    def test_empty_spec(self):
+        self.assertEqual(self._callFUT('bytes=-'), None)
+
+    def test_last_before_first(self):
+        self.assertEqual(self._callFUT('bytes=5-4'), None)
+
+    def test_closed(self):
+        self.assertEqual(self._callFUT('bytes=2-4'), [(2, 5)])
+
+    def test_closed_past_end(self):
+        self.assertEqual(self._callFUT('bytes=8-40'), [(8, 10)])
+
+    def test_open(self):
+        self.assertEqual(self._callFUT('bytes=7-'), [(7, 10)])
+
+    def test_suffix(self):
+        self.assertEqual(self._callFUT('bytes=-3'), [(7, 10)])
+
+    def test_suffix_longer_than_body(self):
+        self.assertEqual(self._callFUT('bytes=-30'), [(0, 10)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(self._callFUT('bytes=10-20'), [])
+        self.assertEqual(self._callFUT('bytes=-0'), [])
+
+    def test_multiple_sorted_and_coalesced(self):
+        self.assertEqual(self._callFUT('bytes=8-, 0-1, 1-3, 4-4, 20-30'),
+                         [(0, 5), (8, 10)])
+
+
+class Test_slice_body(unittest.TestCase):
+
+    def _callFUT(self, body, start, stop):
+        from repoze.accelerator.ranges import slice_body
+        return list(slice_body(body, start, stop))
+
+    def test_whole_chunks_not_copied(self):
+        chunk = 'def'
+        result = self._callFUT(['abc', chunk, 'ghi'], 3, 6)
+        self.assertEqual(result, ['def'])
+        self.failUnless(result[0] is chunk)
+
+    def test_spanning_chunks(self):
+        self.assertEqual(self._callFUT(['abc', 'def', 'ghi'], 2, 7),
+                         ['c', 'def', 'g'])
+
+    def test_within_chunk(self):
+        self.assertEqual(self._callFUT(['abcdefghi'], 2, 4), ['cd'])
+
+    def test_stops_consuming_body(self):
+        def body():
+            yield 'abc'
+            raise AssertionError('consumed too far') #pragma NO COVER
+        self.assertEqual(self._callFUT(body(), 0, 2), ['ab'])
+
+
+class Test_body_length(unittest.TestCase):
+
+    def test_it(self):
+        from repoze.accelerator.ranges import body_length
+        self.assertEqual(body_length(['abc', '', 'de']), 5)
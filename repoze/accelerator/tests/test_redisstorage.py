@@ -0,0 +1,405 @@
+import sys
+import unittest
+
+class TestRedisStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeRedisServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def _getTargetClass(self):
+        from repoze.accelerator.redisstorage import RedisStorage
+        return RedisStorage
+
+    def _makeOne(self, **kw):
+        kw.setdefault('port', self.server.port)
+        return self._getTargetClass()(DummyLogger(), '127.0.0.1', **kw)
+
+    def _storeOne(self, storage, url, body, discriminators=(),
+                  expires=sys.maxint, **extras):
+        handler = storage.store(url, discriminators, expires, '200 OK',
+                                [('Content-Type', 'text/plain')], **extras)
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def test_class_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IStorage
+        verifyClass(IStorage, self._getTargetClass())
+
+    def test_instance_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorage
+        verifyObject(IStorage, self._makeOne())
+
+    def test_factory_provides_IStorageFactory(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorageFactory
+        from repoze.accelerator.redisstorage import make_redis_storage
+        verifyObject(IStorageFactory, make_redis_storage)
+
+    def test_factory(self):
+        from repoze.accelerator.redisstorage import make_redis_storage
+        storage = make_redis_storage(None, {'storage.host':'cache',
+                                            'storage.port':'6380',
+                                            'storage.db':'2',
+                                            'storage.prefix':'app:',
+                                            'storage.pool_size':'4',
+                                            'storage.timeout':'0.5'})
+        self.assertEqual(storage.prefix, 'app:')
+        self.assertEqual(storage.pool.host, 'cache')
+        self.assertEqual(storage.pool.port, 6380)
+        self.assertEqual(storage.pool.db, 2)
+        self.assertEqual(storage.pool.size, 4)
+        self.assertEqual(storage.pool.timeout, 0.5)
+
+    def test_fetch_nonexistent(self):
+        storage = self._makeOne()
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_store_and_fetch(self):
+        storage = self._makeOne()
+        discrims = (('env', ('REQUEST_METHOD', 'GET')),)
+        self._storeOne(storage, 'url', ['chunk1', 'chunk2'], discrims,
+                       stale_until=sys.maxint)
+        entries = storage.fetch('url')
+        self.assertEqual(len(entries), 1)
+        discriminators, expires, status, headers, body, extras = entries[0]
+        self.assertEqual(discriminators, discrims)
+        self.assertEqual(expires, sys.maxint)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('Content-Length', '12')])
+        self.assertEqual(extras['stale_until'], sys.maxint)
+        self.assertEqual(body, ['chunk1chunk2'])
+        self.assertEqual(body.length, 12)
+
+    def test_store_variants(self):
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        d2 = (('vary', ('cookie', '2')),)
+        self._storeOne(storage, 'url', ['one'], d1)
+        self._storeOne(storage, 'url', ['two'], d2)
+        self._storeOne(storage, 'url', ['three'], d1)
+        entries = storage.fetch('url')
+        bodies = sorted([ (entry[0], entry[4][0]) for entry in entries ])
+        self.assertEqual(bodies, [(d1, 'three'), (d2, 'two')])
+        self.assertEqual(self.server.commands.count('MGET'), 1)
+
+    def test_store_sets_ttl(self):
+        import time
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'], expires=time.time() + 100)
+        self._storeOne(storage, 'url', ['abc'], (('vary', ('a', 'b')),),
+                       expires=time.time() + 10, stale_until=time.time() + 50)
+        ttls = sorted([ int(round(deadline - time.time()))
+                        for deadline in self.server.expires.values() ])
+        # two entries, and the set of them, which lasts as long as the
+        # longest-lived
+        self.assertEqual(ttls, [50, 100, 100])
+
+    def test_store_without_expiry_is_dropped(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'], expires=None)
+        self.assertEqual(self.server.data, {})
+        self.assertEqual(storage.logger.warnings, [])
+
+    def test_store_expired_is_dropped(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'], expires=0)
+        self.assertEqual(self.server.data, {})
+
+    def test_fetch_forgets_expired_variants(self):
+        import time
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        self._storeOne(storage, 'url', ['one'], d1, expires=time.time() + 10)
+        self._storeOne(storage, 'url', ['two'])
+        for key in self.server.expires.keys():
+            if not isinstance(self.server.data[key], set):
+                if self.server.expires[key] < time.time() + 20:
+                    self.server.expires[key] = 0
+        entries = storage.fetch('url')
+        self.assertEqual([ entry[4] for entry in entries ], [['two']])
+        members = [ value for value in self.server.data.values()
+                    if isinstance(value, set) ][0]
+        self.assertEqual(len(members), 1)
+
+    def test_server_down_misses(self):
+        self.server.close()
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'])
+        self.assertEqual(storage.fetch('url'), None)
+        self.assertEqual(len(storage.logger.warnings), 2)
+        self.assertEqual(storage.pool.created, 0)
+
+    def test_server_down_not_retried_at_once(self):
+        from repoze.accelerator.redisstorage import RedisError
+        self.server.close()
+        storage = self._makeOne(retry_interval=60)
+        self.assertEqual(storage.fetch('url'), None)
+        self.assertRaises(RedisError, storage.pool.acquire)
+
+    def test_pool_exhausted_misses(self):
+        storage = self._makeOne(pool_size=1)
+        self._storeOne(storage, 'url', ['abc'])
+        connection = storage.pool.acquire()
+        try:
+            self.assertEqual(storage.fetch('url'), None)
+        finally:
+            storage.pool.release(connection)
+        self.assertEqual(storage.fetch('url')[0][4], ['abc'])
+
+    def test_connections_are_reused(self):
+        storage = self._makeOne()
+        for i in range(5):
+            self._storeOne(storage, 'url%d' % i, ['abc'])
+            storage.fetch('url%d' % i)
+        self.assertEqual(storage.pool.created, 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_broken_connection_is_replaced(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'])
+        self.server.drop_connections()
+        self.assertEqual(storage.fetch('url'), None)
+        self.assertEqual(storage.pool.created, 0)
+        self.assertEqual(storage.fetch('url')[0][4], ['abc'])
+
+    def test_failed_select_closes_connection(self):
+        import socket
+        from repoze.accelerator import redisstorage as module
+        created = []
+        class DummySocketModule:
+            def create_connection(self, address, timeout):
+                sock = socket.create_connection(address, timeout)
+                created.append(sock)
+                return sock
+        module.socket, saved = DummySocketModule(), module.socket
+        try:
+            # (the fake server knows no SELECT command)
+            self.assertRaises(module.RedisError, module.RedisConnection,
+                              '127.0.0.1', self.server.port, 1.0, 1)
+        finally:
+            module.socket = saved
+        self.assertRaises(socket.error, created[0].fileno)
+
+    def test_error_reply_keeps_connection(self):
+        from repoze.accelerator.redisstorage import RedisError
+        storage = self._makeOne()
+        self.assertRaises(RedisError, storage.pool.execute, ('BOGUS',))
+        self.assertEqual(storage.pool.created, 1)
+        self.assertEqual(len(storage.pool.idle), 1)
+
+class Test_read_reply(unittest.TestCase):
+
+    def _callFUT(self, data):
+        from StringIO import StringIO
+        from repoze.accelerator.redisstorage import read_reply
+        return read_reply(StringIO(data))
+
+    def test_simple(self):
+        self.assertEqual(self._callFUT('+OK\r\n'), 'OK')
+
+    def test_error(self):
+        from repoze.accelerator.redisstorage import RedisError
+        error = self._callFUT('-ERR wrong\r\n')
+        self.failUnless(isinstance(error, RedisError))
+        self.assertEqual(str(error), 'ERR wrong')
+
+    def test_integer(self):
+        self.assertEqual(self._callFUT(':42\r\n'), 42)
+
+    def test_bulk(self):
+        self.assertEqual(self._callFUT('$5\r\na\r\nbc\r\n'), 'a\r\nbc')
+        self.assertEqual(self._callFUT('$-1\r\n'), None)
+
+    def test_array(self):
+        self.assertEqual(self._callFUT('*3\r\n$1\r\na\r\n$-1\r\n:1\r\n'),
+                         ['a', None, 1])
+        self.assertEqual(self._callFUT('*-1\r\n'), None)
+
+    def test_truncated(self):
+        from repoze.accelerator.redisstorage import ProtocolError
+        self.assertRaises(ProtocolError, self._callFUT, '')
+        self.assertRaises(ProtocolError, self._callFUT, '$5\r\nab')
+        self.assertRaises(ProtocolError, self._callFUT, ':x\r\n')
+        self.assertRaises(ProtocolError, self._callFUT, '?1\r\n')
+
+class Test_encode_command(unittest.TestCase):
+
+    def _callFUT(self, args):
+        from repoze.accelerator.redisstorage import encode_command
+        return encode_command(args)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT(('SET', 'k', u'\xe9', 'EX', 10)),
+                         '*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$2\r\n\xc3\xa9\r\n'
+                         '$2\r\nEX\r\n$2\r\n10\r\n')
+
+class Test_dumps_value(unittest.TestCase):
+
+    def test_roundtrip(self):
+        from repoze.accelerator.redisstorage import dumps_value
+        from repoze.accelerator.redisstorage import loads_value
+        discrims = (('vary', ('cookie', '1')),)
+        data = dumps_value(discrims, 10, '200 OK', [('A', 'b')], {'x':1},
+                           'body\0bytes')
+        self.assertEqual(loads_value(data),
+                         (discrims, 10, '200 OK', [('A', 'b')], {'x':1},
+                          'body\0bytes'))
+
+    def test_garbage(self):
+        from repoze.accelerator.redisstorage import loads_value
+        self.assertRaises(ValueError, loads_value, 'xy')
+        self.assertRaises(ValueError, loads_value, '\0\0\0\3abcbody')
+
+class FakeRedisServer:
+    """ Enough of a Redis server, in a thread, for RedisStorage.
+    """
+    def __init__(self):
+        import socket
+        import threading
+        self.data = {}
+        self.expires = {}
+        self.commands = []
+        self.connections = 0
+        self.sockets = []
+        self.lock = threading.Lock()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def close(self):
+        import socket
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        import socket
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        self.sockets = []
+
+    def _accept(self):
+        import socket
+        import threading
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            self.sockets.append(sock)
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _serve(self, sock):
+        import socket
+        from repoze.accelerator.redisstorage import read_reply
+        reader = sock.makefile('rb')
+        try:
+            while True:
+                try:
+                    args = read_reply(reader)
+                except Exception:
+                    return
+                self.lock.acquire()
+                try:
+                    reply = self._execute(args)
+                finally:
+                    self.lock.release()
+                sock.sendall(_encode_reply(reply))
+        except socket.error:
+            pass
+
+    def _get(self, key):
+        import time
+        if self.expires.get(key, time.time() + 1) <= time.time():
+            del self.data[key]
+            del self.expires[key]
+        return self.data.get(key)
+
+    def _execute(self, args):
+        import time
+        name = args[0].upper()
+        self.commands.append(name)
+        if name == 'GET':
+            return self._get(args[1])
+        if name == 'MGET':
+            return [ self._get(key) for key in args[1:] ]
+        if name == 'SET':
+            self.data[args[1]] = args[2]
+            self.expires.pop(args[1], None)
+            if len(args) == 5 and args[3].upper() == 'EX':
+                self.expires[args[1]] = time.time() + int(args[4])
+            return Status('OK')
+        if name == 'SADD':
+            members = self._get(args[1])
+            if members is None:
+                members = self.data[args[1]] = set()
+            added = len(set(args[2:]) - members)
+            members.update(args[2:])
+            return added
+        if name == 'SREM':
+            members = self._get(args[1]) or set()
+            removed = len(set(args[2:]) & members)
+            members.difference_update(args[2:])
+            return removed
+        if name == 'SMEMBERS':
+            return sorted(self._get(args[1]) or ())
+        if name == 'TTL':
+            if self._get(args[1]) is None:
+                return -2
+            if args[1] not in self.expires:
+                return -1
+            return int(self.expires[args[1]] - time.time())
+        if name == 'EXPIRE':
+            if self._get(args[1]) is None:
+                return 0
+            self.expires[args[1]] = time.time() + int(args[2])
+            return 1
+        return Error('ERR unknown command %r' % name)
+
+class Status(str):
+    pass
+
+class Error(str):
+    pass
+
+def _encode_reply(reply):
+    if reply is None:
+        return '$-1\r\n'
+    if isinstance(reply, Status):
+        return '+%s\r\n' % reply
+    if isinstance(reply, Error):
+        return '-%s\r\n' % reply
+    if isinstance(reply, int):
+        return ':%d\r\n' % reply
+    if isinstance(reply, list):
+        return '*%d\r\n%s' % (len(reply),
+                              ''.join([ _encode_reply(x) for x in reply ]))
+    return '$%d\r\n%s\r\n' % (len(reply), reply)
+
+class DummyLogger:
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg, *args):
+        self.warnings.append(msg % args)
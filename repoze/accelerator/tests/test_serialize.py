@@ -0,0 +1,61 @@
+import unittest
+
+class Test_dumps_loads(unittest.TestCase):
+
+    def _roundtrip(self, obj):
+        from repoze.accelerator.serialize import dumps
+        from repoze.accelerator.serialize import loads
+        return loads(dumps(obj))
+
+    def test_scalars(self):
+        for obj in (None, True, False, 0, -1, 2**62, 2**70, -2**70, 1.5,
+                    '', 'abc\x00\xff', u'\xe9'):
+            result = self._roundtrip(obj)
+            self.assertEqual(result, obj)
+            self.assertEqual(type(result), type(obj))
+
+    def test_containers(self):
+        obj = {'headers':[('Content-Type', 'text/html')],
+               'discrims':(('env', ('REQUEST_METHOD', 'GET')),),
+               1:{}}
+        self.assertEqual(self._roundtrip(obj), obj)
+
+    def test_unserializable(self):
+        from repoze.accelerator.serialize import dumps
+        self.assertRaises(TypeError, dumps, object())
+
+    def test_loads_trailing_data(self):
+        from repoze.accelerator.serialize import dumps
+        from repoze.accelerator.serialize import loads
+        self.assertRaises(ValueError, loads, dumps(1) + 'x')
+
+    def test_loads_truncated(self):
+        from repoze.accelerator.serialize import dumps
+        from repoze.accelerator.serialize import loads
+        data = dumps(['abc', 1])
+        for i in range(len(data)):
+            self.assertRaises(ValueError, loads, data[:i])
+
+    def test_loads_unknown_tag(self):
+        from repoze.accelerator.serialize import loads
+        self.assertRaises(ValueError, loads, 'X\x00\x00\x00\x00')
+
+
+class Test_dumps_entry_loads_entry(unittest.TestCase):
+
+    def test_roundtrip(self):
+        from repoze.accelerator.serialize import dumps_entry
+        from repoze.accelerator.serialize import loads_entry
+        discrims = (('vary', ('cookie', '1')),)
+        headers = [('Content-Type', 'text/html')]
+        data = dumps_entry(discrims, 10.5, '200 OK', headers, {'a':1})
+        self.assertEqual(loads_entry(data),
+                         (discrims, 10.5, '200 OK', headers, {'a':1}))
+
+    def test_bad_magic(self):
+        from repoze.accelerator.serialize import loads_entry
+        self.assertRaises(ValueError, loads_entry, 'XYZ\x01N')
+
+    def test_bad_version(self):
+        from repoze.accelerator.serialize import loads_entry
+        self.assertRaises(ValueError, loads_entry, 'RAE\x02N')
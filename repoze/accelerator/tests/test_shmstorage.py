@@ -0,0 +1,182 @@
+import sys
+import unittest
+
+class TestSharedMemoryStorage(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.storages = []
+
+    def tearDown(self):
+        import shutil
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.dir)
+
+    def _getTargetClass(self):
+        from repoze.accelerator.shmstorage import SharedMemoryStorage
+        return SharedMemoryStorage
+
+    def _makeOne(self, arena_size=1 << 20, index_slots=64):
+        import os
+        path = os.path.join(self.dir, 'arena')
+        storage = self._getTargetClass()(None, path, arena_size, index_slots)
+        self.storages.append(storage)
+        return storage
+
+    def _storeOne(self, storage, url, body, discriminators=(),
+                  expires=sys.maxint, **extras):
+        handler = storage.store(url, discriminators, expires, '200 OK',
+                                [('Content-Type', 'text/plain')], **extras)
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def test_class_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IStorage
+        verifyClass(IStorage, self._getTargetClass())
+
+    def test_instance_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorage
+        verifyObject(IStorage, self._makeOne())
+
+    def test_factory_provides_IStorageFactory(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorageFactory
+        from repoze.accelerator.shmstorage import make_shm_storage
+        verifyObject(IStorageFactory, make_shm_storage)
+
+    def test_factory(self):
+        import os
+        from repoze.accelerator.shmstorage import make_shm_storage
+        path = os.path.join(self.dir, 'cache')
+        storage = make_shm_storage(None, {'storage.path':path,
+                                          'storage.arena_size':'1048576',
+                                          'storage.index_slots':'128'})
+        self.storages.append(storage)
+        self.assertEqual(storage.path, path)
+        self.assertEqual(storage.arena_size, 1 << 20)
+        self.assertEqual(storage.index_slots, 128)
+        self.assertEqual(os.path.getsize(path), 1 << 20)
+
+    def test_arena_too_small(self):
+        self.assertRaises(ValueError, self._makeOne, 8192, 1024)
+
+    def test_fetch_nonexistent(self):
+        storage = self._makeOne()
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_store_and_fetch(self):
+        storage = self._makeOne()
+        discrims = (('env', ('REQUEST_METHOD', 'GET')),)
+        self._storeOne(storage, 'url', ['chunk1', 'chunk2'], discrims, 10,
+                       stale_until=20)
+        entries = storage.fetch('url')
+        self.assertEqual(len(entries), 1)
+        discriminators, expires, status, headers, body, extras = entries[0]
+        self.assertEqual(discriminators, discrims)
+        self.assertEqual(expires, 10)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('Content-Length', '12')])
+        self.assertEqual(extras['stale_until'], 20)
+        self.assertEqual(body, ['chunk1chunk2'])
+        self.assertEqual(body.length, 12)
+
+    def test_store_variants_and_replace(self):
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        d2 = (('vary', ('cookie', '2')),)
+        self._storeOne(storage, 'url', ['one'], d1)
+        self._storeOne(storage, 'url', ['two'], d2)
+        self._storeOne(storage, 'url', ['three'], d1)
+        entries = storage.fetch('url')
+        bodies = sorted([ (entry[0], entry[4][0]) for entry in entries ])
+        self.assertEqual(bodies, [(d1, 'three'), (d2, 'two')])
+
+    def test_shared_between_instances(self):
+        writer = self._makeOne()
+        reader = self._makeOne()
+        self._storeOne(writer, 'url', ['abc'])
+        self.assertEqual(reader.fetch('url')[0][4], ['abc'])
+
+    def test_shared_with_forked_process(self):
+        import os
+        storage = self._makeOne()
+        pid = os.fork()
+        if not pid: # child
+            try:
+                self._storeOne(storage, 'url', ['from child'])
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(storage.fetch('url')[0][4], ['from child'])
+
+    def test_different_layout_is_reformatted(self):
+        self._storeOne(self._makeOne(), 'url', ['abc'])
+        self.assertEqual(self._makeOne(index_slots=128).fetch('url'), None)
+
+    def test_too_large_not_stored(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['x' * (1 << 20)])
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_without_expiry_not_stored(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'], expires=None)
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_slab_reuse_invalidates_oldest(self):
+        storage = self._makeOne(index_slots=1024)
+        size, count, offset = storage.slabs[0]
+        for i in range(count + 1):
+            self._storeOne(storage, 'url%d' % i, ['abc'])
+        self.assertEqual(storage.fetch('url0'), None)
+        self.assertEqual(storage.fetch('url1')[0][4], ['abc'])
+        self.assertEqual(storage.fetch('url%d' % count)[0][4], ['abc'])
+
+    def test_full_bucket_drops_soonest_expiring(self):
+        from repoze.accelerator.shmstorage import PROBE
+        storage = self._makeOne(index_slots=PROBE)
+        for i in range(PROBE):
+            self._storeOne(storage, 'url%d' % i, ['abc'], expires=100 + i)
+        self._storeOne(storage, 'new', ['abc'])
+        self.assertEqual(storage.fetch('url0'), None)
+        self.assertEqual(storage.fetch('url1')[0][1], 101)
+        self.assertEqual(storage.fetch('new')[0][4], ['abc'])
+
+    def test_corrupt_slot_reads_as_miss(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['abc'])
+        size, count, offset = storage.slabs[0]
+        # as if a writer died half way through the body
+        end = storage.arena.find('abc', offset)
+        storage.arena[end:end + 3] = 'xyz'
+        self.assertEqual(storage.fetch('url'), None)
+        self._storeOne(storage, 'url', ['abc'])
+        self.assertEqual(storage.fetch('url')[0][4], ['abc'])
+
+    def test_torn_record_reads_as_miss(self):
+        from repoze.accelerator.shmstorage import RECORD_SIZE
+        storage = self._makeOne(index_slots=1)
+        self._storeOne(storage, 'url', ['abc'])
+        record = storage.index_offset
+        self.assertNotEqual(storage.arena[record:record + 8], '\0' * 8)
+        storage.arena[record + RECORD_SIZE - 1] = 'X'
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_purge(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url1', ['abc'], expires=10)
+        self._storeOne(storage, 'url2', ['abc'], expires=10, stale_until=30)
+        self._storeOne(storage, 'url3', ['abc'], expires=50)
+        count, size = storage.purge(now=20)
+        self.assertEqual(count, 1)
+        self.failUnless(size > 3)
+        self.assertEqual(storage.fetch('url1'), None)
+        self.failIf(storage.fetch('url2') is None)
+        self.failIf(storage.fetch('url3') is None)
+        self.assertEqual(storage.purge(now=20), (0, 0))
@@ -0,0 +1,57 @@
+import unittest
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def _write(self, entries):
+        from repoze.accelerator.snapshot import write_snapshot
+        return write_snapshot(self.path, entries)
+
+    def _read(self):
+        from repoze.accelerator.snapshot import read_snapshot
+        return list(read_snapshot(self.path))
+
+    def test_roundtrip(self):
+        entries = [
+            ('url1', (('vary', ('cookie', '1')),), 10, '200 OK',
+             [('Content-Type', 'text/plain')], {'stale_until':20}, 'abc'),
+            ('url2', (), 30, '203 Non-Authoritative Information', [], {},
+             ''),
+            ]
+        self.assertEqual(self._write(iter(entries)), (2, 3))
+        self.assertEqual(self._read(), entries)
+
+    def test_replaces_atomically(self):
+        import os
+        self._write([('url', (), 10, '200 OK', [], {}, 'old')])
+        def entries():
+            yield ('url', (), 10, '200 OK', [], {}, 'new')
+            raise KeyError
+        self.assertRaises(KeyError, self._write, entries())
+        self.assertEqual(self._read()[0][6], 'old')
+        self.assertEqual(os.listdir(self.dir), ['snapshot'])
+
+    def test_not_a_snapshot(self):
+        open(self.path, 'wb').write('garbage')
+        self.assertRaises(ValueError, self._read)
+
+    def test_unsupported_version(self):
+        from repoze.accelerator.snapshot import MAGIC
+        open(self.path, 'wb').write(MAGIC + chr(99))
+        self.assertRaises(ValueError, self._read)
+
+    def test_truncated_record_ignored(self):
+        self._write([('url1', (), 10, '200 OK', [], {}, 'abc'),
+                     ('url2', (), 10, '200 OK', [], {}, 'def')])
+        data = open(self.path, 'rb').read()
+        open(self.path, 'wb').write(data[:-1])
+        self.assertEqual([ entry[0] for entry in self._read() ], ['url1'])
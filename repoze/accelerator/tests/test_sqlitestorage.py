@@ -0,0 +1,258 @@
+import sys
+import time
+import unittest
+
+class TestSQLiteStorage(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        # (connections of finished threads may be removing their files)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _getTargetClass(self):
+        from repoze.accelerator.sqlitestorage import SQLiteStorage
+        return SQLiteStorage
+
+    def _makeOne(self):
+        import os
+        path = os.path.join(self.dir, 'cache.sqlite')
+        return self._getTargetClass()(None, path)
+
+    def _storeOne(self, storage, url, body, discriminators=(),
+                  expires=sys.maxint, **extras):
+        handler = storage.store(url, discriminators, expires, '200 OK',
+                                [('Content-Type', 'text/plain')], **extras)
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def test_class_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IStorage
+        verifyClass(IStorage, self._getTargetClass())
+
+    def test_instance_conforms_to_IStorage(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorage
+        verifyObject(IStorage, self._makeOne())
+
+    def test_factory_provides_IStorageFactory(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IStorageFactory
+        from repoze.accelerator.sqlitestorage import make_sqlite_storage
+        verifyObject(IStorageFactory, make_sqlite_storage)
+
+    def test_factory(self):
+        import os
+        from repoze.accelerator.sqlitestorage import make_sqlite_storage
+        path = os.path.join(self.dir, 'other.sqlite')
+        storage = make_sqlite_storage(None, {'storage.path':path,
+                                             'storage.timeout':'2',
+                                             'storage.body_grace':'10'})
+        self.assertEqual(storage.path, path)
+        self.assertEqual(storage.timeout, 2.0)
+        self.assertEqual(storage.body_grace, 10.0)
+        self.assertEqual(storage.purge_interval, 0)
+        self.failUnless(os.path.exists(path))
+
+    def test_wal_mode(self):
+        storage = self._makeOne()
+        mode, = storage.connection().execute(
+            'PRAGMA journal_mode').fetchone()
+        self.assertEqual(mode, 'wal')
+
+    def test_connection_per_thread(self):
+        import threading
+        storage = self._makeOne()
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(storage.connection()))
+        thread.start()
+        thread.join()
+        self.failUnless(storage.connection() is storage.connection())
+        self.failIf(connections[0] is storage.connection())
+
+    def test_fetch_nonexistent(self):
+        storage = self._makeOne()
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_store_and_fetch(self):
+        storage = self._makeOne()
+        discrims = (('env', ('REQUEST_METHOD', 'GET')),)
+        self._storeOne(storage, 'url', ['chunk1', 'chunk2'], discrims, 10,
+                       stale_until=20)
+        entries = storage.fetch('url')
+        self.assertEqual(len(entries), 1)
+        discriminators, expires, status, headers, body, extras = entries[0]
+        self.assertEqual(discriminators, discrims)
+        self.assertEqual(expires, 10)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers, [('Content-Type', 'text/plain'),
+                                   ('Content-Length', '12')])
+        self.assertEqual(extras, {'stale_until':20})
+        self.assertEqual(body.length, 12)
+        self.assertEqual(list(body), ['chunk1chunk2'])
+
+    def test_empty_body(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', [])
+        self.assertEqual(list(storage.fetch('url')[0][4]), [])
+
+    def test_entries_survive_restart(self):
+        self._storeOne(self._makeOne(), 'url', ['abc'])
+        entries = self._makeOne().fetch('url')
+        self.assertEqual(''.join(entries[0][4]), 'abc')
+
+    def test_store_variants_and_replace(self):
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        d2 = (('vary', ('cookie', '2')),)
+        self._storeOne(storage, 'url', ['one'], d1)
+        self._storeOne(storage, 'url', ['two'], d2)
+        self._storeOne(storage, 'url', ['three'], d1)
+        entries = storage.fetch('url')
+        bodies = sorted([ (entry[0], ''.join(entry[4]))
+                          for entry in entries ])
+        self.assertEqual(bodies, [(d1, 'three'), (d2, 'two')])
+        # the replaced body is kept until purged after the grace period
+        chunks, = storage.connection().execute(
+            'SELECT count(*) FROM chunks').fetchone()
+        self.assertEqual(chunks, 3)
+        storage.purge(now=time.time() + storage.body_grace)
+        chunks, = storage.connection().execute(
+            'SELECT count(*) FROM chunks').fetchone()
+        self.assertEqual(chunks, 2)
+
+    def test_store_without_expiry_not_kept(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['old'])
+        self._storeOne(storage, 'url', ['new'], expires=None)
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_store_reaps_bodies_past_grace(self):
+        from repoze.accelerator.sqlitestorage import BLOCK_SIZE
+        storage = self._makeOne()
+        body = 'x' * (BLOCK_SIZE * 2)
+        for i in range(5):
+            self._storeOne(storage, 'url', [body])
+        chunks, = storage.connection().execute(
+            'SELECT count(*) FROM chunks').fetchone()
+        self.assertEqual(chunks, 10)
+        storage.body_grace = 0
+        self._storeOne(storage, 'url', [body])
+        chunks, = storage.connection().execute(
+            'SELECT count(*) FROM chunks').fetchone()
+        self.assertEqual(chunks, 4)
+        dead, = storage.connection().execute(
+            'SELECT count(*) FROM dead').fetchone()
+        self.assertEqual(dead, 1)
+        self.assertEqual(''.join(storage.fetch('url')[0][4]), body)
+
+    def test_purge_interval_thread(self):
+        import os
+        path = os.path.join(self.dir, 'cache.sqlite')
+        storage = self._getTargetClass()(None, path, purge_interval=0.01)
+        self._storeOne(storage, 'url', ['abc'], expires=time.time() + 0.02)
+        for i in range(500):
+            if storage.fetch('url') is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(storage.fetch('url'), None)
+
+    def test_body_replaced_between_fetch_and_iteration(self):
+        storage = self._makeOne()
+        data = ''.join([ chr(i % 251) for i in xrange(200000) ])
+        self._storeOne(storage, 'url', [data])
+        body = storage.fetch('url')[0][4]
+        self._storeOne(storage, 'url', ['new'])
+        self.assertEqual(''.join(body), data)
+        self.assertEqual(''.join(storage.fetch('url')[0][4]), 'new')
+
+    def test_body_purged_between_fetch_and_iteration(self):
+        storage = self._makeOne()
+        data = ''.join([ chr(i % 251) for i in xrange(200000) ])
+        self._storeOne(storage, 'url', [data], expires=time.time() + 10)
+        body = storage.fetch('url')[0][4]
+        self.assertEqual(storage.purge(now=time.time() + 20),
+                         (1, len(data)))
+        self.assertEqual(''.join(body), data)
+        storage.purge(now=time.time() + 20 + storage.body_grace)
+        chunks, = storage.connection().execute(
+            'SELECT count(*) FROM chunks').fetchone()
+        self.assertEqual(chunks, 0)
+
+    def test_large_body_in_blocks(self):
+        from repoze.accelerator.sqlitestorage import BLOCK_SIZE
+        storage = self._makeOne()
+        data = ''.join([ chr(i % 251) for i in xrange(BLOCK_SIZE * 2 + 10) ])
+        self._storeOne(storage, 'url', [data[:5], data[5:]])
+        body = storage.fetch('url')[0][4]
+        blocks = list(body)
+        self.assertEqual([ len(block) for block in blocks ],
+                         [BLOCK_SIZE, BLOCK_SIZE, 10])
+        self.assertEqual(''.join(blocks), data)
+        self.assertEqual(''.join(body.iter_range(BLOCK_SIZE - 2,
+                                                 BLOCK_SIZE * 2 + 3)),
+                         data[BLOCK_SIZE - 2:BLOCK_SIZE * 2 + 3])
+        self.assertEqual(''.join(body.iter_range(3, 7)), data[3:7])
+        self.assertEqual(''.join(body.iter_range(BLOCK_SIZE + 1,
+                                                 BLOCK_SIZE + 4)),
+                         data[BLOCK_SIZE + 1:BLOCK_SIZE + 4])
+        self.assertEqual(list(body.iter_range(5, 5)), [])
+
+    def test_body_read_from_snapshot(self):
+        import threading
+        from repoze.accelerator.sqlitestorage import BLOCK_SIZE
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['a' * (BLOCK_SIZE * 3)])
+        blocks = iter(storage.fetch('url')[0][4])
+        self.assertEqual(blocks.next(), 'a' * BLOCK_SIZE)
+        self.assertEqual(blocks.next(), 'a' * BLOCK_SIZE)
+        # replaced by another thread while being sent
+        thread = threading.Thread(target=self._storeOne,
+                                  args=(storage, 'url', ['b' * 10]))
+        thread.start()
+        thread.join()
+        self.assertEqual(list(blocks), ['a' * BLOCK_SIZE])
+        self.assertEqual(list(storage.fetch('url')[0][4]), ['b' * 10])
+
+    def test_body_close_finishes_statement(self):
+        from repoze.accelerator.sqlitestorage import BLOCK_SIZE
+        storage = self._makeOne()
+        self._storeOne(storage, 'url', ['a' * (BLOCK_SIZE * 3)])
+        body = storage.fetch('url')[0][4]
+        blocks = iter(body)
+        blocks.next()
+        blocks.next()
+        self.failIf(body._cursor is None)
+        body.close()
+        self.assertEqual(body._cursor, None)
+
+    def test_purge(self):
+        storage = self._makeOne()
+        self._storeOne(storage, 'url1', ['abc'], expires=10)
+        self._storeOne(storage, 'url2', ['abcd'], expires=10,
+                       stale_until=30)
+        self._storeOne(storage, 'url3', ['abcde'], expires=50)
+        self.assertEqual(storage.purge(now=20), (1, 3))
+        self.assertEqual(storage.fetch('url1'), None)
+        self.failIf(storage.fetch('url2') is None)
+        self.failIf(storage.fetch('url3') is None)
+        self.assertEqual(storage.purge(now=20), (0, 0))
+        # url1's body is removed;  those of url2 and url3, purged now,
+        # are kept for the grace period
+        storage.purge(now=20 + storage.body_grace)
+        chunks, = storage.connection().execute(
+            'SELECT count(*) FROM chunks').fetchone()
+        self.assertEqual(chunks, 2)
+
+    def test_purge_uses_index(self):
+        from repoze.accelerator.sqlitestorage import SWEEP
+        storage = self._makeOne()
+        plan = storage.connection().execute('EXPLAIN QUERY PLAN ' + SWEEP,
+                                            (0,)).fetchall()
+        self.failUnless('entries_deadline' in str(plan), plan)
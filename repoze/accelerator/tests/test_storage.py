@@ -1,3 +1,4 @@
+import sys
 import unittest
 
 _MARKER = object()
@@ -34,31 +35,58 @@ class TestMemoryStorage(unittest.TestCase):
         headers = [('Header1', 'value1')]
         handler = storage.store('url', (), 0, 'status', headers)
         self.failIf(handler is None)
-        chunks = ['chunk1', 'chunk2']
         for chunk in ('chunk1', 'chunk2'):
             handler.write(chunk)
         handler.close()
-        self.assertEqual(storage.data['url'][()],
-                         (0, 'status', headers, chunks, {}))
+        self.assertEqual(tuple(storage.data['url'][()]),
+                         ((), 0, 'status',
+                          headers + [('Content-Length', '12')],
+                          ['chunk1chunk2'], {}))
         self.assertEqual(lock.acquired, 1)
         self.assertEqual(lock.released, 1)
 
     def test_store_existing(self):
         lock = DummyLock()
         storage = self._makeOne(lock)
-        storage.data['url'] = {}
-        storage.data['url'][(), ()] = ('otherstatus', (), ())
+        self._storeOne(storage, 'url', ['other'])
         headers = [('Header1', 'value1')]
         handler = storage.store('url', (), 0, 'status', headers)
         self.failIf(handler is None)
-        chunks = ['chunk1', 'chunk2']
         for chunk in ('chunk1', 'chunk2'):
             handler.write(chunk)
         handler.close()
-        self.assertEqual(storage.data['url'][()],
-                         (0, 'status', headers, chunks, {}))
-        self.assertEqual(lock.acquired, 1)
-        self.assertEqual(lock.released, 1)
+        self.assertEqual(tuple(storage.data['url'][()]),
+                         ((), 0, 'status',
+                          headers + [('Content-Length', '12')],
+                          ['chunk1chunk2'], {}))
+        self.assertEqual(len(storage.fetch('url')), 1)
+        self.assertEqual(storage.size, 12 + 13)
+        self.assertEqual(lock.acquired, 2)
+        self.assertEqual(lock.released, 2)
+
+    def test_store_joins_chunks(self):
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', ['a', 'bc', '', 'def'])
+        body = storage.fetch('url')[0][4]
+        self.assertEqual(body, ['abcdef'])
+        self.assertEqual(body.length, 6)
+
+    def test_store_keeps_content_length(self):
+        storage = self._makeOne(DummyLock())
+        headers = [('content-length', '3')]
+        handler = storage.store('url', (), sys.maxint, 'status', headers)
+        handler.write('abc')
+        handler.close()
+        self.assertEqual(storage.fetch('url')[0][3], headers)
+
+    def test_store_empty_body(self):
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', [])
+        discrims, expires, status, headers, body, extras = \
+                  storage.fetch('url')[0]
+        self.assertEqual(headers, [])
+        self.assertEqual(body, [])
+        self.assertEqual(body.length, 0)
 
     def test_fetch_nonexistent(self):
         lock = DummyLock()
@@ -68,26 +96,794 @@ class TestMemoryStorage(unittest.TestCase):
     def test_fetch_existing(self):
         lock = DummyLock()
         storage = self._makeOne(lock)
-        storage.data['url'] = {
-            ('env', (1, 2)):(0, 200, [], [], {}),
-            ('env', (3, 4)):(0, 203, [], [], {}),
-            }
-        result = storage.fetch('url')
+        d1 = (('env', ('A', '1')),)
+        d2 = (('env', ('A', '2')),)
+        self._storeOne(storage, 'url', [], d1)
+        self._storeOne(storage, 'url', [], d2)
+        result = [ tuple(entry) for entry in storage.fetch('url') ]
         result.sort()
         self.assertEqual(len(result), 2)
         self.assertEqual(
             result[0],
-            (('env', (1,2)), 0, 200, [], [], {})
+            (d1, sys.maxint, 'status', [], [], {})
             )
         self.assertEqual(
             result[1],
-            (('env', (3,4)), 0, 203, [], [], {})
+            (d2, sys.maxint, 'status', [], [], {})
             )
 
+    def test_fetch_returns_unchanging_view(self):
+        storage = self._makeOne(DummyLock())
+        d1 = (('env', ('A', '1')),)
+        d2 = (('env', ('A', '2')),)
+        self._storeOne(storage, 'url', ['abc'], d1)
+        view = storage.fetch('url')
+        self.failUnless(storage.fetch('url') is view)
+        self._storeOne(storage, 'url', ['abc'], d2)
+        self.assertEqual(len(view), 1)
+        self.assertEqual(len(storage.fetch('url')), 2)
+        storage.purge(now=sys.maxint)
+        self.assertEqual(len(view), 1)
+        self.assertEqual(storage.fetch('url'), None)
+        self.assertEqual(storage.views, {})
+
+    def test_entry_memory_overhead(self):
+        from repoze.accelerator.storage import CacheEntry
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', ['abc'])
+        entry = storage.fetch('url')[0]
+        self.failUnless(isinstance(entry, CacheEntry))
+        self.failIf(hasattr(entry, '__dict__'))
+        # the per-entry overhead (beyond the values themselves) is less
+        # than that of a tuple of the same fields
+        overhead = sys.getsizeof(entry)
+        as_tuple = sys.getsizeof((None,) * len(CacheEntry.__slots__))
+        self.failUnless(overhead < as_tuple, (overhead, as_tuple))
+
+    def test_store_interns_headers(self):
+        storage = self._makeOne(DummyLock())
+        name = ''.join(['Content-', 'Type'])
+        value = ''.join(['text/', 'html'])
+        etag = ''.join(['"a', '"'])
+        handler = storage.store('url', (), sys.maxint, 'status',
+                                [(name, value), ('ETag', etag)])
+        handler.close()
+        headers = storage.fetch('url')[0].headers
+        self.failUnless(headers[0][0] is intern('Content-Type'))
+        self.failUnless(headers[0][1] is intern('text/html'))
+        self.failUnless(headers[1][1] is etag) # not a shared value
+
     def test_storage_factory_defaults(self):
         from repoze.accelerator.storage import make_memory_storage
         storage = make_memory_storage(None, {})
         self.assertEqual(storage.logger, None)
+        self.assertEqual(storage.max_size, 0)
+        self.assertEqual(storage.max_entries, 0)
+        self.failIf(storage.bounded)
+        self.assertEqual(storage.purge_batch, 8)
+        self.assertEqual(storage.purge_interval, 0)
+        self.assertEqual(storage.compress_min_size, 0)
+        self.assertEqual(storage.max_object_size, 0)
+
+    def test_default_locks_not_shared(self):
+        from repoze.accelerator.storage import MemoryStorage
+        self.failIf(MemoryStorage(None).lock is MemoryStorage(None).lock)
+
+    def test_storage_factory_overrides(self):
+        from repoze.accelerator.storage import make_memory_storage
+        config = {'storage.max_size':'1000',
+                  'storage.max_entries':'10',
+                  'storage.purge_batch':'0',
+                  'storage.purge_interval':'3600',
+                  'storage.compress_min_size':'512',
+                  'storage.max_object_size':'4096'}
+        storage = make_memory_storage(None, config)
+        self.assertEqual(storage.max_size, 1000)
+        self.assertEqual(storage.max_entries, 10)
+        self.failUnless(storage.bounded)
+        self.assertEqual(storage.purge_batch, 0)
+        self.assertEqual(storage.purge_interval, 3600)
+        self.assertEqual(storage.compress_min_size, 512)
+        self.assertEqual(storage.max_object_size, 4096)
+
+    def _storeOne(self, storage, url, body, discriminators=(),
+                  expires=sys.maxint, **extras):
+        handler = storage.store(url, discriminators, expires, 'status', [],
+                                **extras)
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def test_store_accounts_size(self):
+        storage = self._makeOne(DummyLock())
+        headers = [('Header1', 'value1')]
+        discrims = (('env', ('REQUEST_METHOD', 'GET')),)
+        handler = storage.store('url', discrims, 0, 'status', headers)
+        handler.write('chunk1')
+        handler.close()
+        self.assertEqual(storage.size, 6 + 13 + 3 + 14 + 3)
+
+    def test_store_accounts_encodings_size(self):
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', ['abcdef'],
+                       encodings={'gzip': 'abcd', 'br': 'abc'})
+        self.assertEqual(storage.size, 6 + 4 + 3)
+
+    def test_store_within_max_object_size(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_object_size = 6
+        handler = storage.store('url', (), sys.maxint, 'status', [])
+        handler.write('abc')
+        handler.write('def')
+        self.failIf(handler.discarding)
+        handler.close()
+        self.assertEqual(storage.fetch('url')[0].body, ['abcdef'])
+        self.assertEqual(storage.oversized, 0)
+        self.assertEqual(storage.oversized_bytes, 0)
+
+    def test_store_exceeds_max_object_size(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_object_size = 5
+        handler = storage.store('url', (), sys.maxint, 'status', [])
+        handler.write('abc')
+        self.failIf(handler.discarding)
+        handler.write('def')
+        self.failUnless(handler.discarding)
+        handler.write('ghi')
+        handler.close()
+        self.assertEqual(storage.fetch('url'), None)
+        self.assertEqual(storage.size, 0)
+        self.assertEqual(storage.oversized, 1)
+        self.assertEqual(storage.oversized_bytes, 9)
+        stats = storage.stats()
+        self.assertEqual(stats['storage_oversized'], 1)
+        self.assertEqual(stats['storage_oversized_bytes'], 9)
+
+    def test_store_content_length_exceeds_max_object_size(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_object_size = 5
+        handler = storage.store('url', (), sys.maxint, 'status',
+                                [('Content-Length', '6')])
+        self.failUnless(handler.discarding)
+        handler.write('abcdef')
+        handler.close()
+        self.assertEqual(storage.fetch('url'), None)
+        self.assertEqual(storage.oversized, 1)
+        self.assertEqual(storage.oversized_bytes, 6)
+
+    def test_store_bad_content_length_max_object_size(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_object_size = 5
+        handler = storage.store('url', (), sys.maxint, 'status',
+                                [('Content-Length', 'bogus')])
+        self.failIf(handler.discarding)
+
+    def test_store_no_max_object_size(self):
+        storage = self._makeOne(DummyLock())
+        handler = storage.store('url', (), sys.maxint, 'status',
+                                [('Content-Length', '100000')])
+        self.failIf(handler.discarding)
+
+    def _makeCompressing(self, min_size=100):
+        storage = self._makeOne(DummyLock())
+        storage.compress_min_size = min_size
+        return storage
+
+    def test_store_compressed(self):
+        from repoze.accelerator.storage import CompressedBody
+        storage = self._makeCompressing()
+        self._storeOne(storage, 'url', ['abc' * 100, 'def' * 100])
+        body = storage.fetch('url')[0][4]
+        self.failUnless(isinstance(body, CompressedBody))
+        self.assertEqual(body.length, 600)
+        self.assertEqual(''.join(body), 'abc' * 100 + 'def' * 100)
+        self.assertEqual(''.join(body), 'abc' * 100 + 'def' * 100)
+        self.assertEqual(storage.compressed, 1)
+        self.assertEqual(storage.compressed_in, 600)
+        self.assertEqual(storage.compressed_out, len(body.data))
+        self.assertEqual(storage.size, len(body.data))
+        self.failUnless(storage.compress_time >= 0)
+        self.failUnless(storage.compression_ratio > 5)
+
+    def test_store_compressed_reuses_gzip_encoding(self):
+        from repoze.accelerator.encoding import compress
+        storage = self._makeCompressing()
+        encoded = compress('gzip', 'abc' * 100)
+        self._storeOne(storage, 'url', ['abc' * 100],
+                       encodings={'gzip': encoded})
+        entry = storage.fetch('url')[0]
+        self.failUnless(entry.body.data is encoded)
+        self.assertEqual(''.join(entry.body), 'abc' * 100)
+        self.assertEqual(storage.compress_time, 0)
+        self.assertEqual(storage.size, len(encoded))
+
+    def test_store_compressed_below_min_size(self):
+        storage = self._makeCompressing(min_size=1000)
+        self._storeOne(storage, 'url', ['abc' * 100])
+        self.assertEqual(storage.fetch('url')[0][4], ['abc' * 100])
+        self.assertEqual(storage.compressed, 0)
+        self.assertEqual(storage.compression_ratio, 0.0)
+
+    def test_store_compressed_encoded_already(self):
+        storage = self._makeCompressing()
+        handler = storage.store('url', (), sys.maxint, 'status',
+                                [('Content-Encoding', 'gzip')])
+        handler.write('abc' * 100)
+        handler.close()
+        self.assertEqual(storage.fetch('url')[0][4], ['abc' * 100])
+        self.assertEqual(storage.compressed, 0)
+
+    def test_store_compressed_incompressible(self):
+        import os
+        storage = self._makeCompressing()
+        data = os.urandom(1000)
+        self._storeOne(storage, 'url', [data])
+        self.assertEqual(storage.fetch('url')[0][4], [data])
+        self.assertEqual(storage.compressed, 0)
+        self.assertEqual(storage.size, 1000)
+
+    def test_compressed_body_decompressed_in_blocks(self):
+        from repoze.accelerator.storage import BLOCK_SIZE
+        storage = self._makeCompressing()
+        self._storeOne(storage, 'url', ['a' * (BLOCK_SIZE * 3 + 10)])
+        blocks = list(storage.fetch('url')[0][4])
+        self.failUnless(len(blocks) >= 4)
+        self.failIf([ block for block in blocks if len(block) > BLOCK_SIZE ])
+        self.assertEqual(''.join(blocks), 'a' * (BLOCK_SIZE * 3 + 10))
+
+    def test_store_replacing_entry_accounts_size_once(self):
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', ['abc'])
+        self._storeOne(storage, 'url', ['abcdef'])
+        self.assertEqual(storage.size, 6)
+
+    def test_unbounded_never_evicts(self):
+        storage = self._makeOne(DummyLock())
+        for i in range(100):
+            self._storeOne(storage, 'url%d' % i, ['x' * 100])
+        self.assertEqual(len(storage.data), 100)
+        self.assertEqual(storage.evictions, 0)
+
+    def test_max_entries_evicts_least_recently_used(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_entries = 2
+        storage.bounded = True
+        self._storeOne(storage, 'url1', ['abc'])
+        self._storeOne(storage, 'url2', ['abc'])
+        storage.fetch('url1')
+        self._storeOne(storage, 'url3', ['abc'])
+        self.assertEqual(sorted(storage.data.keys()), ['url1', 'url3'])
+        self.assertEqual(storage.evictions, 1)
+        self.assertEqual(storage.evicted_bytes, 3)
+        self.assertEqual(storage.size, 6)
+
+    def test_max_size_evicts_until_within_budget(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_size = 10
+        storage.bounded = True
+        self._storeOne(storage, 'url1', ['abc'])
+        self._storeOne(storage, 'url2', ['abc', 'def'])
+        self._storeOne(storage, 'url3', ['abcd'])
+        self.assertEqual(sorted(storage.data.keys()), ['url2', 'url3'])
+        self._storeOne(storage, 'url4', ['abcdefghi'])
+        self.assertEqual(storage.data.keys(), ['url4'])
+        self.assertEqual(storage.evictions, 3)
+        self.assertEqual(storage.evicted_bytes, 13)
+        self.assertEqual(storage.size, 9)
+
+    def test_max_size_evicts_single_variant(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_size = 15
+        storage.bounded = True
+        d1 = (('env', ('A', '1')),)
+        d2 = (('env', ('A', '2')),)
+        self._storeOne(storage, 'url', ['abc'], d1)
+        self._storeOne(storage, 'url', ['abc'], d2)
+        self.assertEqual(storage.data['url'].keys(), [d2])
+        self.assertEqual(storage.evictions, 1)
+
+    def test_entry_larger_than_max_size_not_stored(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_size = 10
+        storage.bounded = True
+        self._storeOne(storage, 'url1', ['abc'])
+        self._storeOne(storage, 'url2', ['abcd'])
+        handler = storage.store('url3', (), sys.maxint, 'status', [])
+        handler.write('abcdefghijk')
+        handler.close()
+        self.failUnless(handler.discarding)
+        self.assertEqual(sorted(storage.data.keys()), ['url1', 'url2'])
+        self.assertEqual(storage.size, 7)
+        self.assertEqual(storage.evictions, 0)
+        self.assertEqual(storage.oversized, 1)
+        self.assertEqual(storage.oversized_bytes, 11)
+
+    def test_purge_nothing_expired(self):
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', ['abc'])
+        self.assertEqual(storage.purge(), (0, 0))
+        self.assertEqual(storage.data.keys(), ['url'])
+
+    def test_purge_expired(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        storage.logger = logger = DummyLogger()
+        d1 = (('env', ('A', '1')),)
+        self._storeOne(storage, 'url1', ['abc'], expires=10)
+        self._storeOne(storage, 'url1', ['abc'], d1, expires=30)
+        self._storeOne(storage, 'url2', ['abcdef'], expires=20)
+        self.assertEqual(storage.purge(now=20), (2, 9))
+        self.assertEqual(storage.data.keys(), ['url1'])
+        self.assertEqual(tuple(storage.data['url1'][d1]),
+                         (d1, 30, 'status', [('Content-Length', '3')],
+                          ['abc'], {}))
+        self.assertEqual(storage.size, 8)
+        self.assertEqual(storage.purged, 2)
+        self.assertEqual(storage.purged_bytes, 9)
+        self.assertEqual(logger.messages,
+                         ['repoze.accelerator: purged 2 entries (9 bytes)'])
+
+    def test_purge_limit(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        for i in range(5):
+            self._storeOne(storage, 'url%d' % i, ['abc'], expires=i)
+        self.assertEqual(storage.purge(now=10, limit=2), (2, 6))
+        self.assertEqual(sorted(storage.data.keys()), ['url2', 'url3',
+                                                       'url4'])
+
+    def test_purge_keeps_stale_until(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        self._storeOne(storage, 'url', ['abc'], expires=10, stale_until=30)
+        self.assertEqual(storage.purge(now=20), (0, 0))
+        self.assertEqual(storage.purge(now=30), (1, 3))
+
+    def test_purge_skips_replaced_entry(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        self._storeOne(storage, 'url', ['abc'], expires=10)
+        self._storeOne(storage, 'url', ['abcd'], expires=50)
+        self.assertEqual(storage.purge(now=20), (0, 0))
+        self.assertEqual(storage.data['url'][()].expires, 50)
+        self.assertEqual(storage.purge(now=50), (1, 4))
+        self.assertEqual(storage._expiry, [])
+
+    def test_purge_skips_evicted_entry(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        storage.max_entries = 1
+        storage.bounded = True
+        self._storeOne(storage, 'url1', ['abc'], expires=10)
+        self._storeOne(storage, 'url2', ['abc'], expires=50)
+        self.assertEqual(storage.purge(now=20), (0, 0))
+        self.assertEqual(storage.data.keys(), ['url2'])
+
+    def test_store_purges_expired_batch(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        for i in range(3):
+            self._storeOne(storage, 'old%d' % i, ['abc'], expires=i)
+        storage.purge_batch = 2
+        self._storeOne(storage, 'new', ['abc'])
+        self.assertEqual(sorted(storage.data.keys()), ['new', 'old2'])
+        self.assertEqual(storage.purged, 2)
+
+    def test_store_purge_disabled(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        self._storeOne(storage, 'old', ['abc'], expires=1)
+        self._storeOne(storage, 'new', ['abc'])
+        self.assertEqual(sorted(storage.data.keys()), ['new', 'old'])
+
+    def test_purge_compacts_expiry_heap(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        for i in range(100):
+            self._storeOne(storage, 'url', ['abc'], expires=sys.maxint - i)
+        self.assertEqual(len(storage._expiry), 100)
+        storage.purge()
+        self.assertEqual(storage._expiry, [(sys.maxint - 99, 'url', ())])
+
+    def test_purge_interval_thread(self):
+        import time
+        storage = self._getTargetClass()(None, purge_interval=0.01)
+        self._storeOne(storage, 'url', ['abc'], expires=time.time() + 0.02)
+        for i in range(500):
+            if not storage.data:
+                break
+            time.sleep(0.01)
+        self.assertEqual(storage.data, {})
+        self.assertEqual(storage.purged, 1)
+
+    def test_class_conforms_to_IVariantStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IVariantStorage
+        verifyClass(IVariantStorage, self._getTargetClass())
+
+    def test_class_conforms_to_IStatsStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IStatsStorage
+        verifyClass(IStatsStorage, self._getTargetClass())
+
+    def test_stats(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_entries = 1
+        storage.bounded = True
+        self._storeOne(storage, 'url1', ['abc'])
+        self._storeOne(storage, 'url2', ['abcd'])
+        stats = storage.stats()
+        self.assertEqual(stats['storage_entries'], 1)
+        self.assertEqual(stats['storage_bytes'], 4)
+        self.assertEqual(stats['storage_evictions'], 1)
+        self.assertEqual(stats['storage_evicted_bytes'], 3)
+        self.assertEqual(stats['storage_purged'], 0)
+        self.assertEqual(stats['storage_compressed'], 0)
+
+    def _resolver(self, **values):
+        def resolve(typ, name):
+            return values.get('%s_%s' % (typ, name))
+        return resolve
+
+    def test_fetch_variant_nonexistent(self):
+        storage = self._makeOne(DummyLock())
+        self.assertEqual(storage.fetch_variant('url', self._resolver()), None)
+
+    def test_fetch_variant(self):
+        storage = self._makeOne(DummyLock())
+        d1 = (('env', ('REQUEST_METHOD', 'GET')), ('vary', ('cookie', '1')))
+        d2 = (('env', ('REQUEST_METHOD', 'GET')), ('vary', ('cookie', '2')))
+        d3 = (('vary', ('x-foo', '1')),)
+        self._storeOne(storage, 'url', ['one'], d1)
+        self._storeOne(storage, 'url', ['two'], d2)
+        self._storeOne(storage, 'url', ['three'], d3)
+        self.assertEqual(len(storage.index['url']), 2)
+        resolve = self._resolver(env_REQUEST_METHOD='GET', vary_cookie='2')
+        self.assertEqual(tuple(storage.fetch_variant('url', resolve)),
+                         (d2, sys.maxint, 'status',
+                          [('Content-Length', '3')], ['two'], {}))
+        resolve = self._resolver(env_REQUEST_METHOD='GET', vary_cookie='3',
+                                 **{'vary_x-foo':'1'})
+        self.assertEqual(storage.fetch_variant('url', resolve)[4],
+                         ['three'])
+        resolve = self._resolver(env_REQUEST_METHOD='GET')
+        self.assertEqual(storage.fetch_variant('url', resolve), None)
+
+    def test_fetch_variant_no_discriminators(self):
+        storage = self._makeOne(DummyLock())
+        self._storeOne(storage, 'url', ['abc'])
+        self.assertEqual(storage.fetch_variant('url', self._resolver())[4],
+                         ['abc'])
+
+    def test_fetch_variant_touches_only_match(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_entries = 2
+        storage.bounded = True
+        d1 = (('vary', ('cookie', '1')),)
+        d2 = (('vary', ('cookie', '2')),)
+        self._storeOne(storage, 'url', ['one'], d1)
+        self._storeOne(storage, 'url', ['two'], d2)
+        storage.fetch_variant('url', self._resolver(vary_cookie='1'))
+        self._storeOne(storage, 'other', ['three'])
+        self.assertEqual(storage.data['url'].keys(), [d1])
+
+    def test_index_forgets_removed_entries(self):
+        storage = self._makeOne(DummyLock())
+        storage.purge_batch = 0
+        d1 = (('vary', ('cookie', '1')),)
+        d2 = (('vary', ('cookie', '2')),)
+        d3 = (('env', ('REMOTE_USER', 'fred')),)
+        self._storeOne(storage, 'url', ['one'], d1, expires=10)
+        self._storeOne(storage, 'url', ['two'], d2, expires=20)
+        self._storeOne(storage, 'url', ['three'], d3, expires=30)
+        storage.purge(now=10)
+        self.assertEqual(storage.index['url'],
+                         {(('vary', 'cookie'),):{('2',):d2},
+                          (('env', 'REMOTE_USER'),):{('fred',):d3}})
+        storage.purge(now=20)
+        self.assertEqual(storage.index['url'],
+                         {(('env', 'REMOTE_USER'),):{('fred',):d3}})
+        storage.purge(now=30)
+        self.assertEqual(storage.index, {})
+
+    def test_bounded_fetch_of_unaccounted_entry(self):
+        storage = self._makeOne(DummyLock())
+        storage.max_entries = 1
+        storage.bounded = True
+        from repoze.accelerator.storage import CacheEntry
+        entry = CacheEntry((), 0, 200, [], [], 0, {})
+        storage.data['url'] = {(): entry}
+        storage.views['url'] = (entry,)
+        self.assertEqual(storage.fetch('url'), (entry,))
+
+class TestShardedMemoryStorage(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.accelerator.storage import ShardedMemoryStorage
+        return ShardedMemoryStorage
+
+    def _makeOne(self, segments=4, **kw):
+        klass = self._getTargetClass()
+        return klass(None, segments, **kw)
+
+    def _storeOne(self, storage, url, body, discriminators=(),
+                  expires=sys.maxint):
+        handler = storage.store(url, discriminators, expires, 'status', [])
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def test_class_conforms_to_IVariantStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IVariantStorage
+        verifyClass(IVariantStorage, self._getTargetClass())
+
+    def test_instance_conforms_to_IVariantStorage(self):
+        from zope.interface.verify import verifyObject
+        from repoze.accelerator.interfaces import IVariantStorage
+        verifyObject(IVariantStorage, self._makeOne())
+
+    def test_class_conforms_to_IStatsStorage(self):
+        from zope.interface.verify import verifyClass
+        from repoze.accelerator.interfaces import IStatsStorage
+        verifyClass(IStatsStorage, self._getTargetClass())
+
+    def test_stats(self):
+        storage = self._makeOne()
+        for i in range(20):
+            self._storeOne(storage, 'url%d' % i, ['abc'])
+        stats = storage.stats()
+        self.assertEqual(stats['storage_entries'], 20)
+        self.assertEqual(stats['storage_bytes'], 60)
+        self.assertEqual(stats['storage_evictions'], 0)
+
+    def test_segments_have_own_locks(self):
+        storage = self._makeOne()
+        self.assertEqual(len(storage.segments), 4)
+        locks = set([ id(segment.lock) for segment in storage.segments ])
+        self.assertEqual(len(locks), 4)
+
+    def test_store_and_fetch(self):
+        storage = self._makeOne()
+        for i in range(20):
+            self._storeOne(storage, 'url%d' % i, ['abc%d' % i])
+        for i in range(20):
+            url = 'url%d' % i
+            entries = storage.fetch(url)
+            self.assertEqual(len(entries), 1)
+            self.assertEqual(entries[0][4], ['abc%d' % i])
+            self.failUnless(url in storage.segment(url).data)
+        used = [ segment for segment in storage.segments if segment.data ]
+        self.failUnless(len(used) > 1)
+        self.assertEqual(storage.fetch('other'), None)
+
+    def test_fetch_variant(self):
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        self._storeOne(storage, 'url', ['abc'], d1)
+        resolve = lambda typ, name: '1'
+        self.assertEqual(storage.fetch_variant('url', resolve)[4], ['abc'])
+        self.assertEqual(storage.fetch_variant('other', resolve), None)
+
+    def test_budgets_are_shared(self):
+        storage = self._makeOne(max_size=10, max_entries=9)
+        for segment in storage.segments:
+            self.assertEqual(segment.max_size, 3)
+            self.assertEqual(segment.max_entries, 3)
+            self.failUnless(segment.bounded)
+
+    def test_purge_and_totals(self):
+        storage = self._makeOne(purge_batch=0)
+        for i in range(10):
+            self._storeOne(storage, 'url%d' % i, ['abc'], expires=i)
+        self.assertEqual(storage.size, 30)
+        self.assertEqual(storage.purge(now=5), (6, 18))
+        self.assertEqual(storage.size, 12)
+        self.assertEqual(storage.purged, 6)
+        self.assertEqual(storage.purged_bytes, 18)
+        self.assertEqual(storage.evictions, 0)
+        self.assertEqual(storage.evicted_bytes, 0)
+
+    def test_compression_totals(self):
+        storage = self._makeOne(compress_min_size=100)
+        for i in range(10):
+            self._storeOne(storage, 'url%d' % i, ['abc' * 100])
+        self.assertEqual(storage.compressed, 10)
+        self.assertEqual(storage.compressed_in, 3000)
+        self.assertEqual(storage.compression_ratio,
+                         3000.0 / storage.compressed_out)
+        self.failUnless(storage.compress_time >= 0)
+
+    def test_oversized_totals(self):
+        storage = self._makeOne(max_object_size=2)
+        self.assertEqual(storage.max_object_size, 2)
+        for i in range(10):
+            self._storeOne(storage, 'url%d' % i, ['abc'])
+        self.assertEqual(storage.oversized, 10)
+        self.assertEqual(storage.oversized_bytes, 30)
+        self.assertEqual(storage.stats()['storage_oversized_bytes'], 30)
+
+    def test_factory(self):
+        from repoze.accelerator.storage import make_memory_storage
+        storage = make_memory_storage(None, {'storage.segments':'8',
+                                             'storage.max_entries':'80'})
+        self.failUnless(isinstance(storage, self._getTargetClass()))
+        self.assertEqual(len(storage.segments), 8)
+        self.assertEqual(storage.max_entries, 80)
+        self.assertEqual(storage.segments[0].max_entries, 10)
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def _makeOne(self):
+        from repoze.accelerator.storage import MemoryStorage
+        return MemoryStorage(DummyLogger())
+
+    def _storeOne(self, storage, url, body, discriminators=(),
+                  expires=sys.maxint, **extras):
+        handler = storage.store(url, discriminators, expires, 'status',
+                                [('Content-Type', 'text/plain')], **extras)
+        for chunk in body:
+            handler.write(chunk)
+        handler.close()
+
+    def _wait_restored(self, storage):
+        import time
+        for i in range(500):
+            if not storage.restoring:
+                return
+            time.sleep(0.01)
+        self.fail('not restored')
+
+    def test_snapshot_and_restore(self):
+        storage = self._makeOne()
+        d1 = (('vary', ('cookie', '1')),)
+        self._storeOne(storage, 'url1', ['abc', 'def'], d1,
+                       stale_until=sys.maxint)
+        self._storeOne(storage, 'url2', ['ghi'])
+        self._storeOne(storage, 'expired', ['jkl'], expires=1)
+        self.assertEqual(storage.snapshot(self.path), (2, 9))
+        restored = self._makeOne()
+        self.assertEqual(restored.restore(self.path), (2, 9))
+        self.assertEqual(sorted(restored.data.keys()), ['url1', 'url2'])
+        entry = restored.data['url1'][d1]
+        self.assertEqual(tuple(entry),
+                         (d1, sys.maxint, 'status',
+                          [('Content-Type', 'text/plain'),
+                           ('Content-Length', '6')],
+                          ['abcdef'], {'stale_until':sys.maxint}))
+        self.failIf(restored.restoring)
+        self.assertEqual(restored.logger.messages[-1],
+                         'repoze.accelerator: loaded 2 entries (9 bytes) '
+                         'from %s' % self.path)
+
+    def test_restore_skips_expired_and_newer(self):
+        import time
+        from repoze.accelerator.snapshot import write_snapshot
+        write_snapshot(self.path, [
+            ('gone', (), time.time() - 1, 'status', [], {}, 'abc'),
+            ('stale', (), time.time() - 1, 'status', [],
+             {'stale_until':sys.maxint}, 'abc'),
+            ('newer', (), sys.maxint, 'status', [], {}, 'old'),
+            ])
+        storage = self._makeOne()
+        self._storeOne(storage, 'newer', ['new'])
+        self.assertEqual(storage.restore(self.path), (1, 3))
+        self.assertEqual(sorted(storage.data.keys()), ['newer', 'stale'])
+        self.assertEqual(storage.fetch('newer')[0][4], ['new'])
+
+    def test_sharded_snapshot_and_restore(self):
+        from repoze.accelerator.storage import ShardedMemoryStorage
+        storage = ShardedMemoryStorage(None, 4)
+        for i in range(10):
+            self._storeOne(storage, 'url%d' % i, ['abc'])
+        self.assertEqual(storage.snapshot(self.path), (10, 30))
+        restored = ShardedMemoryStorage(None, 4)
+        self.assertEqual(restored.restore(self.path), (10, 30))
+        for i in range(10):
+            self.assertEqual(restored.fetch('url%d' % i)[0][4], ['abc'])
+
+    def test_enable_snapshots_loads_in_background(self):
+        from repoze.accelerator import storage as module
+        old = self._makeOne()
+        self._storeOne(old, 'url', ['abc'])
+        old.snapshot(self.path)
+        atexit = DummyAtexit()
+        module.atexit, saved = atexit, module.atexit
+        try:
+            storage = self._makeOne()
+            module.enable_snapshots(storage, self.path)
+        finally:
+            module.atexit = saved
+        self._wait_restored(storage)
+        self.assertEqual(storage.fetch('url')[0][4], ['abc'])
+        # saved at exit
+        self._storeOne(storage, 'url2', ['def'])
+        atexit.run()
+        restored = self._makeOne()
+        self.assertEqual(restored.restore(self.path), (2, 6))
+
+    def test_enable_snapshots_no_save_while_loading(self):
+        import os
+        from repoze.accelerator import storage as module
+        atexit = DummyAtexit()
+        module.atexit, saved = atexit, module.atexit
+        try:
+            storage = self._makeOne()
+            storage.logger.warning = storage.logger.info
+            module.enable_snapshots(storage, self.path)
+        finally:
+            module.atexit = saved
+        storage.restoring = True
+        atexit.run()
+        self.failIf(os.path.exists(self.path))
+
+    def test_enable_snapshots_on_signal(self):
+        import os
+        import signal
+        import time
+        from repoze.accelerator import storage as module
+        previous = signal.getsignal(signal.SIGUSR2)
+        module.atexit, saved = DummyAtexit(), module.atexit
+        try:
+            storage = self._makeOne()
+            self._storeOne(storage, 'url', ['abc'])
+            module.enable_snapshots(storage, self.path, 'SIGUSR2')
+            os.kill(os.getpid(), signal.SIGUSR2)
+            for i in range(500):
+                if os.path.exists(self.path):
+                    break
+                time.sleep(0.01)
+        finally:
+            module.atexit = saved
+            signal.signal(signal.SIGUSR2, previous)
+        restored = self._makeOne()
+        self.assertEqual(restored.restore(self.path), (1, 3))
+
+    def test_enable_snapshots_signal_outside_main_thread(self):
+        import signal
+        import threading
+        from repoze.accelerator import storage as module
+        previous = signal.getsignal(signal.SIGUSR2)
+        atexit = DummyAtexit()
+        module.atexit, saved = atexit, module.atexit
+        try:
+            storage = self._makeOne()
+            storage.logger.warning = storage.logger.info
+            thread = threading.Thread(target=module.enable_snapshots,
+                                      args=(storage, self.path, 'SIGUSR2'))
+            thread.start()
+            thread.join()
+        finally:
+            module.atexit = saved
+        self.assertEqual(signal.getsignal(signal.SIGUSR2), previous)
+        self.assertEqual(len(atexit.funcs), 1)
+        self.assertEqual(storage.logger.messages, [
+            'repoze.accelerator: not saving %s on SIGUSR2:  signal '
+            'handlers may only be installed from the main thread'
+            % self.path])
+
+    def test_factory(self):
+        from repoze.accelerator import storage as module
+        old = self._makeOne()
+        self._storeOne(old, 'url', ['abc'])
+        old.snapshot(self.path)
+        module.atexit, saved = DummyAtexit(), module.atexit
+        try:
+            storage = module.make_memory_storage(
+                None, {'storage.snapshot_path':self.path})
+        finally:
+            module.atexit = saved
+        self._wait_restored(storage)
+        self.assertEqual(storage.fetch('url')[0][4], ['abc'])
 
 class DummyLock:
     def __init__(self):
@@ -100,3 +896,20 @@ class DummyLock:
     def release(self):
         self.released += 1
 
+class DummyLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg, *args):
+        self.messages.append(msg % args)
+
+class DummyAtexit:
+    def __init__(self):
+        self.funcs = []
+
+    def register(self, func):
+        self.funcs.append(func)
+
+    def run(self):
+        for func in self.funcs:
+            func()